@@ -0,0 +1,88 @@
+"""
+Microbenchmark comparing the two ways of writing a pipeline to the server:
+one `send` per buffered command (the original `BloomdPipeline.execute`),
+and a single `send_many` write of the whole buffer.
+
+A local responder answers "Yes" to every line, so only client side costs
+are measured. Usage:
+
+    python benchmarks/pipeline_send.py [depth ...]
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pybloomd import BloomdConnection
+
+
+class CountingSocket(object):
+    "Wraps a socket, counting the sendall calls and bytes written"
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+        self.bytes = 0
+
+    def sendall(self, data):
+        self.calls += 1
+        self.bytes += len(data)
+        return self.sock.sendall(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+def responder(listener):
+    "Answers every received line with 'Yes'"
+    while True:
+        conn, _ = listener.accept()
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(b"Yes\n" * data.count(b"\n"))
+        conn.close()
+
+
+def run(conn, cmds, single_write):
+    "Writes the commands and reads back every response"
+    if single_write:
+        conn.send_many(cmds)
+    else:
+        for cmd in cmds:
+            conn.send(cmd)
+    for _ in cmds:
+        conn.read()
+
+
+def main(depths):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    t = threading.Thread(target=responder, args=(listener,))
+    t.daemon = True
+    t.start()
+
+    conn = BloomdConnection("127.0.0.1:%d" % listener.getsockname()[1], None)
+    conn.sock = CountingSocket(conn._create_socket())
+
+    print("%-14s %8s %10s %12s %14s" % ("mode", "depth", "sendall", "bytes", "cmds/sec"))
+    for depth in depths:
+        cmds = [b"c foobar key%d" % i for i in range(depth)]
+        rounds = max(1, 100000 // depth)
+        for label, single_write in (("per-command", False), ("single-write", True)):
+            run(conn, cmds, single_write)
+            conn.sock.calls = conn.sock.bytes = 0
+            start = time.time()
+            for _ in range(rounds):
+                run(conn, cmds, single_write)
+            elapsed = time.time() - start
+            print("%-14s %8d %10d %12d %14.0f" % (label, depth, conn.sock.calls // rounds,
+                                                   conn.sock.bytes // rounds,
+                                                   depth * rounds / elapsed))
+
+
+if __name__ == "__main__":
+    main([int(d) for d in sys.argv[1:]] or [10, 100, 1000, 10000])
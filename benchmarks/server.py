@@ -0,0 +1,231 @@
+"""
+An in-process stand-in for a bloomd server, speaking enough of the line
+protocol to exercise the client: create, list, s, c, b, m, info, flush,
+drop, clear and close. Filters are plain sets, so there are no false
+positives and nothing is written to disk.
+
+It is meant for benchmarks and local testing, not as a bloomd replacement.
+It can also be run on its own:
+
+    python benchmarks/server.py [port]
+"""
+import socket
+import sys
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class StandInFilter(object):
+    "Holds the keys and counters of a single filter"
+    def __init__(self, name, capacity=100000, prob=0.0001, in_memory=False):
+        self.name = name
+        self.capacity = capacity
+        self.prob = prob
+        self.in_memory = in_memory
+        self.keys = set()
+        self.checks = self.check_hits = 0
+        self.sets = self.set_hits = 0
+
+    def set(self, key):
+        "Adds a key, returning the protocol response"
+        self.sets += 1
+        if key in self.keys:
+            return "No"
+        self.set_hits += 1
+        self.keys.add(key)
+        return "Yes"
+
+    def check(self, key):
+        "Checks a key, returning the protocol response"
+        self.checks += 1
+        if key in self.keys:
+            self.check_hits += 1
+            return "Yes"
+        return "No"
+
+    def storage(self):
+        "Returns a plausible byte size for the filter"
+        return self.capacity * 2 + 240
+
+    def info(self):
+        "Returns the lines of an info response"
+        return [
+            "capacity %d" % self.capacity,
+            "checks %d" % self.checks,
+            "check_hits %d" % self.check_hits,
+            "check_misses %d" % (self.checks - self.check_hits),
+            "in_memory %d" % self.in_memory,
+            "page_ins 0",
+            "page_outs 0",
+            "probability %f" % self.prob,
+            "sets %d" % self.sets,
+            "set_hits %d" % self.set_hits,
+            "set_misses %d" % (self.sets - self.set_hits),
+            "size %d" % len(self.keys),
+            "storage %d" % self.storage(),
+        ]
+
+
+class StandInHandler(socketserver.BaseRequestHandler):
+    """
+    Handles a single client connection. All complete lines in a read are
+    answered with a single write, so pipelined commands are not slowed
+    down by per-response syscalls.
+    """
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        pending = b""
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                return
+            pending += data
+            if b"\n" not in pending:
+                continue
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+            out = []
+            for line in lines:
+                out.extend(self.server.execute(line.decode("utf-8").rstrip("\r")))
+            sock.sendall(("\n".join(out) + "\n").encode("utf-8"))
+
+
+class StandInServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    A threaded TCP server holding a set of stand-in filters. Commands
+    are run one at a time under a lock.
+
+    :Parameters:
+        - host (optional) : The address to listen on.
+        - port (optional) : The port to listen on, 0 picks a free one.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        socketserver.TCPServer.__init__(self, (host, port), StandInHandler)
+        self.filters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def address(self):
+        "Returns the host:port string to give to a client"
+        return "%s:%d" % self.server_address[:2]
+
+    def start(self):
+        "Starts serving on a background thread, returning the server"
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        "Stops serving and closes the listening socket"
+        self.shutdown()
+        self.server_close()
+
+    def execute(self, line):
+        "Runs a single command line, returning the response lines"
+        parts = line.split(" ")
+        handler = getattr(self, "cmd_" + parts[0], None)
+        if handler is None:
+            return ["Client Error: Command not supported"]
+        with self.lock:
+            return handler(*parts[1:])
+
+    def _filter(self, name):
+        "Returns a filter by name, or None if it does not exist"
+        return self.filters.get(name)
+
+    def cmd_create(self, name=None, *args):
+        if not name:
+            return ["Client Error: Must provide filter name"]
+        if name in self.filters:
+            return ["Exists"]
+        options = {}
+        for arg in args:
+            key, _, value = arg.partition("=")
+            options[key] = value
+        try:
+            self.filters[name] = StandInFilter(
+                name,
+                capacity=int(options.get("capacity", 100000)),
+                prob=float(options.get("prob", 0.0001)),
+                in_memory=options.get("in_memory") == "1")
+        except ValueError:
+            return ["Client Error: Bad arguments"]
+        return ["Done"]
+
+    def cmd_list(self, prefix=""):
+        lines = ["START"]
+        for name in sorted(self.filters):
+            if name.startswith(prefix):
+                f = self.filters[name]
+                lines.append("%s %f %d %d %d" % (name, f.prob, f.storage(), f.capacity, len(f.keys)))
+        lines.append("END")
+        return lines
+
+    def _keyed(self, method, name=None, *keys):
+        "Applies a filter method to each key, returning the joined responses"
+        f = self._filter(name)
+        if f is None:
+            return ["Filter does not exist"]
+        if not keys:
+            return ["Client Error: Must provide filter name and key"]
+        method = getattr(f, method)
+        return [" ".join([method(key) for key in keys])]
+
+    def cmd_s(self, *args):
+        return self._keyed("set", *args[:2])
+
+    def cmd_c(self, *args):
+        return self._keyed("check", *args[:2])
+
+    def cmd_b(self, *args):
+        return self._keyed("set", *args)
+
+    def cmd_m(self, *args):
+        return self._keyed("check", *args)
+
+    def cmd_info(self, name=None):
+        f = self._filter(name)
+        if f is None:
+            return ["Filter does not exist"]
+        return ["START"] + f.info() + ["END"]
+
+    def cmd_flush(self, name=None):
+        if name is not None and name not in self.filters:
+            return ["Filter does not exist"]
+        return ["Done"]
+
+    def cmd_drop(self, name=None):
+        if self.filters.pop(name, None) is None:
+            return ["Filter does not exist"]
+        return ["Done"]
+
+    def cmd_close(self, name=None):
+        if name not in self.filters:
+            return ["Filter does not exist"]
+        return ["Done"]
+
+    def cmd_clear(self, name=None):
+        f = self._filter(name)
+        if f is None:
+            return ["Filter does not exist"]
+        self.filters[name] = StandInFilter(name, f.capacity, f.prob, f.in_memory)
+        return ["Done"]
+
+
+if __name__ == "__main__":
+    server = StandInServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8673)
+    print("Stand-in bloomd listening on %s" % server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,277 @@
+"""
+Benchmarks the client's hot paths: BloomdFilter add/check/bulk/multi,
+BloomdPipeline.execute and BloomdClient.list_filters, across key counts,
+pipeline depths and concurrency levels.
+
+By default an in-process stand-in server (see server.py) is started, so
+the numbers mostly reflect client side costs. Use --server to point the
+suite at a real bloomd instead. Results can be saved as JSON and compared
+against an earlier run:
+
+    python benchmarks/suite.py --save before.json
+    python benchmarks/suite.py --compare before.json
+
+Each benchmark reports the operations per second, where an operation is
+a single key or command, and the latency percentiles of each call.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pybloomd import BloomdClient
+from server import StandInServer
+
+# Use the most precise clock available
+clock = getattr(time, "perf_counter", time.time)
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(ordered, pct):
+    "Returns the nearest-rank percentile of a sorted list"
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+class Benchmark(object):
+    """
+    A single benchmark case. `setup` is called once with the client and
+    returns a callable, which is timed repeatedly and must return the
+    number of operations it performed.
+
+    :Parameters:
+        - name : The benchmark name.
+        - params : A dictionary of the parameters of this case.
+        - setup : Takes a client, returns the callable to time.
+    """
+    def __init__(self, name, params, setup):
+        self.name = name
+        self.params = params
+        self.setup = setup
+
+    @property
+    def key(self):
+        "Returns a name identifying this case across runs"
+        args = ",".join("%s=%s" % item for item in sorted(self.params.items()))
+        return "%s[%s]" % (self.name, args)
+
+    def run(self, client, duration, concurrency):
+        "Runs the benchmark for about `duration` seconds, returning the results"
+        func = self.setup(client)
+        func()  # Warm up the connections and filter
+
+        latencies = [[] for _ in range(concurrency)]
+        ops = [0] * concurrency
+        deadline = clock() + duration
+
+        def worker(idx):
+            record = latencies[idx].append
+            count = 0
+            while clock() < deadline:
+                start = clock()
+                count += func()
+                record(clock() - start)
+            ops[idx] = count
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        start = clock()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = clock() - start
+
+        ordered = sorted(l for per_thread in latencies for l in per_thread)
+        result = {
+            "calls": len(ordered),
+            "ops": sum(ops),
+            "ops_per_sec": sum(ops) / elapsed,
+        }
+        for pct in PERCENTILES:
+            result["p%d_ms" % pct] = percentile(ordered, pct) * 1000
+        return result
+
+
+def filter_name(prefix, params):
+    "Returns a filter name unique to a benchmark case"
+    return prefix + "".join("-%s%s" % item for item in sorted(params.items()))
+
+
+def make_filter(client, name):
+    "Creates a fresh in-memory filter"
+    client.create_filter(name, capacity=1000000, prob=0.001, in_memory=True)
+    f = client[name]
+    f.clear()
+    return f
+
+
+def bench_add(client):
+    f = make_filter(client, "bench-add")
+    counter = [0]
+
+    def func():
+        counter[0] += 1
+        f.add("key%d" % counter[0])
+        return 1
+    return func
+
+
+def bench_check(client):
+    f = make_filter(client, "bench-check")
+    f.bulk(["key%d" % i for i in range(1000)])
+
+    def func():
+        f.check("key500")
+        return 1
+    return func
+
+
+def bench_batch(method, key_count):
+    "Returns a setup for a bulk or multi benchmark with `key_count` keys"
+    def setup(client):
+        f = make_filter(client, filter_name("bench-" + method, {"keys": key_count}))
+        keys = ["key%d" % i for i in range(key_count)]
+        call = getattr(f, method)
+
+        def func():
+            call(keys)
+            return key_count
+        return func
+    return setup
+
+
+def bench_pipeline(depth):
+    "Returns a setup for a pipeline of `depth` checks"
+    def setup(client):
+        f = make_filter(client, filter_name("bench-pipeline", {"depth": depth}))
+        keys = ["key%d" % i for i in range(depth)]
+
+        def func():
+            pipe = f.pipeline()
+            for key in keys:
+                pipe.check(key)
+            pipe.execute()
+            return depth
+        return func
+    return setup
+
+
+def bench_list(filter_count):
+    "Returns a setup for listing with `filter_count` filters on the server"
+    def setup(client):
+        for i in range(filter_count):
+            client.create_filter("bench-list-%d" % i, in_memory=True)
+
+        def func():
+            client.list_filters()
+            return 1
+        return func
+    return setup
+
+
+def benchmarks(key_counts, depths):
+    "Returns all the benchmark cases"
+    cases = [
+        Benchmark("add", {}, bench_add),
+        Benchmark("check", {}, bench_check),
+    ]
+    for count in key_counts:
+        cases.append(Benchmark("bulk", {"keys": count}, bench_batch("bulk", count)))
+        cases.append(Benchmark("multi", {"keys": count}, bench_batch("multi", count)))
+    for depth in depths:
+        cases.append(Benchmark("pipeline", {"depth": depth}, bench_pipeline(depth)))
+    cases.append(Benchmark("list_filters", {"filters": 100}, bench_list(100)))
+    return cases
+
+
+def compare(results, baseline, threshold):
+    "Prints the change in ops/sec against a baseline, returning the regressions"
+    regressions = []
+    old = dict((r["key"], r) for r in baseline["results"])
+    print("\n%-44s %14s %14s %8s" % ("benchmark", "before", "after", "change"))
+    for r in results:
+        before = old.get(r["key"])
+        if before is None:
+            continue
+        change = r["ops_per_sec"] / before["ops_per_sec"] - 1
+        mark = ""
+        if change < -threshold:
+            mark = " REGRESSION"
+            regressions.append(r["key"])
+        print("%-44s %14.0f %14.0f %+7.1f%%%s" % (r["key"], before["ops_per_sec"],
+                                                r["ops_per_sec"], change * 100, mark))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--server", help="host:port of a bloomd server, instead of the stand-in")
+    parser.add_argument("--duration", type=float, default=1.0,
+                        help="seconds to run each benchmark (default: %(default)s)")
+    parser.add_argument("--keys", type=int, nargs="+", default=[10, 100, 1000, 10000],
+                        help="key counts for bulk and multi")
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 10, 100, 1000],
+                        help="pipeline depths")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4],
+                        help="numbers of threads sharing the client")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare against results saved with --save")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown reported as a regression (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    server = None
+    address = args.server
+    if address is None:
+        server = StandInServer().start()
+        address = server.address
+
+    results = []
+    print("%-44s %14s %10s %10s %10s" % ("benchmark", "ops/sec", "p50 ms", "p90 ms", "p99 ms"))
+    try:
+        for concurrency in args.concurrency:
+            client = BloomdClient([address], max_connections=concurrency)
+            for case in benchmarks(args.keys, args.depths):
+                if args.filter and args.filter not in case.name:
+                    continue
+                case.params["threads"] = concurrency
+                result = case.run(client, args.duration, concurrency)
+                result.update(name=case.name, params=case.params, key=case.key)
+                results.append(result)
+                print("%-44s %14.0f %10.3f %10.3f %10.3f" % (case.key, result["ops_per_sec"],
+                                                             result["p50_ms"], result["p90_ms"],
+                                                             result["p99_ms"]))
+                sys.stdout.flush()
+            for pool in client.sever_pools.values():
+                pool.disconnect()
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "server": args.server or "stand-in",
+                "results": results,
+            }, fh, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(results, json.load(fh), args.threshold)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,75 @@
 """
 This module implements a client for the BloomD server.
 """
-__all__ = ["BloomdError", "BloomdConnection", "BloomdClient", "BloomdFilter"]
+__all__ = ["BloomdError", "BloomdFanOutError", "BloomdPoolTimeout", "BloomdServerDown", "BloomdConnection", "BloomdClient", "BloomdFilter",
+           "ShardedBloomdFilter", "ConsistentHashRing", "PositiveCache",
+           "BufferedBloomdFilter", "BloomdFuture", "KeyHasher", "LocalBackend", "LocalBloomFilter",
+           "BloomdMetrics", "LatencyHistogram", "MultiplexedPool",
+           "CircuitBreaker", "ReplicatedBloomdFilter", "FilterStatsCache"]
 __version__ = "0.4.1"
 import os
+import random
 import logging
 import socket
 import errno
+import select
+import threading
 import time
 import hashlib
+import binascii
+import base64
+import functools
+import bisect
+import re
+import collections
+import itertools
+import math
+import struct
+from contextlib import closing
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# The type of unicode strings
+_text_type = type(u"")
+
+# Use the most precise clock available for latencies
+_clock = getattr(time, "perf_counter", time.time)
+
+# Delays between retries double from the base, up to the max, with jitter
+RETRY_BACKOFF = 0.01
+RETRY_BACKOFF_MAX = 1.0
+
+# Default number of in flight commands for streaming pipelines
+DEFAULT_WINDOW = 512
+
+# Default number of in flight command bytes for streaming pipelines
+DEFAULT_WINDOW_BYTES = 64 * 1024
+
+# Limits on the keys sent in each bulk or multi command
+BATCH_MAX_KEYS = 10000
+BATCH_MAX_BYTES = 512 * 1024
+
+# Most threads running concurrent requests, beyond which the caller runs them
+MAX_WORKERS = 64
+
+# Servers starting with this are served in-process by a LocalBackend
+LOCAL_PREFIX = "local://"
+
+# Supported types of bulk and multi results
+RESULT_TYPES = ("list", "bytearray", "numpy")
+
+# Maps the first letter of Yes/No to a 1/0 byte
+_FLAG_TABLE = bytearray(range(256))
+_FLAG_TABLE[ord("Y")] = 1
+_FLAG_TABLE[ord("N")] = 0
+_FLAG_TABLE = bytes(_FLAG_TABLE)
 
 
 class BloomdError(Exception):
@@ -16,9 +77,555 @@ class BloomdError(Exception):
     pass
 
 
+class BloomdFanOutError(BloomdError):
+    """
+    Raised when a call to multiple servers failed on some of them.
+    The partial `results` are kept, and `errors` maps each server
+    which failed to its error.
+    """
+    def __init__(self, results, errors):
+        failures = ", ".join("%s (%s)" % (srv, err) for srv, err in sorted(errors.items()))
+        BloomdError.__init__(self, "Failed on %d server(s): %s" % (len(errors), failures))
+        self.results = results
+        self.errors = errors
+
+
+class BloomdPoolTimeout(BloomdError):
+    "Raised when no pooled connection became available in time"
+    pass
+
+
+class BloomdServerDown(BloomdError, EnvironmentError):
+    "Raised without contacting a server while its circuit breaker is open"
+    pass
+
+
+def _native_str(data):
+    "Converts UTF-8 bytes to the native str type"
+    if str is bytes:
+        return data
+    return data.decode("utf-8")
+
+
+def _encode(value):
+    "Encodes a command argument as bytes, with text as UTF-8"
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, _text_type):
+        return value.encode("utf-8")
+    return _encode(str(value))
+
+
+# Searching bytes for an int is much faster than for a bytes on Python 3
+_SPACE, _NEWLINE = (b" ", b"\n") if str is bytes else (32, 10)
+
+
+def _encode_key(key):
+    "Encodes a key as bytes, checking that it is valid"
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8") if isinstance(key, _text_type) else _encode(key)
+    if not key or _SPACE in key or _NEWLINE in key:
+        if not key:
+            raise ValueError("Keys must not be empty!")
+        raise ValueError("Keys must not contain spaces or newlines!")
+    return key
+
+
+def _join_keys(keys):
+    """
+    Joins a list of keys into the arguments of a command, as bytes. Lists
+    of only bytes or only text are joined and encoded at once, and the
+    keys are checked over the joined bytes. Keys are only looked at one
+    at a time in mixed lists, or if the joined bytes show a bad key.
+    """
+    try:
+        data = b" ".join(keys)
+    except (TypeError, ValueError):
+        data = None
+    if not isinstance(data, bytes):
+        try:
+            data = u" ".join(keys).encode("utf-8")
+        except (TypeError, ValueError):
+            data = b" ".join([_encode(key) for key in keys])
+    if (data.count(b" ") != len(keys) - 1 or _NEWLINE in data or b"  " in data
+            or data[:1] in (b"", b" ") or data[-1:] == b" "):
+        for key in keys:
+            _encode_key(key)
+    return data
+
+
+# Verbs which take keys, and which only take the filter name
+_KEY_VERBS = ("s", "c", "b", "m")
+_FILTER_VERBS = ("drop", "close", "clear", "info", "flush")
+
+
+def _filter_commands(name):
+    """
+    Returns the commands of a filter as bytes, keyed by verb. Commands
+    for the verbs taking keys end with a space, and the keys are
+    appended to them.
+    """
+    name = _encode(name)
+    commands = dict((verb, _encode(verb) + b" " + name + b" ") for verb in _KEY_VERBS)
+    commands.update((verb, _encode(verb) + b" " + name) for verb in _FILTER_VERBS)
+    return commands
+
+
+_BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+
+def _b62encode(data):
+    "Encodes bytes as a base62 string"
+    num = int(binascii.hexlify(data) or b"0", 16)
+    chars = []
+    while num:
+        num, rem = divmod(num, 62)
+        chars.append(_BASE62[rem])
+    return ("".join(reversed(chars)) or "0").encode("ascii")
+
+
+# Wire encodings for hashed keys
+KEY_ENCODINGS = {
+    "hex": binascii.hexlify,
+    "base64": lambda data: base64.urlsafe_b64encode(data).rstrip(b"="),
+    "base62": _b62encode,
+}
+
+
+class KeyHasher(object):
+    """
+    Hashes keys client side before they are sent to the server. This
+    supports non-ascii keys, and bounds the size of large keys. The hash
+    algorithm, digest size and wire encoding are configurable.
+    """
+    def __init__(self, algorithm="sha1", digest_size=None, encoding="hex"):
+        """
+        Creates a new KeyHasher.
+
+        :Parameters:
+            - algorithm (optional) : A hashlib algorithm name, such as "sha1"
+              or "blake2b", or a callable taking bytes and returning a hash
+              object or digest, such as `xxhash.xxh64`. Defaults to "sha1".
+            - digest_size (optional) : Truncate digests to this many bytes.
+              blake2 hashes are computed at this size directly.
+            - encoding (optional) : The wire encoding of digests, one of "hex",
+              "base64" (url-safe, unpadded), or "base62". Defaults to "hex".
+        """
+        if encoding not in KEY_ENCODINGS:
+            raise ValueError("Unknown key encoding: %s" % encoding)
+        self.algorithm = algorithm
+        self.digest_size = digest_size
+        self.encoding = encoding
+
+        fast = encoding == "hex" and not digest_size
+        if callable(algorithm):
+            new = algorithm
+            fast = fast and hasattr(new(b""), "hexdigest")
+        elif algorithm in ("blake2b", "blake2s") and digest_size and hasattr(hashlib, algorithm):
+            new = functools.partial(getattr(hashlib, algorithm), digest_size=digest_size)
+        else:
+            new = getattr(hashlib, algorithm, None) or functools.partial(hashlib.new, algorithm)
+        new(b"")
+
+        if fast:
+            self._hash_one, self._hash_many = self._build_hexdigest(new)
+        else:
+            self._hash_one, self._hash_many = self._build_generic(new, digest_size, KEY_ENCODINGS[encoding])
+
+    @staticmethod
+    def _build_hexdigest(new):
+        "Builds the hash functions for full length hex digests"
+        def hash_one(key):
+            if isinstance(key, _text_type):
+                key = key.encode("utf-8")
+            return new(key).hexdigest()
+
+        def hash_many(keys):
+            return [new(k.encode("utf-8") if isinstance(k, _text_type) else k).hexdigest()
+                    for k in keys]
+        return hash_one, hash_many
+
+    @staticmethod
+    def _build_generic(new, digest_size, encode):
+        "Builds the hash functions for any digest size and encoding"
+        has_digest = hasattr(new(b""), "digest")
+
+        def hash_one(key):
+            if isinstance(key, _text_type):
+                key = key.encode("utf-8")
+            digest = new(key)
+            if has_digest:
+                digest = digest.digest()
+            if digest_size:
+                digest = digest[:digest_size]
+            return _native_str(encode(digest))
+
+        def hash_many(keys):
+            return [hash_one(k) for k in keys]
+        return hash_one, hash_many
+
+    @classmethod
+    def from_setting(cls, hash_keys):
+        """
+        Returns the KeyHasher for a `hash_keys` setting. This is None when
+        keys are not hashed, and a SHA1 hex hasher for True. A KeyHasher
+        is used as is, and any other value is taken as an algorithm name.
+        """
+        if not hash_keys:
+            return None
+        if hash_keys is True:
+            return cls()
+        if isinstance(hash_keys, KeyHasher):
+            return hash_keys
+        return cls(hash_keys)
+
+    def __call__(self, key):
+        "Returns the hashed key"
+        return self._hash_one(key)
+
+    def hash_many(self, keys):
+        """
+        Returns a list of the hashed keys, for a list of keys. Each key
+        is still hashed and encoded on its own, as hashlib has no batch
+        interface and encoding the joined digests at once measured no
+        faster, so this only saves a method call per key.
+        """
+        return self._hash_many(keys)
+
+    def hash_iter(self, keys, batch_size=1024):
+        "Hashes any iterable of keys lazily, `batch_size` keys at a time"
+        keys = iter(keys)
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch:
+                return
+            for key in self._hash_many(batch):
+                yield key
+
+
+class LatencyHistogram(object):
+    """
+    Counts latencies into fixed buckets, doubling from 50 microseconds
+    to about 52 seconds, so recording is cheap and histograms from
+    different sources can be added together.
+    """
+    BOUNDS = tuple(0.00005 * 2 ** i for i in range(21))
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency):
+        "Records a single latency, in seconds"
+        self.buckets[bisect.bisect_left(self.BOUNDS, latency)] += 1
+        self.count += 1
+        self.total += latency
+        if latency > self.max:
+            self.max = latency
+
+    def percentile(self, pct):
+        "Returns the upper bound of the bucket holding the `pct` percentile"
+        if not self.count:
+            return 0.0
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        "Returns a dictionary of the histogram, with times in seconds"
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "buckets": list(zip(self.BOUNDS + (float("inf"),), self.buckets)),
+        }
+
+
+class BloomdMetrics(object):
+    """
+    Collects client metrics: a latency histogram per server and command,
+    bytes sent and received, connects, reconnects, retries and errors per
+    server, and filter location refreshes. Hooks can be registered to feed
+    other systems. Each hook is a list of callables, called with:
+
+        - on_send(server, command, nbytes)
+        - on_response(server, command, latency, nbytes)
+        - on_error(server, command, error)
+
+    Commands are named by their protocol verb, such as "c" or "info", and
+    `command` is None for errors outside of a command. `nbytes` is the
+    size of that one command or response. Hooks are called on the thread
+    making the request, or for multiplexed connections on the writer and
+    reader threads of the connection, so they must be thread safe, fast
+    and not raise.
+
+    Clients without a BloomdMetrics do none of this work.
+    """
+    def __init__(self, on_send=(), on_response=(), on_error=()):
+        self.on_send = list(on_send)
+        self.on_response = list(on_response)
+        self.on_error = list(on_error)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        "Clears all the collected metrics, keeping the hooks"
+        with self._lock:
+            self.latency = collections.defaultdict(LatencyHistogram)
+            self.servers = collections.defaultdict(lambda: dict.fromkeys(
+                ("bytes_sent", "bytes_received", "connects", "reconnects", "retries", "errors"), 0))
+            self.refreshes = 0
+            self.refresh_failures = 0
+            self.refresh_time = 0.0
+            self.resolves = 0
+
+    def sent(self, server, commands, sizes):
+        "Records commands written to a server, with the bytes of each"
+        with self._lock:
+            self.servers[server]["bytes_sent"] += sum(sizes)
+        for hook in self.on_send:
+            for command, nbytes in zip(commands, sizes):
+                hook(server, command, nbytes)
+
+    def received(self, server, command, latency, nbytes):
+        "Records a response read from a server"
+        with self._lock:
+            self.latency[server, command].record(latency)
+            self.servers[server]["bytes_received"] += nbytes
+        for hook in self.on_response:
+            hook(server, command, latency, nbytes)
+
+    def received_bytes(self, server, nbytes):
+        "Records bytes read from a server outside of a response's first line"
+        with self._lock:
+            self.servers[server]["bytes_received"] += nbytes
+
+    def error(self, server, command, error):
+        "Records a failed send or read"
+        with self._lock:
+            self.servers[server]["errors"] += 1
+        for hook in self.on_error:
+            hook(server, command, error)
+
+    def connected(self, server, reconnect):
+        "Records a new socket to a server"
+        with self._lock:
+            self.servers[server]["reconnects" if reconnect else "connects"] += 1
+
+    def retried(self, server):
+        "Records a command being retried"
+        with self._lock:
+            self.servers[server]["retries"] += 1
+
+    def refreshed(self, duration, ok):
+        "Records a reload of the filter locations"
+        with self._lock:
+            self.refreshes += 1
+            self.refresh_time += duration
+            if not ok:
+                self.refresh_failures += 1
+
+    def resolved(self):
+        "Records a filter location lookup missing the cache"
+        with self._lock:
+            self.resolves += 1
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the metrics. Latencies are under
+        "latency" as {server : {command : histogram}}, and the counters
+        under "servers" as {server : {counter : value}}.
+        """
+        with self._lock:
+            latency = {}
+            for (server, command), hist in self.latency.items():
+                latency.setdefault(server, {})[command] = hist.snapshot()
+            return {
+                "latency": latency,
+                "servers": dict((server, dict(counters)) for server, counters in self.servers.items()),
+                "locations": {
+                    "refreshes": self.refreshes,
+                    "refresh_failures": self.refresh_failures,
+                    "refresh_time": self.refresh_time,
+                    "resolves": self.resolves,
+                },
+            }
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of a server. After `failure_threshold` failures in
+    a row the circuit opens, and connecting to the server fails fast with
+    BloomdServerDown. Once the reset timeout passes, one caller is let
+    through to probe the server. If it succeeds the circuit closes, and if
+    it fails the circuit opens again for twice as long, up to
+    `max_reset_timeout`. Reset timeouts are randomly shortened by up to
+    half, so many clients do not probe a recovering server at once.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, server, failure_threshold=5, reset_timeout=1.0, max_reset_timeout=60.0):
+        """
+        Creates a new closed CircuitBreaker.
+
+        :Parameters:
+            - server : The server name, used in errors.
+            - failure_threshold (optional) : Failures in a row which open the circuit.
+            - reset_timeout (optional) : Seconds before the first probe.
+            - max_reset_timeout (optional) : The most seconds between probes.
+        """
+        self.server = server
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opens = 0
+        self.retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Checks that a connection may be made, raising BloomdServerDown
+        if the circuit is open. Once the reset timeout has passed, the
+        caller is allowed through as the probe.
+        """
+        if self.state == self.CLOSED:
+            return
+        with self._lock:
+            now = time.time()
+            if self.state == self.CLOSED:
+                return
+            if now >= self.retry_at:
+                # Let a single probe through, and give it a timeout to finish
+                self.state = self.HALF_OPEN
+                self.retry_at = now + self._timeout()
+                return
+            raise BloomdServerDown("Server %s is down, retrying in %.2f seconds" %
+                                   (self.server, self.retry_at - now))
+
+    def success(self):
+        "Records a successful response, closing the circuit"
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opens = 0
+
+    def failure(self):
+        "Records a failure, opening the circuit if there were too many"
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self.failures >= self.failure_threshold):
+                self.opens += 1
+                self.state = self.OPEN
+                self.retry_at = time.time() + self._timeout() * random.uniform(0.5, 1.0)
+
+    def _timeout(self):
+        "Returns the current reset timeout, doubled for each open in a row"
+        return min(self.max_reset_timeout, self.reset_timeout * 2 ** max(0, self.opens - 1))
+
+    def stats(self):
+        "Returns a dictionary of the circuit state"
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "opens": self.opens,
+                "retry_in": max(0.0, self.retry_at - time.time()) if self.state != self.CLOSED else 0.0,
+            }
+
+
+class LineReader(object):
+    """
+    Reads lines from a socket with `recv_into` a reusable buffer. Lines
+    are found in the buffer in place, and the common responses such as
+    Yes, No and Done are returned as constants without allocating a
+    string. Multi-key responses can be parsed into flags straight from
+    the buffer. The buffer grows to fit the longest line.
+    """
+    # The common responses by length, as (bytes, native str) pairs
+    CONSTANTS = {}
+    for _line in ("Yes", "No", "Done", "Exists", "START", "END"):
+        CONSTANTS.setdefault(len(_line), []).append((_line.encode("ascii"), _line))
+    del _line
+
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.last_size = 0
+
+    def _fill(self):
+        "Reads more data from the socket, making room in the buffer first"
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            size = self.end - self.start
+            if self.start:
+                self.view[:size] = self.view[self.start:self.end]
+            else:
+                # A line fills the whole buffer, so double it
+                buf = bytearray(len(self.buf) * 2)
+                buf[:size] = self.view
+                self.buf, self.view = buf, memoryview(buf)
+            self.start, self.end = 0, size
+        read = self.sock.recv_into(self.view[self.end:])
+        if not read:
+            raise EnvironmentError("Connection closed by bloomd server!")
+        self.end += read
+
+    def _next_line(self):
+        "Returns the (start, end) of the next line in the buffer, consuming it"
+        while True:
+            idx = self.buf.find(b"\n", self.start, self.end)
+            if idx >= 0:
+                break
+            self._fill()
+        start, end = self.start, idx
+        if end > start and self.buf[end - 1] == 13:
+            end -= 1
+        self.start = idx + 1
+        self.last_size = idx + 1 - start
+        return start, end
+
+    def readline(self):
+        "Returns the next line, without the line ending"
+        start, end = self._next_line()
+        for raw, line in self.CONSTANTS.get(end - start, ()):
+            if self.buf.startswith(raw, start, end):
+                return line
+        return _native_str(self.view[start:end].tobytes())
+
+    def read_flags(self):
+        """
+        Reads a bulk or multi response. Returns (True, a string with a 0
+        or 1 byte per key), or (False, line) if it was not Yes/No values.
+        """
+        start, end = self._next_line()
+        if not (self.buf.startswith(b"Yes", start, end) or self.buf.startswith(b"No", start, end)):
+            return False, _native_str(self.view[start:end].tobytes())
+        return True, self.view[start:end].tobytes().translate(_FLAG_TABLE, b"eso ")
+
+
 class BloomdConnection(object):
     "Provides a convenient interface to server connections"
-    def __init__(self, server, timeout, attempts=3, pool=None):
+    def __init__(self, server, timeout, attempts=3, pool=None, metrics=None, breaker=None):
         """
         Creates a new Bloomd Connection.
 
@@ -27,47 +634,101 @@ class BloomdConnection(object):
                       Uses the default port of 8673 if none is provided for tcp, and 8674 for udp.
             - timeout: The socket timeout to use.
             - attempts (optional): Maximum retry attempts on errors. Defaults to 3.
+            - metrics (optional): A BloomdMetrics to record commands into.
+            - breaker (optional): A CircuitBreaker tracking the health of the server.
         """
         self.pid = os.getpid()
 
-        # Parse the host/port
-        parts = server.split(":", 1)
-        if len(parts) == 2:
-            host, port = parts[0], int(parts[1])
-        else:
-            host, port = parts[0], 8673
-
-        self.server = (host, port)
+        self.server = _parse_server(server)
         self.timeout = timeout
         self.sock = None
-        self.fh = None
+        self.reader = None
         self.attempts = attempts
         self.pool = pool
+        self.last_used = time.time()
         self.logger = logging.getLogger("pybloomd.BloomdConnection.%s.%d" % self.server)
 
+        # Track the commands awaiting responses for the metrics
+        self.metrics = metrics
+        self.server_name = server
+        self.connects = 0
+        self.in_flight = collections.deque()
+        self.breaker = breaker
+
     def _create_socket(self):
         "Creates a new socket, tries to connect to the server"
+        if self.breaker is not None:
+            self.breaker.allow()
+
         # Connect the socket
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.settimeout(self.timeout)
-        s.connect(self.server)
+        try:
+            s.connect(self.server)
+        except socket.error as e:
+            if self.metrics is not None:
+                self.metrics.error(self.server_name, None, e)
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise
         s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-        self.fh = None
+        self.reader = None
+        if self.metrics is not None:
+            self.in_flight.clear()
+            self.metrics.connected(self.server_name, self.connects > 0)
+        self.connects += 1
         return s
 
+    def connect(self):
+        "Connects to the server, if not already connected"
+        if self.sock is None:
+            self.sock = self._create_socket()
+
     def send(self, cmd):
-        "Sends a command with out the newline to the server"
+        "Sends a command as bytes with out the newline to the server"
+        if self.metrics is None:
+            self._sendall(cmd + b"\n")
+        else:
+            start = _clock()
+            self._sendall(cmd + b"\n")
+            self._record_sent([cmd], start)
+
+    def send_many(self, cmds):
+        """
+        Sends multiple commands as bytes with out the newlines to the
+        server. The commands are joined into a single buffer, and
+        flushed with a single write.
+        """
+        if not cmds:
+            return
+        data = b"\n".join(itertools.chain(cmds, (b"",)))
+        if self.metrics is None:
+            self._sendall(data)
+        else:
+            start = _clock()
+            self._sendall(data)
+            self._record_sent(cmds, start)
+
+    def _sendall(self, data):
+        "Writes raw data to the server, reconnecting on errors"
         if self.sock is None:
             self.sock = self._create_socket()
         sent = False
-        for attempt in xrange(self.attempts):
+        for attempt in range(self.attempts):
             try:
-                self.sock.sendall(cmd + "\n")
+                self.sock.sendall(data)
                 sent = True
                 break
-            except socket.error, e:
+            except socket.error as e:
                 self.logger.exception("Failed to send command to bloomd server! Attempt: %d" % attempt)
-                if e[0] in (errno.ECONNRESET, errno.ECONNREFUSED, errno.EAGAIN, errno.EHOSTUNREACH, errno.EPIPE):
+                if self.metrics is not None:
+                    self._record_error(e)
+                if self.breaker is not None:
+                    self.breaker.failure()
+                if e.errno in (errno.ECONNRESET, errno.ECONNREFUSED, errno.EAGAIN, errno.EHOSTUNREACH, errno.EPIPE):
+                    if self.metrics is not None:
+                        self.metrics.retried(self.server_name)
+                    self._backoff(attempt)
                     self.sock = self._create_socket()
                 else:
                     raise
@@ -78,12 +739,79 @@ class BloomdConnection(object):
 
     def read(self):
         "Returns a single line from the file"
-        if self.sock is None:
-            self.sock = self._create_socket()
-        if not self.fh:
-            self.fh = self.sock.makefile()
-        read = self.fh.readline().rstrip("\r\n")
-        return read
+        line = self._readline()
+        self._read_succeeded(len(line) + 1)
+        return line
+
+    def read_flags(self):
+        """
+        Reads a bulk or multi response. Returns (True, a string with a 0
+        or 1 byte per key), or (False, line) if it was not Yes/No values.
+        """
+        reader = self._line_reader()
+        if reader is None:
+            line = self.read()
+            if line.startswith("Yes") or line.startswith("No"):
+                return True, _parse_flags(line)
+            return False, line
+        try:
+            result = reader.read_flags()
+        except EnvironmentError as e:
+            self._read_failed(e)
+            raise
+        self._read_succeeded(reader.last_size)
+        return result
+
+    def _line_reader(self):
+        "Returns the LineReader of the socket, connecting if needed"
+        self.connect()
+        if self.reader is None:
+            self.reader = LineReader(self.sock)
+        return self.reader
+
+    def _readline(self):
+        "Reads a line from the server, without recording a response"
+        reader = self._line_reader()
+        try:
+            return reader.readline()
+        except EnvironmentError as e:
+            self._read_failed(e)
+            raise
+
+    def _read_succeeded(self, nbytes):
+        "Records a response of `nbytes` bytes"
+        if self.metrics is not None:
+            self._record_received(nbytes)
+        if self.breaker is not None:
+            self.breaker.success()
+
+    def _read_failed(self, error):
+        "Records a failed read"
+        if self.metrics is not None:
+            self._record_error(error)
+        if self.breaker is not None:
+            self.breaker.failure()
+
+    def _backoff(self, attempt):
+        "Sleeps before a retry, for a random time that doubles with each attempt"
+        time.sleep(random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt)))
+
+    def _record_sent(self, cmds, start):
+        "Records commands sent at `start`, which are awaiting responses"
+        verbs = [_native_str(cmd.partition(b" ")[0]) for cmd in cmds]
+        self.in_flight.extend((verb, start) for verb in verbs)
+        self.metrics.sent(self.server_name, verbs, [len(cmd) + 1 for cmd in cmds])
+
+    def _record_received(self, nbytes):
+        "Records the response to the oldest command in flight"
+        if self.in_flight:
+            verb, start = self.in_flight.popleft()
+            self.metrics.received(self.server_name, verb, _clock() - start, nbytes)
+
+    def _record_error(self, error):
+        "Records an error, against the oldest command in flight"
+        verb = self.in_flight[0][0] if self.in_flight else None
+        self.metrics.error(self.server_name, verb, error)
 
     def readblock(self, start="START", end="END"):
         """
@@ -92,16 +820,26 @@ class BloomdConnection(object):
         optionally provided. Returns an array of the lines within
         the block.
         """
-        lines = []
+        return list(self.iterblock(start, end))
+
+    def iterblock(self, start="START", end="END"):
+        """
+        Reads a response block from the server like `readblock`, but
+        yields each line as it is read, so large blocks can be parsed
+        incrementally. The generator must be consumed fully.
+        """
         first = self.read()
         if first != start:
             raise BloomdError("Did not get block start (%s)! Got '%s'!" % (start, first))
+        size = len(end) + 1
         while True:
-            line = self.read()
+            line = self._readline()
             if line == end:
                 break
-            lines.append(line)
-        return lines
+            size += len(line) + 1
+            yield line
+        if self.metrics is not None:
+            self.metrics.received_bytes(self.server_name, size)
 
     def send_and_receive(self, cmd):
         """
@@ -109,13 +847,20 @@ class BloomdConnection(object):
         and reads the response, performing a retry if necessary.
         """
         done = False
-        for attempt in xrange(self.attempts):
+        for attempt in range(self.attempts):
             try:
                 self.send(cmd)
                 return self.read()
-            except socket.error, e:
+            except BloomdServerDown:
+                # The circuit is open, so fail fast without logging each call
+                raise
+            except socket.error as e:
+                # The error was already recorded by the failed send or read
                 self.logger.exception("Failed to send command to bloomd server! Attempt: %d" % attempt)
-                if e[0] in (errno.ECONNRESET, errno.ECONNREFUSED, errno.EAGAIN, errno.EHOSTUNREACH, errno.EPIPE):
+                if e.errno in (errno.ECONNRESET, errno.ECONNREFUSED, errno.EAGAIN, errno.EHOSTUNREACH, errno.EPIPE):
+                    if self.metrics is not None:
+                        self.metrics.retried(self.server_name)
+                    self._backoff(attempt)
                     self.sock = self._create_socket()
                 else:
                     raise
@@ -130,8 +875,20 @@ class BloomdConnection(object):
         output into a dictionary by splitting on spaces, and using the
         first column as the key, and the remainder as the value.
         """
-        resp_lines = self.readblock()
-        return dict(tuple(l.split(" ", 1)) for l in resp_lines)
+        return dict(tuple(l.split(" ", 1)) for l in self.iterblock())
+
+    def is_stale(self):
+        """
+        Checks if an idle connection can no longer be used, because
+        the server closed it or there is unread data on the socket.
+        """
+        if self.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
 
     def disconnect(self):
         "Disconnects from the Bloomd server"
@@ -142,6 +899,8 @@ class BloomdConnection(object):
         except socket.error:
             pass
         self.sock = None
+        self.reader = None
+        self.in_flight.clear()
 
     def release(self):
         if self.pool is None:
@@ -152,166 +911,1345 @@ class BloomdConnection(object):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        # After a socket error, the state of the stream is unknown
+        if exc_type is not None and issubclass(exc_type, EnvironmentError):
+            self.disconnect()
         self.release()
 
 
 class ConnectionPool(object):
-    "Generic connection pool"
+    """
+    Thread-safe connection pool. Once `max_connections` are in use,
+    callers block until a connection is released.
+    """
     def __init__(self, connection_class=BloomdConnection, max_connections=None,
-                 **connection_kwargs):
-        self.pid = os.getpid()
+                 pool_timeout=None, max_idle_time=None, **connection_kwargs):
+        """
+        Creates a new ConnectionPool. Extra keyword arguments are
+        passed to the connection class.
+
+        :Parameters:
+            - max_connections (optional) : The maximum number of connections.
+              Defaults to unlimited.
+            - pool_timeout (optional) : How long to wait for a connection when
+              all are in use before raising BloomdPoolTimeout. Defaults to
+              waiting forever.
+            - max_idle_time (optional) : Connections idle for longer than this
+              many seconds are closed. Defaults to never.
+        """
         self.connection_class = connection_class
         self.connection_kwargs = connection_kwargs
         self.max_connections = max_connections or 2 ** 31
+        self.pool_timeout = pool_timeout
+        self.max_idle_time = max_idle_time
+        self._reset()
+
+    def _reset(self):
+        "Resets the pool state, forgetting all connections"
+        self.pid = os.getpid()
+        self._lock = threading.Condition()
         self._created_connections = 0
         self._available_connections = []
         self._in_use_connections = set()
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
 
     def _checkpid(self):
         if self.pid != os.getpid():
             self.disconnect()
-            self.__init__(self.connection_class, self.max_connections,
-                          **self.connection_kwargs)
+            self._reset()
+
+    def _evict_idle(self):
+        "Closes connections idle for too long. Must hold the lock."
+        if self.max_idle_time is None:
+            return
+        cutoff = time.time() - self.max_idle_time
+        while self._available_connections and self._available_connections[0].last_used < cutoff:
+            connection = self._available_connections.pop(0)
+            connection.disconnect()
+            self._created_connections -= 1
 
     def get_connection(self):
-        "Get a connection from the pool"
+        """
+        Get a connection from the pool. Blocks for up to `pool_timeout`
+        if all connections are in use. Connections closed by the
+        server while idle are reset before being returned.
+        """
         self._checkpid()
-        try:
-            connection = self._available_connections.pop()
-        except IndexError:
-            connection = self.make_connection()
-        self._in_use_connections.add(connection)
+        start = None
+        connection = None
+        with self._lock:
+            while True:
+                self._evict_idle()
+                if self._available_connections:
+                    connection = self._available_connections.pop()
+                    break
+                if self._created_connections < self.max_connections:
+                    self._created_connections += 1
+                    break
+
+                # Wait for a connection to be released
+                now = time.time()
+                if start is None:
+                    start = now
+                if self.pool_timeout is None:
+                    self._lock.wait()
+                else:
+                    remaining = start + self.pool_timeout - now
+                    if remaining <= 0:
+                        self._record_wait(start)
+                        raise BloomdPoolTimeout("Timed out waiting for a connection")
+                    self._lock.wait(remaining)
+
+            if start is not None:
+                self._record_wait(start)
+
+        if connection is None:
+            try:
+                connection = self.make_connection()
+            except:
+                with self._lock:
+                    self._created_connections -= 1
+                    self._lock.notify()
+                raise
+        elif connection.is_stale():
+            connection.disconnect()
+
+        with self._lock:
+            self._in_use_connections.add(connection)
         return connection
 
+    def _record_wait(self, start):
+        "Updates the wait statistics. Must hold the lock."
+        waited = time.time() - start
+        self.waits += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
     def make_connection(self):
         "Create a new connection"
-        if self._created_connections >= self.max_connections:
-            raise ConnectionError("Too many connections")
-        self._created_connections += 1
         return self.connection_class(pool=self, **self.connection_kwargs)
 
+    def warm_up(self, count=1):
+        """
+        Opens up to `count` connections ahead of use, so the first
+        commands do not pay for connecting. Returns the number of
+        connections opened or already open.
+        """
+        connections = []
+        try:
+            while len(connections) < min(count, self.max_connections):
+                connections.append(self.get_connection())
+            for connection in connections:
+                connection.connect()
+        finally:
+            for connection in connections:
+                self.release(connection)
+        return len(connections)
+
     def release(self, connection):
         "Releases the connection back to the pool"
         self._checkpid()
-        if connection.pid == self.pid:
+        if connection.pid != self.pid:
+            return
+        with self._lock:
+            if connection not in self._in_use_connections:
+                return
             self._in_use_connections.remove(connection)
+            connection.last_used = time.time()
             self._available_connections.append(connection)
+            self._lock.notify()
+
+    def stats(self):
+        """
+        Returns a dictionary of pool statistics: the number of connections
+        created, in use and available, and how many checkouts had to wait
+        for a connection along with the total and maximum wait in seconds.
+        """
+        with self._lock:
+            return {
+                "created": self._created_connections,
+                "in_use": len(self._in_use_connections),
+                "available": len(self._available_connections),
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+            }
 
     def disconnect(self):
         "Disconnects all connections in the pool"
-        all_conns = chain(self._available_connections,
-                          self._in_use_connections)
+        with self._lock:
+            all_conns = list(itertools.chain(self._available_connections,
+                                             self._in_use_connections))
         for connection in all_conns:
             connection.disconnect()
 
 
-class BloomdClient(object):
-    "Provides a client abstraction around the BloomD interface."
-    def __init__(self, servers, timeout=None, hash_keys=False):
+class LocalBloomFilter(object):
+    """
+    A scalable bloom filter held in the process, with the same semantics
+    as a bloomd filter. Keys are stored in layers of bit arrays. Once a
+    layer holds its capacity, a new layer is added with `scale_size` times
+    the capacity and a tighter false positive rate, so the overall rate
+    stays under `prob` however many keys are added.
+    """
+    def __init__(self, name, capacity=100000, prob=0.0001, in_memory=False,
+                 scale_size=4, prob_reduction=0.9):
         """
-        Creates a new BloomD client.
+        Creates a new empty filter.
 
         :Parameters:
-            - servers : A list of servers, which are provided as strings in the "host" or "host:port".
-            - timeout: (Optional) A socket timeout to use, defaults to no timeout.
-            - hash_keys: (Optional) Should keys be hashed before sending to bloomd. Defaults to False.
+            - name : The name of the filter.
+            - capacity (optional) : The number of keys the first layer holds.
+            - prob (optional) : The false positive rate of the whole filter.
+            - in_memory (optional) : Reported in the info, local filters are
+              always in memory.
+            - scale_size (optional) : The growth factor of new layers.
+            - prob_reduction (optional) : The factor each new layer's false
+              positive rate is reduced by.
         """
-        if len(servers) == 0:
-            raise ValueError("Must provide at least 1 server!")
-        self.servers = servers
-        self.timeout = timeout
-        self.sever_pools = {}
-        self.server_info = None
-        self.info_time = 0
-        self.hash_keys = hash_keys
+        if capacity <= 0:
+            raise ValueError("Capacity must be positive!")
+        if not 0 < prob < 1:
+            raise ValueError("Probability must be between 0 and 1!")
+        self.name = name
+        self.capacity = capacity
+        self.prob = prob
+        self.in_memory = in_memory
+        self.scale_size = scale_size
+        self.prob_reduction = prob_reduction
+        self.checks = self.check_hits = 0
+        self.sets = self.set_hits = 0
+        self.clear()
 
-    def _server_pool(self, server):
-        "Returns a connection to a server, tries to cache connections."
-        if server in self.sever_pools:
-            return self.sever_pools[server]
-        else:
-            pool = ConnectionPool(server=server, timeout=self.timeout)
-            self.sever_pools[server] = pool
-            return pool
+    def clear(self):
+        "Removes all keys from the filter"
+        self.layers = []
+        self.size = 0
+        self._add_layer()
 
-    def _get_pool(self, filter, strict=True, explicit_server=None):
-        """
-        Gets a connection to a server which is able to service a filter.
-        Because filters may exist on any server, all servers are queried
-        for their filters and the results are cached. This allows us to
-        partition data across multiple servers.
+    def _add_layer(self):
+        "Adds a new layer, sized from the number of layers so far"
+        num = len(self.layers)
+        capacity = self.capacity * self.scale_size ** num
+        # The layer rates form a geometric series summing to under prob
+        prob = self.prob * (1 - self.prob_reduction) * self.prob_reduction ** num
+        bits = int(math.ceil(-capacity * math.log(prob) / math.log(2) ** 2))
+        hashes = int(math.ceil(-math.log(prob, 2)))
+        self.layers.append([capacity, 0, bits, hashes, bytearray((bits + 7) // 8)])
 
-        :Parameters:
-            - filter : The filter to connect to
-            - strict (optional) : If True, an error is raised when a filter
-                does not exist.
-            - explicit_server (optional) : If provided, when a filter does
-                not exist and strict is False, a connection to this server is made.
-                Otherwise, the server with the fewest sets is returned.
-        """
-        # Force checking if we have no info or 5 minutes has elapsed
-        if not self.server_info or time.time() - self.info_time > 300:
-            self.server_info = self.list_filters(inc_server=True)
-            self.info_time = time.time()
+    def _hash(self, key):
+        "Returns the two base hashes of a key"
+        if isinstance(key, _text_type):
+            key = key.encode("utf-8")
+        return struct.unpack("<II", hashlib.md5(key).digest()[:8])
 
-        # Check if this filter is in a known location
-        if filter in self.server_info:
-            serv = self.server_info[filter][0]
-            return self._server_pool(serv)
+    def _contains(self, h1, h2):
+        "Checks if any layer contains the key with the base hashes"
+        for capacity, count, bits, hashes, data in self.layers:
+            for offset in range(h1, h1 + hashes * h2, h2) if h2 else [h1] * hashes:
+                offset %= bits
+                if not data[offset >> 3] & (1 << (offset & 7)):
+                    break
+            else:
+                return True
+        return False
 
-        # Possibly old data? Reload
-        self.server_info = self.list_filters(inc_server=True)
-        self.info_time = time.time()
+    def add(self, key):
+        "Adds a key to the filter. Returns True if it was not already present."
+        self.sets += 1
+        h1, h2 = self._hash(key)
+        if self._contains(h1, h2):
+            return False
+        layer = self.layers[-1]
+        if layer[1] >= layer[0]:
+            self._add_layer()
+            layer = self.layers[-1]
+        capacity, count, bits, hashes, data = layer
+        for offset in range(h1, h1 + hashes * h2, h2) if h2 else [h1] * hashes:
+            offset %= bits
+            data[offset >> 3] |= 1 << (offset & 7)
+        layer[1] += 1
+        self.size += 1
+        self.set_hits += 1
+        return True
 
-        # Recheck
-        if filter in self.server_info:
-            serv = self.server_info[filter][0]
-            return self._server_pool(serv)
+    def check(self, key):
+        "Checks if the key is contained in the filter."
+        self.checks += 1
+        if self._contains(*self._hash(key)):
+            self.check_hits += 1
+            return True
+        return False
 
-        # Check if this is fatal
-        if strict:
-            raise BloomdError("Filter does not exist!")
+    def total_capacity(self):
+        "Returns the number of keys the current layers hold"
+        return sum(layer[0] for layer in self.layers)
 
-        # We have an explicit server provided to us, use that
-        if explicit_server:
-            return self._server_pool(explicit_server)
+    def storage(self):
+        "Returns the number of bytes used by the bit arrays"
+        return sum(len(layer[4]) for layer in self.layers)
 
-        # Does not exist, and is not not strict
-        # we can select a server on any criteria then.
-        # We will use the server with the minimal set count.
-        counts = {}
-        for server in self.servers:
-            counts[server] = 0
-        for filter, (server, info) in self.server_info.items():
-            counts[server] += 1
+    def info(self):
+        "Returns the info dictionary about the filter, as bloomd reports it."
+        return {
+            "capacity": str(self.total_capacity()),
+            "checks": str(self.checks),
+            "check_hits": str(self.check_hits),
+            "check_misses": str(self.checks - self.check_hits),
+            "in_memory": str(int(self.in_memory)),
+            "page_ins": "0",
+            "page_outs": "0",
+            "probability": "%f" % self.prob,
+            "sets": str(self.sets),
+            "set_hits": str(self.set_hits),
+            "set_misses": str(self.sets - self.set_hits),
+            "size": str(self.size),
+            "storage": str(self.storage()),
+        }
 
-        counts = [(count, srv) for srv, count in counts.items()]
-        counts.sort()
 
-        # Select the least used
-        serv = counts[0][1]
-        return self._server_pool(serv)
+class LocalBackend(object):
+    """
+    An in-process stand-in for a bloomd server, holding LocalBloomFilters.
+    It executes protocol command lines, so the rest of the client works
+    with it unchanged. Backends are shared by server string within a
+    process, and are not shared with forked children.
+    """
+    _backends = {}
+    _backends_lock = threading.Lock()
 
-    def create_filter(self, name, capacity=None, prob=None, in_memory=False, server=None):
+    def __init__(self):
+        self.filters = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def named(cls, server):
+        "Returns the backend for a local:// server string, creating it if needed"
+        with cls._backends_lock:
+            backend = cls._backends.get(server)
+            if backend is None:
+                backend = cls._backends[server] = cls()
+            return backend
+
+    def execute(self, cmd):
+        "Executes a single command line, returning the response lines"
+        if isinstance(cmd, bytes):
+            cmd = _native_str(cmd)
+        parts = cmd.split(" ")
+        verb, args = parts[0], parts[1:]
+        with self.lock:
+            if verb in ("s", "c", "b", "m"):
+                f = self.filters.get(args[0]) if args else None
+                if f is None:
+                    return ["Filter does not exist"]
+                keys = args[1:2] if verb in ("s", "c") else args[1:]
+                if not keys:
+                    return ["Client Error: Must provide filter name and key"]
+                method = f.add if verb in ("s", "b") else f.check
+                return [" ".join(["Yes" if method(key) else "No" for key in keys])]
+            elif verb == "create":
+                return self._create(args)
+            elif verb == "list":
+                prefix = args[0] if args else ""
+                lines = ["START"]
+                for name in sorted(self.filters):
+                    if name.startswith(prefix):
+                        f = self.filters[name]
+                        lines.append("%s %f %d %d %d" % (name, f.prob, f.storage(),
+                                                         f.total_capacity(), f.size))
+                lines.append("END")
+                return lines
+            elif verb == "flush":
+                if args and args[0] not in self.filters:
+                    return ["Filter does not exist"]
+                return ["Done"]
+            elif verb in ("info", "drop", "close", "clear"):
+                f = self.filters.get(args[0]) if args else None
+                if f is None:
+                    return ["Filter does not exist"]
+                if verb == "info":
+                    return ["START"] + ["%s %s" % item for item in sorted(f.info().items())] + ["END"]
+                if verb == "drop":
+                    del self.filters[f.name]
+                elif verb == "clear":
+                    f.clear()
+                return ["Done"]
+        return ["Client Error: Command not supported"]
+
+    def _create(self, args):
+        "Executes a create command. Must hold the lock."
+        if not args:
+            return ["Client Error: Must provide filter name"]
+        name = args[0]
+        if name in self.filters:
+            return ["Exists"]
+        options = dict(arg.partition("=")[::2] for arg in args[1:])
+        try:
+            self.filters[name] = LocalBloomFilter(name,
+                                                  capacity=int(options.get("capacity", 100000)),
+                                                  prob=float(options.get("prob", 0.0001)),
+                                                  in_memory=options.get("in_memory") == "1")
+        except ValueError:
+            return ["Client Error: Bad arguments"]
+        return ["Done"]
+
+
+class LocalConnection(BloomdConnection):
+    """
+    Provides the BloomdConnection interface to a LocalBackend. Commands
+    are executed as they are sent, and their responses queued to be read,
+    so no sockets are used.
+    """
+    def __init__(self, server, timeout=None, attempts=3, pool=None, metrics=None):
         """
-        Creates a new filter on the BloomD server and returns a BloomdFilter
-        to interface with it. This will return a BloomdFilter object attached
-        to the filter if the filter already exists.
+        Creates a new local connection.
 
         :Parameters:
-            - name : The name of the new filter
-            - capacity (optional) : The initial capacity of the filter
-            - prob (optional) : The inital probability of false positives.
-            - in_memory (optional) : If True, specified that the filter should be created
-              in memory only.
-            - server (optional) : In a multi-server environment, this forces the
-                    filter to be created on a specific server. Should be provided
-                    in the same format as initialization "host" or "host:port".
+            - server : The "local://" or "local://name" server string.
+            - timeout : Ignored, local commands never block.
+            - attempts (optional) : Ignored.
+            - metrics (optional) : A BloomdMetrics to record commands into.
         """
-        if prob and not capacity:
-            raise ValueError("Must provide size with probability!")
+        self.pid = os.getpid()
+        self.server = server
+        self.timeout = timeout
+        self.attempts = attempts
+        self.pool = pool
+        self.last_used = time.time()
+        self.backend = LocalBackend.named(server)
+        self.responses = collections.deque()
+        self.logger = logging.getLogger("pybloomd.LocalConnection.%s" % server)
+        self.metrics = metrics
+        self.server_name = server
+        self.in_flight = collections.deque()
+        self.breaker = None
 
-        pool = self._get_pool(name, strict=False, explicit_server=server)
+    def connect(self):
+        "Local connections have nothing to open"
+        pass
+
+    def send(self, cmd):
+        "Executes a command, queueing its response"
+        self.send_many([cmd])
+
+    def send_many(self, cmds):
+        "Executes multiple commands, queueing their responses"
+        if self.metrics is None:
+            for cmd in cmds:
+                self.responses.extend(self.backend.execute(cmd))
+        else:
+            start = _clock()
+            for cmd in cmds:
+                self.responses.extend(self.backend.execute(cmd))
+            self._record_sent(cmds, start)
+
+    def _line_reader(self):
+        return None
+
+    def _readline(self):
+        "Returns the next queued response line"
+        if not self.responses:
+            raise BloomdError("No response pending!")
+        return self.responses.popleft()
+
+    def is_stale(self):
+        "Checks if there are unread responses"
+        return bool(self.responses)
+
+    def disconnect(self):
+        "Discards any unread responses"
+        self.responses.clear()
+        self.in_flight.clear()
+
+
+class MultiplexedConnection(object):
+    """
+    A connection to a server shared by many threads. bloomd answers
+    commands strictly in order, so callers queue their commands for a
+    writer thread, which sends everything queued with a single write.
+    A reader thread matches each response to the oldest pending future.
+    """
+    # Commands whose responses may be a START/END block
+    BLOCK_VERBS = ("list", "info")
+
+    def __init__(self, server, timeout=None, metrics=None, breaker=None):
+        """
+        Creates a new multiplexed connection. It connects lazily.
+
+        :Parameters:
+            - server : Provided as a string, either as "host" or "host:port".
+            - timeout (optional) : The connect timeout. Callers waiting for
+              responses apply their own timeouts.
+            - metrics (optional) : A BloomdMetrics to record commands into.
+            - breaker (optional) : A CircuitBreaker tracking the health of the server.
+        """
+        self.server = _parse_server(server)
+        self.server_name = server
+        self.timeout = timeout
+        self.metrics = metrics
+        self.breaker = breaker
+        self.connects = 0
+        self.logger = logging.getLogger("pybloomd.MultiplexedConnection.%s.%d" % self.server)
+        self._reset()
+
+    def _reset(self):
+        "Resets the connection state, forgetting the socket and threads"
+        self.pid = os.getpid()
+        self.sock = None
+        self._lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._pending = collections.deque()
+        self._writer = None
+
+    def _checkpid(self):
+        if self.pid != os.getpid():
+            self._reset()
+
+    def submit(self, cmds):
+        """
+        Queues commands to be sent, returning a BloomdFuture for each.
+        A future's result is the list of lines in the response. Raises
+        BloomdServerDown if the circuit of a connected server is open,
+        otherwise the circuit is checked when connecting.
+        """
+        self._checkpid()
+        if self.breaker is not None and self.sock is not None:
+            self.breaker.allow()
+        futures = [BloomdFuture() for _ in cmds]
+        self._requests.put((cmds, futures, _clock()))
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop)
+                    self._writer.daemon = True
+                    self._writer.start()
+        return futures
+
+    def connect(self):
+        "Connects to the server ahead of the first command"
+        self._checkpid()
+        with self._lock:
+            if self.sock is None:
+                self._connect()
+
+    def load(self):
+        "Returns the number of commands waiting on this connection"
+        return len(self._pending) + self._requests.qsize()
+
+    def _connect(self):
+        "Creates a new socket and starts its reader. Must hold the lock."
+        if self.breaker is not None:
+            self.breaker.allow()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        try:
+            s.connect(self.server)
+        except socket.error as e:
+            if self.metrics is not None:
+                self.metrics.error(self.server_name, None, e)
+            if self.breaker is not None:
+                self.breaker.failure()
+            raise
+        s.settimeout(None)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Writes from many callers may be in flight at once
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.metrics is not None:
+            self.metrics.connected(self.server_name, self.connects > 0)
+        self.connects += 1
+
+        # Each socket gets its own queue, so a reader draining an old
+        # socket cannot complete the commands sent on a new one
+        self._pending = collections.deque()
+        reader = threading.Thread(target=self._read_loop, args=(s, self._pending))
+        reader.daemon = True
+        reader.start()
+        self.sock = s
+        return s
+
+    def _write_loop(self):
+        "Sends the queued commands, batching everything waiting"
+        while True:
+            batch = [self._requests.get()]
+            while True:
+                try:
+                    batch.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        "Sends a batch of queued commands over the socket"
+        try:
+            data = b"".join([b"\n".join(cmds) + b"\n" for cmds, futures, start in batch])
+        except TypeError as e:
+            # Commands which are not bytes fail the batch, not the writer
+            for cmds, futures, start in batch:
+                for future in futures:
+                    future.set_exception(e)
+            return
+        entries = [(_native_str(cmd.partition(b" ")[0]), future, start)
+                   for cmds, futures, start in batch
+                   for cmd, future in zip(cmds, futures)]
+        with self._lock:
+            try:
+                sock = self.sock or self._connect()
+            except EnvironmentError as e:
+                if not isinstance(e, BloomdServerDown):
+                    self.logger.exception("Failed to connect to bloomd server!")
+                for verb, future, start in entries:
+                    future.set_exception(e)
+                return
+            self._pending.extend(entries)
+
+        try:
+            sock.sendall(data)
+        except socket.error as e:
+            self.logger.exception("Failed to send commands to bloomd server!")
+            self._fail(sock, e)
+            return
+        if self.metrics is not None:
+            sizes = [len(cmd) + 1 for cmds, futures, start in batch for cmd in cmds]
+            self.metrics.sent(self.server_name, [verb for verb, _, _ in entries], sizes)
+
+    def _read_loop(self, sock, pending):
+        "Reads responses from a socket, completing its pending futures"
+        reader = LineReader(sock)
+        try:
+            while True:
+                lines = [reader.readline()]
+                verb, future, start = pending.popleft()
+                if verb in self.BLOCK_VERBS and lines[0] == "START":
+                    while lines[-1] != "END":
+                        lines.append(reader.readline())
+                if self.metrics is not None:
+                    self.metrics.received(self.server_name, verb, _clock() - start,
+                                          sum(len(line) + 1 for line in lines))
+                if self.breaker is not None:
+                    self.breaker.success()
+                future.set_result(lines)
+        except Exception as e:
+            self._fail(sock, e)
+
+    def _fail(self, sock, error, count=True):
+        """
+        Closes a failed socket, failing every command waiting on it.
+        The failure counts against the server's health if `count` is True.
+        """
+        with self._lock:
+            if self.sock is not sock:
+                return
+            self.sock = None
+            pending, self._pending = self._pending, collections.deque()
+        try:
+            # Shut down first, to wake the reader blocked on the socket
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        try:
+            sock.close()
+        except socket.error:
+            pass
+        # The reader may still be taking entries, so take them one at a time
+        failed = []
+        while True:
+            try:
+                failed.append(pending.popleft())
+            except IndexError:
+                break
+        pending = failed
+        if pending and self.metrics is not None:
+            self.metrics.error(self.server_name, pending[0][0], error)
+        if pending and count and self.breaker is not None:
+            self.breaker.failure()
+        if not isinstance(error, EnvironmentError):
+            error = EnvironmentError("Lost connection to bloomd server: %s" % error)
+        for verb, future, start in pending:
+            future.set_exception(error)
+
+    def close(self):
+        "Closes the socket, failing any commands waiting on it"
+        sock = self.sock
+        if sock is not None:
+            self._fail(sock, EnvironmentError("Connection closed by client!"), count=False)
+
+
+class MultiplexedHandle(BloomdConnection):
+    """
+    Provides the BloomdConnection interface for a single caller of a
+    MultiplexedConnection. Abandoning a handle with responses unread
+    does not disturb other callers.
+    """
+    def __init__(self, connection, pool=None):
+        self.pid = os.getpid()
+        self.connection = connection
+        self.server = connection.server
+        self.server_name = connection.server_name
+        self.timeout = connection.timeout
+        self.pool = pool
+        self.metrics = None
+        self.breaker = None
+        self.last_used = time.time()
+        self.logger = connection.logger
+        self.futures = collections.deque()
+        self.lines = collections.deque()
+
+    def send(self, cmd):
+        "Queues a command with out the newline to be sent"
+        self.futures.extend(self.connection.submit([cmd]))
+
+    def send_many(self, cmds):
+        "Queues multiple commands with out the newlines to be sent"
+        if cmds:
+            self.futures.extend(self.connection.submit(cmds))
+
+    def send_and_receive(self, cmd):
+        "Convenience wrapper around `send` and `read`"
+        self.send(cmd)
+        return self.read()
+
+    def _line_reader(self):
+        return None
+
+    def _readline(self):
+        "Returns the next response line, waiting up to the timeout"
+        if not self.lines:
+            if not self.futures:
+                raise BloomdError("No response pending!")
+            future = self.futures.popleft()
+            try:
+                self.lines.extend(future.result(self.timeout))
+            except BloomdError:
+                # Count a response timeout against the server, like a socket timeout
+                if not future.done() and self.connection.breaker is not None:
+                    self.connection.breaker.failure()
+                raise
+        return self.lines.popleft()
+
+    def is_stale(self):
+        return False
+
+    def disconnect(self):
+        "Abandons the responses not yet read"
+        self.futures.clear()
+        self.lines.clear()
+
+
+class MultiplexedPool(object):
+    """
+    Provides the ConnectionPool interface over a few MultiplexedConnections
+    shared by all threads, instead of a connection per thread. Each call
+    gets a handle onto the least loaded connection.
+    """
+    def __init__(self, connections=1, **connection_kwargs):
+        """
+        Creates a new MultiplexedPool. Extra keyword arguments are passed
+        to each MultiplexedConnection.
+
+        :Parameters:
+            - connections (optional) : The number of shared connections.
+        """
+        self.connections = [MultiplexedConnection(**connection_kwargs)
+                            for _ in range(connections)]
+
+    def get_connection(self):
+        "Returns a handle onto the least loaded connection"
+        if len(self.connections) == 1:
+            return MultiplexedHandle(self.connections[0], self)
+        return MultiplexedHandle(min(self.connections, key=MultiplexedConnection.load), self)
+
+    def release(self, connection):
+        "Handles are not reused, so there is nothing to release"
+        pass
+
+    def warm_up(self, count=None):
+        """
+        Connects every shared connection unless `count` is 0, returning
+        the number connected. The number of connections is fixed, so
+        other counts are ignored.
+        """
+        if count == 0:
+            return 0
+        for connection in self.connections:
+            connection.connect()
+        return len(self.connections)
+
+    def stats(self):
+        """
+        Returns a dictionary of pool statistics: the number of shared
+        connections, how many are connected, and the number of commands
+        waiting to be sent or answered.
+        """
+        return {
+            "connections": len(self.connections),
+            "connected": sum(1 for conn in self.connections if conn.sock is not None),
+            "pending": sum(conn.load() for conn in self.connections),
+        }
+
+    def disconnect(self):
+        "Disconnects all the shared connections"
+        for connection in self.connections:
+            connection.close()
+
+
+class PositiveCache(object):
+    """
+    Bounded LRU cache of keys known to be in a filter. A bloom filter
+    never forgets a key unless it is cleared or dropped, so a positive
+    check can be answered locally until then. Entries can expire after
+    a TTL, to pick up clears made by other clients.
+    """
+    def __init__(self, max_size=100000, ttl=None):
+        """
+        Creates a new PositiveCache.
+
+        :Parameters:
+            - max_size (optional) : The maximum number of cached keys.
+            - ttl (optional) : Seconds before a key must be checked again.
+              Defaults to never.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, filter, key):
+        "Checks if a key is known to be in a filter"
+        entry = (filter, key)
+        with self._lock:
+            expires = self._entries.pop(entry, None)
+            if expires is None or (self.ttl is not None and expires < time.time()):
+                self.misses += 1
+                return False
+            self._entries[entry] = expires
+            self.hits += 1
+            return True
+
+    def add(self, filter, key):
+        "Records that a key is in a filter"
+        self.add_many(filter, (key,))
+
+    def add_many(self, filter, keys):
+        "Records that multiple keys are in a filter"
+        expires = time.time() + self.ttl if self.ttl is not None else 0
+        with self._lock:
+            for key in keys:
+                entry = (filter, key)
+                self._entries.pop(entry, None)
+                self._entries[entry] = expires
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, filter):
+        "Forgets every key of a filter"
+        with self._lock:
+            for entry in [e for e in self._entries if e[0] == filter]:
+                del self._entries[entry]
+
+    def stats(self):
+        "Returns a dictionary with the hits, misses and size of the cache"
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class FilterLocationCache(object):
+    """
+    Tracks which server holds each filter. Unknown filters are resolved
+    individually by asking every server concurrently, filters which do
+    not exist are remembered for a short time, and the full map of
+    filters is reloaded in a background thread.
+    """
+    def __init__(self, client, refresh_interval=300, negative_ttl=5):
+        """
+        Creates a new FilterLocationCache.
+
+        :Parameters:
+            - client : The BloomdClient to query
+            - refresh_interval (optional) : Seconds between full reloads.
+            - negative_ttl (optional) : Seconds to remember a missing filter.
+        """
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        "Resets the cache state"
+        self.pid = os.getpid()
+        self.locations = {}
+        self.missing = {}
+        self.refresh_time = 0
+        self.loaded = False
+        self._refreshing = False
+
+    def _checkpid(self):
+        # Any refresh thread did not survive a fork, but the
+        # locations are still good, so warm-ups before a fork last
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._lock = threading.Lock()
+            self._refreshing = False
+
+    def lookup(self, name):
+        """
+        Returns the server holding a filter, or None if it does not exist.
+        Only the single filter is resolved on a cache miss.
+        """
+        self._checkpid()
+        self._maybe_refresh()
+
+        server = self.locations.get(name)
+        if server:
+            return server
+
+        expires = self.missing.get(name)
+        if expires and expires > time.time():
+            return None
+
+        return self.resolve(name)
+
+    def resolve(self, name):
+        """
+        Asks every server for a filter concurrently, and caches the result.
+        Returns the server holding the filter, or None.
+        """
+        if self.client.metrics is not None:
+            self.client.metrics.resolved()
+
+        def has_filter(server):
+            with self.client._server_pool(server).get_connection() as conn:
+                conn.send(_encode("info %s" % name))
+                try:
+                    conn.readblock()
+                    return True
+                except BloomdError:
+                    return False
+
+        found, errors = self.client._each_server(has_filter, self.client.timeout)
+        for server in self.client.servers:
+            if found.get(server):
+                self.set(name, server)
+                return server
+
+        # Only cache the miss if every server answered
+        if not errors:
+            with self._lock:
+                self.missing[name] = time.time() + self.negative_ttl
+        return None
+
+    def resolve_many(self, names):
+        """
+        Resolves many filters at once, pipelining an info command for
+        each over one connection per server. Returns a tuple of
+        dictionaries ({filter_name : server}, {server : error}), leaving
+        out the filters which do not exist. Those are only cached as
+        missing if every server answered.
+        """
+        names = list(names)
+        if not names:
+            return {}, {}
+        if self.client.metrics is not None:
+            self.client.metrics.resolved()
+
+        cmds = [("info", _encode("info %s" % name)) for name in names]
+        found, errors = self.client._execute_grouped(
+            dict((server, cmds) for server in self.client.servers), self.client.timeout)
+
+        located = {}
+        for server in self.client.servers:
+            for name, resp in zip(names, found.get(server, ())):
+                if name not in located and not isinstance(resp, BloomdError):
+                    located[name] = server
+
+        with self._lock:
+            expires = time.time() + self.negative_ttl
+            for name in names:
+                if name in located:
+                    self.locations[name] = located[name]
+                    self.missing.pop(name, None)
+                elif not errors:
+                    self.missing[name] = expires
+        return located, errors
+
+    def set(self, name, server):
+        "Records the location of a filter"
+        with self._lock:
+            self.locations[name] = server
+            self.missing.pop(name, None)
+
+    def all(self):
+        """
+        Returns a dictionary of {filter_name : server} for every known
+        filter, loading it if there has not been a full load yet.
+        """
+        self._checkpid()
+        if not self.loaded:
+            self.refresh()
+        return dict(self.locations)
+
+    def refresh(self):
+        """
+        Reloads the location of every filter. Known locations on servers
+        which fail to respond are kept.
+        """
+        start = _clock()
+        try:
+            info = self.client.list_filters(inc_server=True, timeout=self.client.timeout)
+            failed = {}
+        except BloomdFanOutError as e:
+            if len(e.errors) == len(self.client.servers):
+                self._record_refresh(start, False)
+                raise
+            info, failed = e.results, e.errors
+        self._record_refresh(start, not failed)
+
+        locations = dict((name, server) for name, (server, _) in info.items())
+        with self._lock:
+            for name, server in self.locations.items():
+                if server in failed:
+                    locations.setdefault(name, server)
+            self.locations = locations
+            self.missing = {}
+            self.refresh_time = time.time()
+            self.loaded = True
+
+    def _record_refresh(self, start, ok):
+        "Records a refresh which began at `start` in the client metrics"
+        if self.client.metrics is not None:
+            self.client.metrics.refreshed(_clock() - start, ok)
+
+    def _maybe_refresh(self):
+        "Starts a background reload if the cache is stale"
+        if time.time() - self.refresh_time < self.refresh_interval:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self.refresh_time = time.time()
+        t = threading.Thread(target=self._background_refresh)
+        t.daemon = True
+        t.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logging.getLogger("pybloomd.FilterLocationCache").exception("Failed to reload filter locations!")
+        finally:
+            self._refreshing = False
+
+
+class FilterStatsCache(object):
+    """
+    Caches the info of filters, with the values parsed into ints, floats
+    and bools, for `ttl` seconds. Filters which are missing or stale are
+    fetched together, pipelining an info command for each over a single
+    connection per server. In background mode, stale info is returned
+    while a background thread fetches it again, so only the first
+    lookup of a filter waits on the server.
+    """
+    def __init__(self, client, ttl=60, background=False):
+        """
+        Creates a new FilterStatsCache.
+
+        :Parameters:
+            - client : The BloomdClient to query
+            - ttl (optional) : Seconds the info of a filter is fresh for.
+            - background (optional) : If True, stale info is refreshed in
+              a background thread instead of by the caller.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.background = background
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        "Resets the cache state"
+        self.pid = os.getpid()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._refreshing = False
+
+    def _checkpid(self):
+        # Any refresh thread did not survive a fork
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._lock = threading.Lock()
+            self._refreshing = False
+
+    def get(self, name):
+        """
+        Returns the info of a filter. Raises BloomdError if the filter
+        does not exist.
+        """
+        info = self.get_many([name])
+        if name not in info:
+            raise BloomdError("Filter does not exist!")
+        return info[name]
+
+    def get_many(self, names, timeout=None):
+        """
+        Returns a dictionary of {filter_name : info} for many filters,
+        leaving out the filters which do not exist. The info dictionaries
+        are shared, and must not be modified. If any server fails, a
+        BloomdFanOutError is raised with the info of the other filters as
+        its `results`.
+
+        :Parameters:
+            - names : The names of the filters.
+            - timeout (optional) : The time each server has to respond.
+        """
+        self._checkpid()
+        now = time.time()
+        results = {}
+        missing = []
+        stale = []
+        for name in names:
+            entry = self.entries.get(name)
+            if entry is None:
+                missing.append(name)
+                continue
+            expires, info = entry
+            if expires > now:
+                results[name] = info
+            elif self.background:
+                results[name] = info
+                stale.append(name)
+            else:
+                missing.append(name)
+
+        with self._lock:
+            self.hits += len(results) - len(stale)
+            self.misses += len(missing) + len(stale)
+        if stale:
+            self._maybe_refresh()
+        if missing:
+            try:
+                results.update(self.fetch(missing, timeout))
+            except BloomdFanOutError as e:
+                results.update(e.results)
+                raise BloomdFanOutError(results, e.errors)
+        return results
+
+    def fetch(self, names, timeout=None):
+        """
+        Fetches the info of filters from their servers, and caches it.
+        Filters which no longer exist are forgotten if every server
+        answered. Returns a dictionary
+        of {filter_name : info}, and raises BloomdFanOutError on failures
+        like `get_many`.
+        """
+        info, errors = self.client._fetch_info(names, timeout)
+        expires = time.time() + self.ttl
+        with self._lock:
+            for name in names:
+                if name in info:
+                    self.entries[name] = (expires, info[name])
+                elif not errors:
+                    self.entries.pop(name, None)
+        if errors:
+            raise BloomdFanOutError(info, errors)
+        return info
+
+    def invalidate(self, name):
+        "Forgets the info of a filter"
+        with self._lock:
+            self.entries.pop(name, None)
+
+    def stats(self):
+        "Returns a dictionary with the hits, misses and size of the cache"
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+    def _maybe_refresh(self):
+        "Starts a background fetch of the stale filters, unless one is running"
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        t = threading.Thread(target=self._background_refresh)
+        t.daemon = True
+        t.start()
+
+    def _background_refresh(self):
+        try:
+            now = time.time()
+            stale = [name for name, (expires, _) in list(self.entries.items()) if expires <= now]
+            if stale:
+                self.fetch(stale, self.client.timeout)
+        except Exception:
+            logging.getLogger("pybloomd.FilterStatsCache").exception("Failed to refresh filter stats!")
+        finally:
+            self._refreshing = False
+
+
+class BloomdClient(object):
+    "Provides a client abstraction around the BloomD interface."
+    def __init__(self, servers, timeout=None, hash_keys=False, max_connections=None,
+                 pool_timeout=None, max_idle_time=None, refresh_interval=300, negative_ttl=5,
+                 positive_cache_size=None, positive_cache_ttl=None, metrics=None, multiplex=None,
+                 circuit_breaker=True, stats_ttl=None, stats_background=False):
+        """
+        Creates a new BloomD client.
+
+        :Parameters:
+            - servers : A list of servers, which are provided as strings in the "host" or "host:port".
+              A "local://" or "local://name" server keeps its filters in-process instead.
+            - timeout: (Optional) A socket timeout to use, defaults to no timeout.
+            - hash_keys: (Optional) Should keys be hashed before sending to bloomd. Defaults to False.
+              True uses SHA1 hex digests, or a KeyHasher or hashlib algorithm name may be provided.
+            - max_connections: (Optional) The maximum connections per server. Defaults to unlimited.
+            - pool_timeout: (Optional) How long to wait for a connection once max_connections
+              are in use. Defaults to waiting forever.
+            - max_idle_time: (Optional) Close pooled connections idle for this many seconds.
+            - refresh_interval: (Optional) How often the filter locations are reloaded
+              in the background, in seconds. Defaults to 300.
+            - negative_ttl: (Optional) How long a missing filter is remembered, in seconds.
+              Defaults to 5.
+            - positive_cache_size: (Optional) If provided, up to this many keys known to be
+              in a filter are cached, and checks for them skip the server.
+            - positive_cache_ttl: (Optional) How long cached keys are trusted, in seconds.
+              Useful when other clients may clear or drop filters. Defaults to forever.
+            - metrics: (Optional) A BloomdMetrics to record into, or True to create one.
+              Defaults to no metrics.
+            - multiplex: (Optional) If provided, all threads share this many connections
+              to each server, with commands from many threads in flight at once. The
+              timeout then applies to each response, and max_connections, pool_timeout
+              and max_idle_time are unused.
+            - circuit_breaker: (Optional) If True, each server gets a CircuitBreaker, and
+              calls to a server that keeps failing fail fast with BloomdServerDown until
+              it recovers. A dictionary of CircuitBreaker arguments may be given instead.
+              Defaults to True.
+            - stats_ttl: (Optional) If provided, filter info is cached by a FilterStatsCache
+              for this many seconds, and len() of a filter is served from it.
+            - stats_background: (Optional) If True, stale filter info is refreshed in a
+              background thread, and the stale info is returned meanwhile.
+        """
+        if len(servers) == 0:
+            raise ValueError("Must provide at least 1 server!")
+        self.servers = servers
+        self.timeout = timeout
+        self.sever_pools = {}
+        self.hash_keys = hash_keys
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.max_idle_time = max_idle_time
+        self.metrics = BloomdMetrics() if metrics is True else metrics
+        self.multiplex = multiplex
+        self.circuit_breaker = circuit_breaker
+        self.breakers = {}
+        self.locations = FilterLocationCache(self, refresh_interval, negative_ttl)
+        self.positive_cache = None
+        if positive_cache_size:
+            self.positive_cache = PositiveCache(positive_cache_size, positive_cache_ttl)
+        self.stats_cache = None
+        if stats_ttl:
+            self.stats_cache = FilterStatsCache(self, stats_ttl, stats_background)
+
+    def _server_pool(self, server):
+        "Returns a connection to a server, tries to cache connections."
+        if server in self.sever_pools:
+            return self.sever_pools[server]
+        else:
+            if server.startswith(LOCAL_PREFIX):
+                pool = ConnectionPool(LocalConnection, server=server, metrics=self.metrics)
+                return self.sever_pools.setdefault(server, pool)
+
+            breaker = None
+            if self.circuit_breaker:
+                options = self.circuit_breaker if isinstance(self.circuit_breaker, dict) else {}
+                breaker = self.breakers.setdefault(server, CircuitBreaker(server, **options))
+            if self.multiplex:
+                pool = MultiplexedPool(int(self.multiplex), server=server, timeout=self.timeout,
+                                       metrics=self.metrics, breaker=breaker)
+            else:
+                pool = ConnectionPool(server=server, timeout=self.timeout,
+                                      max_connections=self.max_connections,
+                                      pool_timeout=self.pool_timeout,
+                                      max_idle_time=self.max_idle_time,
+                                      metrics=self.metrics, breaker=breaker)
+            return self.sever_pools.setdefault(server, pool)
+
+    def _get_server(self, filter, strict=True, explicit_server=None):
+        """
+        Gets a server which is able to service a filter. Because filters
+        may exist on any server, their locations are tracked by the
+        FilterLocationCache. This allows us to partition data across
+        multiple servers.
+
+        :Parameters:
+            - filter : The filter to connect to
+            - strict (optional) : If True, an error is raised when a filter
+                does not exist.
+            - explicit_server (optional) : If provided, when a filter does
+                not exist and strict is False, this server is used.
+                Otherwise, the server with the fewest sets is returned.
+        """
+        # Check if this filter is in a known location
+        server = self.locations.lookup(filter)
+        if server:
+            return server
+
+        # Check if this is fatal
+        if strict:
+            raise BloomdError("Filter does not exist!")
+
+        # We have an explicit server provided to us, use that
+        if explicit_server:
+            return explicit_server
+
+        # Does not exist, and is not not strict
+        # we can select a server on any criteria then.
+        # We will use the server with the minimal set count.
+        counts = {}
+        for server in self.servers:
+            counts[server] = 0
+        for server in self.locations.all().values():
+            if server in counts:
+                counts[server] += 1
+
+        counts = [(count, srv) for srv, count in counts.items()]
+        counts.sort()
+
+        # Select the least used
+        return counts[0][1]
+
+    def _get_pool(self, filter, strict=True, explicit_server=None):
+        """
+        Gets a connection pool to a server which is able to service a
+        filter. Takes the same parameters as `_get_server`.
+        """
+        return self._server_pool(self._get_server(filter, strict, explicit_server))
+
+    def create_filter(self, name, capacity=None, prob=None, in_memory=False, server=None):
+        """
+        Creates a new filter on the BloomD server and returns a BloomdFilter
+        to interface with it. This will return a BloomdFilter object attached
+        to the filter if the filter already exists.
+
+        :Parameters:
+            - name : The name of the new filter
+            - capacity (optional) : The initial capacity of the filter
+            - prob (optional) : The inital probability of false positives.
+            - in_memory (optional) : If True, specified that the filter should be created
+              in memory only.
+            - server (optional) : In a multi-server environment, this forces the
+                    filter to be created on a specific server. Should be provided
+                    in the same format as initialization "host" or "host:port".
+        """
+        if prob and not capacity:
+            raise ValueError("Must provide size with probability!")
+
+        server = self._get_server(name, strict=False, explicit_server=server)
+        pool = self._server_pool(server)
 
         with pool.get_connection() as conn:
             cmd = "create %s" % name
@@ -322,148 +2260,1307 @@ class BloomdClient(object):
             if in_memory:
                 cmd += " in_memory=1"
 
-            conn.send(cmd)
-            resp = conn.read()
+            conn.send(_encode(cmd))
+            resp = conn.read()
+
+        if resp == "Done":
+            self.locations.set(name, server)
+            return BloomdFilter(pool, name, self.hash_keys, self.positive_cache, self.stats_cache)
+        elif resp == "Exists":
+            self.locations.set(name, server)
+            return self[name]
+        else:
+            raise BloomdError("Got response: %s" % resp)
+
+    def __getitem__(self, name):
+        "Gets a BloomdFilter object based on the name."
+        pool = self._get_pool(name)
+        return BloomdFilter(pool, name, self.hash_keys, self.positive_cache, self.stats_cache)
+
+    def create_sharded_filter(self, name, shards, capacity=None, prob=None, in_memory=False):
+        """
+        Creates a filter sharded across multiple servers, and returns a
+        ShardedBloomdFilter to interface with it. Shards which already
+        exist are reused.
+
+        :Parameters:
+            - name : The name of the new logical filter
+            - shards : The servers to place shards on, as a list of servers
+              or a dictionary of {shard id : server}. See ShardedBloomdFilter.
+            - capacity (optional) : The initial capacity of the whole filter,
+              which is split evenly between the shards.
+            - prob (optional) : The inital probability of false positives.
+            - in_memory (optional) : If True, specified that the shards should be created
+              in memory only.
+        """
+        layout = _shard_layout(shards)
+        if capacity:
+            capacity = (capacity + len(layout) - 1) // len(layout)
+
+        def create(item):
+            shard, server = item
+            self.create_filter(ShardedBloomdFilter.shard_name(name, shard), capacity,
+                               prob, in_memory, server=server)
+        _fan_out(create, layout)
+        return self.sharded_filter(name, shards)
+
+    def sharded_filter(self, name, shards, previous=None):
+        """
+        Returns a ShardedBloomdFilter for an existing sharded filter.
+
+        :Parameters:
+            - name : The name of the logical filter
+            - shards : The servers holding shards, as a list of servers
+              or a dictionary of {shard id : server}.
+            - previous (optional) : The shards before a change of layout,
+              which are also checked for keys that moved.
+        """
+        return ShardedBloomdFilter(self, name, shards, self.hash_keys, previous)
+
+    def create_replicated_filter(self, name, servers, capacity=None, prob=None, in_memory=False):
+        """
+        Creates a filter copied onto multiple servers, and returns a
+        ReplicatedBloomdFilter to interface with it. Replicas which
+        already exist are reused.
+
+        :Parameters:
+            - name : The name of the new logical filter
+            - servers : The servers to place replicas on. These must be given
+              explicitly, so the replicas do not move when the client's
+              servers change.
+            - capacity (optional) : The initial capacity of each replica.
+            - prob (optional) : The inital probability of false positives.
+            - in_memory (optional) : If True, specified that the replicas should be created
+              in memory only.
+        """
+        servers = list(servers)
+
+        def create(server):
+            replica = ReplicatedBloomdFilter.replica_name(name, server)
+            self.create_filter(replica, capacity, prob, in_memory, server=server)
+        _fan_out(create, servers)
+        return self.replicated_filter(name, servers)
+
+    def replicated_filter(self, name, servers):
+        """
+        Returns a ReplicatedBloomdFilter for an existing replicated filter.
+
+        :Parameters:
+            - name : The name of the logical filter
+            - servers : The servers holding replicas.
+        """
+        return ReplicatedBloomdFilter(self, name, servers, self.hash_keys)
+
+    def pipeline(self, result_type="list"):
+        """
+        Creates a BloomdClientPipeline, to pipeline commands for any
+        filters. Commands are routed to the servers holding their filters.
+
+        :Parameters:
+            - result_type (optional) : The type of bulk and multi results,
+              one of "list", "bytearray" or "numpy".
+        """
+        return BloomdClientPipeline(self, result_type)
+
+    def multi_check(self, filters, keys, timeout=None):
+        """
+        Checks keys against many filters at once. The filters are grouped
+        by the server holding them, the checks for each server are
+        pipelined over a single connection, and the servers are queried
+        concurrently. Returns a dictionary of {filter : [True/False for
+        each key]}, or {filter : True/False} if a single key is given.
+        If any server fails, a BloomdFanOutError is raised with the
+        results of the filters on the other servers as its `results`.
+
+        :Parameters:
+            - filters : The names of the filters to check.
+            - keys : A key, or a list of keys, to check in every filter.
+            - timeout (optional) : The time each server has to respond.
+        """
+        single = isinstance(keys, (bytes, _text_type))
+        keys = [keys] if single else list(keys)
+        hasher = KeyHasher.from_setting(self.hash_keys)
+        sent = hasher.hash_many(keys) if hasher else keys
+        cache = self.positive_cache
+
+        # Find the keys each filter must ask its server about
+        results = {}
+        wanted = {}
+        commands = collections.defaultdict(list)
+        for name in filters:
+            results[name] = [True] * len(keys)
+            idxs = range(len(keys))
+            if cache is not None:
+                idxs = [i for i in idxs if not cache.contains(name, keys[i])]
+            if not idxs:
+                continue
+            wanted[name] = idxs
+            server_cmds = commands[self._get_server(name)]
+            prefixes = _filter_commands(name)
+            if len(idxs) == 1:
+                server_cmds.append((name, ("check", prefixes["c"] + _join_keys([sent[idxs[0]]]))))
+            else:
+                chunks = _chunk_commands(prefixes["m"], [sent[i] for i in idxs],
+                                         BATCH_MAX_KEYS, BATCH_MAX_BYTES)
+                server_cmds.extend((name, ("multi", cmd)) for cmd in chunks)
+
+        def gather(server, responses):
+            "Copies the responses of a server into the results"
+            found = collections.defaultdict(list)
+            for (name, _), resp in zip(commands[server], responses):
+                if isinstance(resp, BloomdError):
+                    raise resp
+                if isinstance(resp, bool):
+                    found[name].append(resp)
+                else:
+                    found[name].extend(resp)
+            for name, hits in found.items():
+                res = results[name]
+                for i, hit in zip(wanted[name], hits):
+                    res[i] = hit
+                if cache is not None:
+                    cache.add_many(name, [keys[i] for i, hit in zip(wanted[name], hits) if hit])
+
+        server_responses, errors = self._execute_grouped(
+            dict((server, [cmd for _, cmd in cmds]) for server, cmds in commands.items()), timeout)
+        for server, responses in server_responses.items():
+            gather(server, responses)
+
+        if single:
+            results = dict((name, res[0]) for name, res in results.items())
+        if errors:
+            failed = set(name for server in errors for name, _ in commands[server])
+            raise BloomdFanOutError(dict((name, res) for name, res in results.items()
+                                         if name not in failed), errors)
+        return results
+
+    def _each_server(self, func, timeout=None, servers=None):
+        """
+        Calls `func(server)` for every server concurrently, giving each
+        server `timeout` seconds to finish. Returns a tuple of dictionaries
+        ({server : result}, {server : error}).
+        """
+        return _fan_out_partial(func, servers or self.servers, timeout)
+
+    def _execute_grouped(self, commands, timeout=None, flags=False):
+        """
+        Executes lists of pipelined (name, cmd) commands on their servers
+        concurrently, each over a single connection. Takes a dictionary of
+        {server : commands}, and returns a tuple of dictionaries
+        ({server : responses}, {server : error}). Responses are parsed by
+        `_read_response`, so errors from the server are BloomdErrors.
+        """
+        def execute(server):
+            cmds = commands[server]
+            with self._server_pool(server).get_connection() as conn:
+                with closing(_execute_windowed(conn, cmds, DEFAULT_WINDOW, flags)) as responses:
+                    return list(responses)
+
+        if not commands:
+            return {}, {}
+        return self._each_server(execute, timeout, list(commands))
+
+    def warm_up(self, filters=None, connections=1, timeout=None):
+        """
+        Opens connections and locates filters ahead of use, so the first
+        commands do not pay for connecting or a filter lookup. Meant to be
+        called at startup, and again in each worker after a fork, since
+        connections do not survive a fork. Filter locations do, so a
+        warm-up before forking saves each worker the lookups.
+
+        Returns a dictionary with the seconds taken under "elapsed", the
+        connections open to each server under "connections", and the
+        number of filters located under "located". If any server fails,
+        a BloomdFanOutError is raised with this dictionary as its `results`.
+
+        :Parameters:
+            - filters (optional) : The names of the filters to locate. They
+               are resolved in a single pipeline per server. Defaults to
+               reloading the locations of every filter.
+            - connections (optional) : The number of connections to open to
+               each server. Defaults to 1.
+            - timeout (optional) : The time each server has to connect.
+        """
+        start = _clock()
+
+        def warm_server(server):
+            return self._server_pool(server).warm_up(connections)
+
+        opened, errors = self._each_server(warm_server, timeout)
+
+        if filters is None:
+            try:
+                self.locations.refresh()
+            except BloomdFanOutError as e:
+                errors.update(e.errors)
+            located = len(self.locations.locations)
+        else:
+            found, failed = self.locations.resolve_many(filters)
+            errors.update(failed)
+            located = len(found)
+
+        report = {
+            "elapsed": _clock() - start,
+            "connections": opened,
+            "located": located,
+        }
+        if errors:
+            raise BloomdFanOutError(report, errors)
+        return report
+
+    def filter_stats(self, filters, timeout=None):
+        """
+        Returns the info of many filters, as a dictionary of {filter_name :
+        info} with the values parsed into ints, floats and bools. The info
+        commands are pipelined over a single connection per server, and
+        the servers are queried concurrently. If the client has a stats
+        cache, only missing or stale filters are fetched. Filters which do
+        not exist are left out. If any server fails, a BloomdFanOutError
+        is raised with the info of the other filters as its `results`.
+
+        :Parameters:
+            - filters : The names of the filters.
+            - timeout (optional) : The time each server has to respond.
+        """
+        if self.stats_cache is not None:
+            return self.stats_cache.get_many(filters, timeout)
+        info, errors = self._fetch_info(filters, timeout)
+        if errors:
+            raise BloomdFanOutError(info, errors)
+        return info
+
+    def _fetch_info(self, filters, timeout=None):
+        """
+        Fetches the info of filters from their servers, bypassing the
+        stats cache. Returns a tuple of dictionaries ({filter_name :
+        info}, {server : error}), leaving out filters which do not exist.
+        """
+        names = collections.defaultdict(list)
+        commands = collections.defaultdict(list)
+        for name in filters:
+            try:
+                server = self._get_server(name)
+            except BloomdError:
+                continue
+            names[server].append(name)
+            commands[server].append(("info", _encode("info %s" % name)))
+
+        found, errors = self._execute_grouped(commands, timeout)
+        info = {}
+        for server, responses in found.items():
+            for name, resp in zip(names[server], responses):
+                if not isinstance(resp, BloomdError):
+                    info[name] = _parse_info(resp)
+        return info, errors
+
+    def list_filters(self, inc_server=False, timeout=None):
+        """
+        Lists all the available filters across all servers.
+        Returns a dictionary of {filter_name : filter_info}. The servers
+        are queried concurrently. If any server fails, a BloomdFanOutError
+        is raised with the filters from the other servers as its `results`.
+
+        :Parameters:
+            - inc_server (optional) : If true, the dictionary values
+               will be (server, filter_info) instead of filter_info.
+            - timeout (optional) : The time each server has to respond.
+        """
+        def list_server(server):
+            with self._server_pool(server).get_connection() as conn:
+                conn.send(b"list")
+                return [line.split(" ", 1) for line in conn.iterblock()]
+
+        blocks, errors = self._each_server(list_server, timeout)
+
+        responses = {}
+        for server in self.servers:
+            for name, info in blocks.get(server, ()):
+                if inc_server:
+                    responses[name] = server, info
+                else:
+                    responses[name] = info
+
+        if errors:
+            raise BloomdFanOutError(responses, errors)
+        return responses
+
+    def stats(self):
+        """
+        Returns a snapshot of the client statistics. The connection pool
+        statistics of each server are under "pools", and the circuit
+        breaker states under "breakers". If the client has metrics, the
+        BloomdMetrics snapshot is included as well.
+        """
+        stats = self.metrics.snapshot() if self.metrics is not None else {}
+        stats["pools"] = dict((server, pool.stats()) for server, pool in list(self.sever_pools.items()))
+        stats["breakers"] = dict((server, breaker.stats()) for server, breaker in list(self.breakers.items()))
+        return stats
+
+    def flush(self, timeout=None):
+        """
+        Instructs all servers to flush to disk. The servers are flushed
+        concurrently, and a BloomdFanOutError is raised if any fail.
+
+        :Parameters:
+            - timeout (optional) : The time each server has to respond.
+        """
+        def flush_server(server):
+            with self._server_pool(server).get_connection() as conn:
+                resp = conn.send_and_receive(b"flush")
+            if resp != "Done":
+                raise BloomdError("Got response: '%s' from '%s'" % (resp, server))
+            return True
+
+        results, errors = self._each_server(flush_server, timeout)
+        if errors:
+            raise BloomdFanOutError(results, errors)
+
+
+class BloomdFilter(object):
+    "Provides an interface to a single Bloomd filter"
+    def __init__(self, pool, name, hash_keys=False, cache=None, stats_cache=None):
+        """
+        Creates a new BloomdFilter object.
+
+        :Parameters:
+            - pool : The connection pool to use
+            - name : The name of the filter
+            - hash_keys : Should the keys be hashed client side
+            - cache (optional) : A PositiveCache used to skip checks of
+              keys which are known to be in the filter.
+            - stats_cache (optional) : A FilterStatsCache used to answer
+              `len` and `stats` without asking the server each time.
+        """
+        self.pool = pool
+        self.name = name
+        self.hash_keys = hash_keys
+        self.hasher = KeyHasher.from_setting(hash_keys)
+        self.cache = cache
+        self.stats_cache = stats_cache
+        self.commands = _filter_commands(name)
+
+    def _get_key(self, key):
+        """
+        Returns the key we should send to the server, as bytes
+        """
+        if self.hasher:
+            return _encode(self.hasher(key))
+        return _encode_key(key)
+
+    def _get_keys(self, keys):
+        "Returns an iterator of the keys we should send to the server"
+        if self.hasher:
+            return self.hasher.hash_iter(keys)
+        return keys
+
+    def add(self, key):
+        """
+        Adds a new key to the filter. Returns True/False if the key was added.
+        """
+        with self.pool.get_connection() as conn:
+            resp = conn.send_and_receive(self.commands["s"] + self._get_key(key))
+
+        if resp in ("Yes", "No"):
+            if self.cache is not None:
+                self.cache.add(self.name, key)
+            return resp == "Yes"
+        raise BloomdError("Got response: %s" % resp)
+
+    def bulk(self, keys, max_keys=BATCH_MAX_KEYS, max_bytes=BATCH_MAX_BYTES, result_type="list"):
+        """
+        Performs a bulk set command, adds multiple keys in the filter.
+        Returns True/False for each key, if it was added.
+
+        :Parameters:
+            - keys : Any iterable of keys. It is consumed lazily, and split
+              into multiple commands which are pipelined on one connection.
+              A NumPy array or buffer protocol object of integers or fixed
+              width strings is formatted with vectorized operations. The
+              positive cache is skipped for arrays.
+            - max_keys (optional) : The maximum keys per command.
+            - max_bytes (optional) : The maximum size of each command.
+            - result_type (optional) : "list" for a list of bools, "bytearray"
+              for a bytearray of 0 or 1 per key, or "numpy" for a NumPy bool
+              array. The compact types are parsed without splitting the response.
+        """
+        if self.cache is None or _as_key_array(keys) is not None:
+            return self._batch("bulk", "b", keys, max_keys, max_bytes, result_type)
+
+        keys = list(keys)
+        results = self._batch("bulk", "b", keys, max_keys, max_bytes, result_type)
+        self.cache.add_many(self.name, keys)
+        return results
+
+    def _batch(self, name, verb, keys, max_keys, max_bytes, result_type):
+        "Sends a bulk or multi command, chunked as needed"
+        _check_result_type(result_type)
+        flags = result_type != "list"
+        prefix = self.commands[verb]
+        array = _as_key_array(keys)
+        if array is not None:
+            cmds = _array_commands(prefix, array, max_keys, max_bytes, self.hasher)
+        else:
+            cmds = _chunk_commands(prefix, self._get_keys(keys), max_keys, max_bytes)
+        results = bytearray() if flags else []
+        with self.pool.get_connection() as conn:
+            # Keep one chunk in flight while the next is sent
+            window = 2
+            cmds = ((name, cmd) for cmd in cmds)
+            responses = _execute_windowed(conn, cmds, window, flags, 2 * max_bytes)
+            with closing(responses):
+                for resp in responses:
+                    if isinstance(resp, BloomdError):
+                        raise resp
+                    results += resp
+        if flags:
+            return _flags_result(results, result_type)
+        return results
+
+    def drop(self):
+        "Deletes the filter from the server. This is permanent"
+        with self.pool.get_connection() as conn:
+            resp = conn.send_and_receive(self.commands["drop"])
+        if self.cache is not None:
+            self.cache.invalidate(self.name)
+        if self.stats_cache is not None:
+            self.stats_cache.invalidate(self.name)
+        if resp != "Done":
+            raise BloomdError("Got response: %s" % resp)
+
+    def close(self):
+        """
+        Closes the filter on the server.
+        """
+        with self.pool.get_connection() as conn:
+            resp = conn.send_and_receive(self.commands["close"])
+        if self.cache is not None:
+            self.cache.invalidate(self.name)
+        if resp != "Done":
+            raise BloomdError("Got response: %s" % resp)
+
+    def clear(self):
+        """
+        Clears the filter on the server.
+        """
+        with self.pool.get_connection() as conn:
+            resp = conn.send_and_receive(self.commands["clear"])
+        if self.cache is not None:
+            self.cache.invalidate(self.name)
+        if self.stats_cache is not None:
+            self.stats_cache.invalidate(self.name)
+        if resp != "Done":
+            raise BloomdError("Got response: %s" % resp)
+
+    def check(self, key):
+        "Checks if the key is contained in the filter."
+        return key in self
+
+    def __contains__(self, key):
+        "Checks if the key is contained in the filter."
+        if self.cache is not None and self.cache.contains(self.name, key):
+            return True
+
+        with self.pool.get_connection() as conn:
+            resp = conn.send_and_receive(self.commands["c"] + self._get_key(key))
+        if resp in ("Yes", "No"):
+            if resp == "Yes" and self.cache is not None:
+                self.cache.add(self.name, key)
+            return resp == "Yes"
+        raise BloomdError("Got response: %s" % resp)
+
+    def multi(self, keys, max_keys=BATCH_MAX_KEYS, max_bytes=BATCH_MAX_BYTES, result_type="list"):
+        """
+        Performs a multi command, checks for multiple keys in the filter.
+        Returns True/False for each key, if it is contained.
+        Takes the same parameters as `bulk`.
+        """
+        if self.cache is None or _as_key_array(keys) is not None:
+            return self._batch("multi", "m", keys, max_keys, max_bytes, result_type)
+
+        # Only ask the server about keys which are not cached
+        results = []
+        misses = []
+        for key in keys:
+            if self.cache.contains(self.name, key):
+                results.append(True)
+            else:
+                results.append(None)
+                misses.append(key)
+        if misses:
+            found = self._batch("multi", "m", misses, max_keys, max_bytes, "list")
+            self.cache.add_many(self.name, [key for key, res in zip(misses, found) if res])
+            found = iter(found)
+            results = [next(found) if res is None else res for res in results]
+
+        _check_result_type(result_type)
+        if result_type != "list":
+            return _flags_result(bytearray(results), result_type)
+        return results
+
+    def __len__(self):
+        "Returns the count of items in the filter."
+        return self.stats()["size"]
+
+    def info(self):
+        "Returns the info dictionary about the filter."
+        with self.pool.get_connection() as conn:
+            conn.send(self.commands["info"])
+            return conn.response_block_to_dict()
+
+    def stats(self):
+        """
+        Returns the info of the filter with the values parsed into ints,
+        floats and bools. It comes from the stats cache if there is one.
+        """
+        if self.stats_cache is not None:
+            return self.stats_cache.get(self.name)
+        return _parse_info(self.info())
+
+    def flush(self):
+        "Forces the filter to flush to disk"
+        with self.pool.get_connection() as conn:
+            resp = conn.send_and_receive(self.commands["flush"])
+        if resp != "Done":
+            raise BloomdError("Got response: %s" % resp)
+
+    def pipeline(self, result_type="list"):
+        """
+        Creates a BloomdPipeline for pipelining multiple queries.
+        `result_type` sets the type of the bulk and multi results, as
+        for `bulk`.
+        """
+        return BloomdPipeline(self.pool, self.name, self.hash_keys, self.cache, result_type)
+
+    def buffered(self, **kwargs):
+        """
+        Creates a BufferedBloomdFilter, which batches adds into bulk
+        commands. Takes the same keyword arguments as BufferedBloomdFilter.
+        """
+        return BufferedBloomdFilter(self, **kwargs)
+
+
+class BloomdFuture(object):
+    "The result of a command which will complete in the future"
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._error = None
+
+    def done(self):
+        "Checks if the command has completed"
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the command to complete, and returns its result or
+        raises its error. Raises BloomdError if `timeout` seconds pass.
+        """
+        if not self._event.wait(timeout) and not self._event.is_set():
+            raise BloomdError("Timed out waiting for result")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, func):
+        "Calls `func(future)` once the command completes"
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def set_result(self, result):
+        "Completes the command with a result"
+        self._result = result
+        self._complete()
+
+    def set_exception(self, error):
+        "Completes the command with an error"
+        self._error = error
+        self._complete()
+
+    def _complete(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception:
+                logging.getLogger("pybloomd.BloomdFuture").exception("Future callback failed!")
+
+
+class BufferedBloomdFilter(object):
+    """
+    Wraps a filter to buffer `add` calls, and send them as bulk commands.
+    A background thread flushes the buffer once it holds `max_keys` keys,
+    or its oldest key is `max_age` seconds old. Adds block once
+    `max_pending` keys are waiting to be sent.
+    """
+    def __init__(self, filter, max_keys=1000, max_age=0.1, max_pending=100000):
+        """
+        Creates a new BufferedBloomdFilter.
+
+        :Parameters:
+            - filter : The filter to add to. Any object with a `bulk` method,
+              such as a BloomdFilter or ShardedBloomdFilter.
+            - max_keys (optional) : Flush once this many keys are buffered.
+            - max_age (optional) : Flush once a key was buffered this many seconds ago.
+            - max_pending (optional) : The maximum keys buffered or being sent.
+        """
+        self.filter = filter
+        self.max_keys = max_keys
+        self.max_age = max_age
+        self.max_pending = max(max_pending, max_keys)
+        self.logger = logging.getLogger("pybloomd.BufferedBloomdFilter.%s" % getattr(filter, "name", ""))
+        self._reset()
+
+    def _reset(self):
+        "Resets the buffer state"
+        self.pid = os.getpid()
+        self._lock = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._keys = []
+        self._futures = []
+        self._oldest = None
+        self._pending = 0
+        self._closed = False
+        self._thread = None
+
+    def _checkpid(self):
+        # Keys buffered before a fork are sent by the parent
+        if self.pid != os.getpid():
+            self._reset()
+
+    def add(self, key, future=False, callback=None):
+        """
+        Buffers a key to be added to the filter.
+
+        :Parameters:
+            - key : The key to add
+            - future (optional) : If True, a BloomdFuture is returned which
+              resolves to True/False if the key was added.
+            - callback (optional) : Called with the BloomdFuture once the key is sent.
+        """
+        self._checkpid()
+        fut = None
+        if future or callback:
+            fut = BloomdFuture()
+            if callback:
+                fut.add_done_callback(callback)
+
+        with self._lock:
+            if self._closed:
+                raise BloomdError("Buffered filter is closed!")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            while self._pending >= self.max_pending:
+                self._lock.wait()
+
+            if not self._keys:
+                # Wake the flusher, which waits forever on an empty buffer
+                self._oldest = time.time()
+                self._lock.notify_all()
+            self._keys.append(key)
+            self._futures.append(fut)
+            self._pending += 1
+            if len(self._keys) >= self.max_keys:
+                self._lock.notify_all()
+        return fut
+
+    def _take(self):
+        "Takes the buffered keys. Must hold the lock."
+        keys, futures = self._keys, self._futures
+        self._keys, self._futures = [], []
+        self._oldest = None
+        return keys, futures
+
+    def _send(self, keys, futures):
+        "Sends keys with a bulk command, and resolves their futures"
+        try:
+            if keys:
+                results = self.filter.bulk(keys)
+                for fut, res in zip(futures, results):
+                    if fut is not None:
+                        fut.set_result(res)
+        except Exception as e:
+            self.logger.exception("Failed to add %d buffered keys!" % len(keys))
+            for fut in futures:
+                if fut is not None:
+                    fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending -= len(keys)
+                self._lock.notify_all()
+
+    def _run(self):
+        "Background thread flushing the buffer"
+        while True:
+            with self._lock:
+                while not self._closed:
+                    if len(self._keys) >= self.max_keys:
+                        break
+                    if self._keys:
+                        remaining = self._oldest + self.max_age - time.time()
+                        if remaining <= 0:
+                            break
+                        self._lock.wait(remaining)
+                    else:
+                        self._lock.wait()
+                if self._closed:
+                    return
+
+            with self._flush_lock:
+                with self._lock:
+                    keys, futures = self._take()
+                try:
+                    self._send(keys, futures)
+                except Exception:
+                    pass
+
+    def flush(self):
+        """
+        Sends every buffered key, and waits for the adds to complete.
+        Errors from the bulk command are raised.
+        """
+        self._checkpid()
+        with self._flush_lock:
+            with self._lock:
+                keys, futures = self._take()
+            self._send(keys, futures)
+
+    def close(self):
+        "Flushes the buffer, and stops the background thread"
+        self.flush()
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ConsistentHashRing(object):
+    """
+    Maps keys onto a set of nodes using consistent hashing. Each node
+    is placed on the ring many times, so keys spread evenly, and adding
+    or removing a node only moves the keys that belong to it.
+    """
+    def __init__(self, nodes=(), replicas=160):
+        """
+        Creates a new ConsistentHashRing.
+
+        :Parameters:
+            - nodes (optional) : The initial nodes, as strings.
+            - replicas (optional) : The number of points per node on the ring.
+        """
+        self.replicas = replicas
+        self.nodes = set()
+        self._points = []
+        self._owners = {}
+        for node in nodes:
+            self.add_node(node)
+
+    def _hash(self, value):
+        "Returns the position of a value on the ring"
+        return int(hashlib.md5(_encode(value)).hexdigest()[:16], 16)
+
+    def add_node(self, node):
+        "Adds a node to the ring"
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            point = self._hash("%s-%d" % (node, i))
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove_node(self, node):
+        "Removes a node from the ring"
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        for i in range(self.replicas):
+            point = self._hash("%s-%d" % (node, i))
+            if self._owners.get(point) == node:
+                del self._owners[point]
+                self._points.remove(point)
+
+    def get_node(self, key):
+        "Returns the node owning a key"
+        if not self._points:
+            raise BloomdError("Hash ring has no nodes!")
+        idx = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[self._points[idx]]
+
+    def get_nodes(self, key, count):
+        """
+        Returns up to `count` distinct nodes for a key, walking the ring
+        from its owner. Used to place copies of a key on several nodes.
+        """
+        if not self._points:
+            raise BloomdError("Hash ring has no nodes!")
+        count = min(count, len(self.nodes))
+        idx = bisect.bisect(self._points, self._hash(key))
+        nodes = []
+        for i in range(len(self._points)):
+            node = self._owners[self._points[(idx + i) % len(self._points)]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+
+class ShardedBloomdFilter(object):
+    """
+    Provides an interface to a logical filter which is split into one
+    physical filter per shard. Keys are assigned to a shard using
+    consistent hashing, and requests covering multiple shards are
+    sent to the servers concurrently.
+
+    Shards are identified by an id, which names the physical filter and
+    places it on the ring. Given a list of servers, the id of each shard
+    is its normalized "host:port", so "host" and "host:8673" are the same
+    shard. Given a dictionary of {shard id : server}, a shard keeps its
+    id when it is moved to another host, along with its data if the
+    filter is copied over.
+
+    Adding or removing a shard moves some keys to a new owner, which
+    has never seen them, so checks for those keys return False. To avoid
+    these false negatives during a change of layout, pass the old shards
+    as `previous`: keys not found in their new shard are also checked in
+    their old one. New keys are only added to their new shard.
+    """
+    def __init__(self, client, name, shards, hash_keys=False, previous=None):
+        """
+        Creates a new ShardedBloomdFilter object.
+
+        :Parameters:
+            - client : The BloomdClient to use
+            - name : The name of the logical filter
+            - shards : The servers holding a shard, as a list of servers
+              or a dictionary of {shard id : server}.
+            - hash_keys : Should the keys be hashed client side
+            - previous (optional) : The shards before a change of layout,
+              in the same form as `shards`.
+        """
+        self.client = client
+        self.name = name
+        self.hash_keys = hash_keys
+        self.hasher = KeyHasher.from_setting(hash_keys)
+        self.layout = dict(_shard_layout(shards))
+        self.ring = ConsistentHashRing(self.layout)
+        self.shards = self._make_shards(self.layout)
+        self.previous = None
+        self.previous_ring = None
+        self.previous_shards = {}
+        if previous is not None:
+            self.previous = dict(_shard_layout(previous))
+            self.previous_ring = ConsistentHashRing(self.previous)
+            self.previous_shards = self._make_shards(self.previous)
+
+    def _make_shards(self, layout):
+        "Returns a dictionary of {shard id : BloomdFilter} for a layout"
+        shards = {}
+        for shard, server in layout.items():
+            pool = self.client._server_pool(server)
+            shards[shard] = BloomdFilter(pool, self.shard_name(self.name, shard),
+                                         cache=self.client.positive_cache,
+                                         stats_cache=self.client.stats_cache)
+        return shards
+
+    @staticmethod
+    def shard_name(name, shard):
+        "Returns the name of the physical filter for a shard id"
+        return "%s.%s" % (name, re.sub(r"[^A-Za-z0-9_-]", "_", shard))
+
+    def _get_key(self, key):
+        """
+        Returns the key we should send to the server
+        """
+        if self.hasher:
+            return self.hasher(key)
+        return key
+
+    def _get_keys(self, keys):
+        "Returns an iterator of the keys we should send to the server"
+        if self.hasher:
+            return self.hasher.hash_iter(keys)
+        return keys
 
-        if resp == "Done":
-            return BloomdFilter(pool, name, self.hash_keys)
-        elif resp == "Exists":
-            return self[name]
-        else:
-            raise BloomdError("Got response: %s" % resp)
+    def _shard(self, key):
+        "Returns the shard filter for a key which was passed through _get_key"
+        return self.shards[self.ring.get_node(key)]
 
-    def __getitem__(self, name):
-        "Gets a BloomdFilter object based on the name."
-        pool = self._get_pool(name)
-        return BloomdFilter(pool, name, self.hash_keys)
+    def _moved(self, key):
+        """
+        Returns the previous shard filter for a key which was passed
+        through _get_key, or None if the key has not moved.
+        """
+        if self.previous_ring is None:
+            return None
+        old = self.previous_ring.get_node(key)
+        new = self.ring.get_node(key)
+        if old == new and self.previous[old] == self.layout[new]:
+            return None
+        return self.previous_shards[old]
 
-    def list_filters(self, inc_server=False):
+    def _scatter(self, method, keys, ring, shards):
         """
-        Lists all the available filters across all servers.
-        Returns a dictionary of {filter_name : filter_info}.
+        Splits keys which were passed through _get_keys by shard, and
+        calls a multi-key method on each shard concurrently. Returns the
+        results in the original key order.
+        """
+        groups = collections.defaultdict(list)
+        order = []
+        for key in keys:
+            shard = ring.get_node(key)
+            groups[shard].append(key)
+            order.append(shard)
 
-        :Parameters:
-            - inc_server (optional) : If true, the dictionary values
-               will be (server, filter_info) instead of filter_info.
+        ids = list(groups)
+        results = _fan_out(lambda shard: getattr(shards[shard], method)(groups[shard]), ids)
+        results = dict((shard, iter(res)) for shard, res in zip(ids, results))
+        return [next(results[shard]) for shard in order]
+
+    def _broadcast(self, method):
+        "Calls a method on every shard concurrently"
+        return _fan_out(lambda shard: getattr(self.shards[shard], method)(), list(self.shards))
+
+    def add(self, key):
         """
-        connections = []
-        for server in self.servers:
-            pool = self._server_pool(server)
-            connections.append(pool.get_connection())
+        Adds a new key to the filter. Returns True/False if the key was added.
+        """
+        key = self._get_key(key)
+        return self._shard(key).add(key)
 
-        # Send the list to all first
-        for conn in connections:
-            conn.send("list")
+    def bulk(self, keys):
+        "Performs a bulk set command, adds multiple keys in the filter"
+        return self._scatter("bulk", list(self._get_keys(keys)), self.ring, self.shards)
 
-        # Check response from all
-        responses = {}
-        for conn in connections:
-            resp = conn.readblock()
-            conn.release()
-            for line in resp:
-                name, info = line.split(" ", 1)
-                if inc_server:
-                    responses[name] = server, info
-                else:
-                    responses[name] = info
+    def check(self, key):
+        "Checks if the key is contained in the filter."
+        return key in self
 
-        return responses
+    def __contains__(self, key):
+        "Checks if the key is contained in the filter."
+        key = self._get_key(key)
+        if key in self._shard(key):
+            return True
+        old = self._moved(key)
+        return old is not None and key in old
+
+    def multi(self, keys):
+        "Performs a multi command, checks for multiple keys in the filter"
+        keys = list(self._get_keys(keys))
+        results = self._scatter("multi", keys, self.ring, self.shards)
+        if self.previous_ring is not None:
+            # Check the keys that were not found where they used to be
+            missed = [i for i, found in enumerate(results)
+                      if not found and self._moved(keys[i]) is not None]
+            if missed:
+                found = self._scatter("multi", [keys[i] for i in missed],
+                                      self.previous_ring, self.previous_shards)
+                for i, res in zip(missed, found):
+                    results[i] = res
+        return results
+
+    def drop(self):
+        "Deletes every shard from the servers. This is permanent"
+        self._broadcast("drop")
+
+    def close(self):
+        "Closes every shard on the servers."
+        self._broadcast("close")
+
+    def clear(self):
+        "Clears every shard on the servers."
+        self._broadcast("clear")
 
     def flush(self):
-        "Instructs all servers to flush to disk"
-        connections = []
-        for server in self.servers:
-            pool = self._server_pool(server)
-            connections.append(pool.get_connection())
+        "Forces every shard to flush to disk"
+        self._broadcast("flush")
 
-        # Send the flush to all first
-        for conn in connections:
-            conn.send("flush")
+    def __len__(self):
+        "Returns the count of items across all shards."
+        return sum(_fan_out(len, list(self.shards.values())))
 
-        # Check response from all
-        error = None
-        for conn in connections:
-            resp = conn.read()
-            conn.release()
+    def info(self):
+        "Returns a dictionary of {shard id : info dictionary} for every shard."
+        return dict(zip(self.shards, self._broadcast("info")))
 
-            if not error and resp != "Done":
-                args = (resp,) + conn.server
-                msg = "Got response: '%s' from '%s:%s'" % args
-                error = error or BloomdError(msg)
 
-        if error:
-            raise error
+class _WorkerPool(object):
+    """
+    Runs calls on reusable daemon threads, so latency sensitive requests
+    do not pay for starting a thread. A new worker is started whenever
+    none are idle, up to `max_workers`. Once they are all busy, callers
+    make the call themselves. This bounds the threads, and the pooled
+    connections held by calls left running after a timeout, and nested
+    calls cannot deadlock waiting for a worker.
+    """
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self._reset()
 
+    def _reset(self):
+        "Resets the pool state, forgetting all workers"
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._tasks = queue.Queue()
+        self._idle = 0
+        self._workers = 0
 
-class BloomdFilter(object):
-    "Provides an interface to a single Bloomd filter"
-    def __init__(self, pool, name, hash_keys=False):
+    def run(self, func, *args):
         """
-        Creates a new BloomdFilter object.
+        Calls `func(*args)` on a worker thread. Returns False without
+        calling it if every worker is busy.
+        """
+        if self.pid != os.getpid():
+            self._reset()
+        with self._lock:
+            start = False
+            if self._idle:
+                self._idle -= 1
+            elif self._workers < self.max_workers:
+                self._workers += 1
+                start = True
+            else:
+                return False
+        self._tasks.put((func, args))
+        if start:
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+        return True
+
+    def call(self, func, *args):
+        "Calls `func(*args)` on a worker thread, or on this one if all are busy"
+        if not self.run(func, *args):
+            func(*args)
+
+    def _work(self):
+        while True:
+            func, args = self._tasks.get()
+            try:
+                func(*args)
+            except Exception:
+                logging.getLogger("pybloomd.WorkerPool").exception("Worker call failed!")
+            with self._lock:
+                self._idle += 1
+
+
+_workers = _WorkerPool()
+
+
+class ReplicaLatency(object):
+    """
+    Tracks the recent latency of a replica: a moving average used to rank
+    replicas, and a histogram for percentiles whose counts are halved
+    every `window` samples, so old latencies fade out. Failures count
+    towards the average as a latency of `penalty` seconds.
+    """
+    def __init__(self, alpha=0.2, window=1000, penalty=1.0):
+        self.alpha = alpha
+        self.window = window
+        self.penalty = penalty
+        self.average = 0.0
+        self.histogram = LatencyHistogram()
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        "Records the latency of a successful request"
+        with self._lock:
+            self._update(latency)
+            hist = self.histogram
+            hist.record(latency)
+            if hist.count >= self.window:
+                hist.buckets = [count // 2 for count in hist.buckets]
+                hist.count = sum(hist.buckets)
+                hist.total /= 2
+
+    def failed(self):
+        "Records a failed request"
+        with self._lock:
+            self._update(self.penalty)
+
+    def _update(self, latency):
+        "Moves the average towards a latency. Must hold the lock."
+        if self.histogram.count or self.average:
+            self.average += self.alpha * (latency - self.average)
+        else:
+            self.average = latency
+
+    def percentile(self, pct, min_samples=20):
+        "Returns a latency percentile, or None if there are too few samples"
+        with self._lock:
+            if self.histogram.count < min_samples:
+                return None
+            return self.histogram.percentile(pct)
+
+
+class ReplicatedBloomdFilter(object):
+    """
+    Provides an interface to a logical filter which is copied onto several
+    servers. Writes go to every replica. Reads go to the replica with the
+    lowest recent latency, and if it has not answered within its
+    `hedge_percentile` latency, the read is also sent to the next fastest
+    replica and the first answer is used. Failed reads move on to the
+    next replica straight away.
+    """
+    def __init__(self, client, name, servers, hash_keys=False, hedge_percentile=95,
+                 hedge_delay=0.01, min_hedge_delay=0.001, write_quorum=None):
+        """
+        Creates a new ReplicatedBloomdFilter object.
 
         :Parameters:
-            - pool : The connection pool to use
-            - name : The name of the filter
+            - client : The BloomdClient to use
+            - name : The name of the logical filter
+            - servers : The servers holding a replica.
             - hash_keys : Should the keys be hashed client side
+            - hedge_percentile (optional) : The latency percentile of the fastest
+              replica after which a read is hedged.
+            - hedge_delay (optional) : The hedge delay used until a replica has
+              enough latency samples, in seconds.
+            - min_hedge_delay (optional) : The shortest hedge delay, in seconds.
+            - write_quorum (optional) : How many replicas a write must succeed on.
+              Defaults to all of them, since a replica missing writes could give
+              false negatives.
         """
-        self.pool = pool
+        self.client = client
         self.name = name
+        self.servers = list(servers)
+        if not self.servers:
+            raise ValueError("At least one replica is required!")
         self.hash_keys = hash_keys
+        self.hasher = KeyHasher.from_setting(hash_keys)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.write_quorum = write_quorum or len(self.servers)
+        self.replicas = {}
+        self.latency = {}
+        for server in self.servers:
+            pool = client._server_pool(server)
+            self.replicas[server] = BloomdFilter(pool, self.replica_name(name, server),
+                                                 cache=client.positive_cache,
+                                                 stats_cache=client.stats_cache)
+            self.latency[server] = ReplicaLatency()
+
+    @staticmethod
+    def replica_name(name, server):
+        "Returns the name of the physical filter for a replica on a server"
+        return ShardedBloomdFilter.shard_name(name, _server_id(server))
 
     def _get_key(self, key):
         """
         Returns the key we should send to the server
         """
-        if self.hash_keys:
-            return hashlib.sha1(key).hexdigest()
+        if self.hasher:
+            return self.hasher(key)
         return key
 
-    def add(self, key):
+    def _get_keys(self, keys):
+        "Returns a list of the keys we should send to the server"
+        if self.hasher:
+            return self.hasher.hash_many(list(keys))
+        return list(keys)
+
+    def ranked(self):
+        "Returns the servers ordered by their recent latency, fastest first"
+        return sorted(self.servers, key=lambda server: self.latency[server].average)
+
+    def _call(self, server, method, args):
+        "Calls a method on a replica, recording its latency"
+        start = _clock()
+        try:
+            result = getattr(self.replicas[server], method)(*args)
+        except Exception:
+            self.latency[server].failed()
+            raise
+        self.latency[server].record(_clock() - start)
+        return result
+
+    def _write(self, method, *args):
         """
-        Adds a new key to the filter. Returns True/False if the key was added.
+        Calls a method on every replica concurrently. Returns the results
+        of the replicas which succeeded, or raises BloomdFanOutError if
+        fewer than `write_quorum` did.
         """
-        with self.pool.get_connection() as conn:
-            resp = conn.send_and_receive("s %s %s" % (self.name, self._get_key(key)))
+        results, errors = _fan_out_partial(lambda server: self._call(server, method, args),
+                                           self.servers)
+        if len(results) < self.write_quorum:
+            raise BloomdFanOutError(results, errors)
+        return [results[server] for server in self.servers if server in results]
 
-        if resp in ("Yes", "No"):
-            return resp == "Yes"
-        raise BloomdError("Got response: %s" % resp)
+    def _read(self, method, *args):
+        """
+        Calls a method on the fastest replica, hedging to the next fastest
+        if it is slow, and failing over if it errors. Returns the first
+        result, or raises BloomdFanOutError if every replica failed.
+        """
+        ranked = self.ranked()
+        done = queue.Queue()
 
-    def bulk(self, keys):
-        "Performs a bulk set command, adds multiple keys in the filter"
-        command = ("b %s " % self.name) + " ".join([self._get_key(k) for k in keys])
+        def call(server):
+            try:
+                done.put((server, True, self._call(server, method, args)))
+            except Exception as e:
+                done.put((server, False, e))
 
-        with self.pool.get_connection() as conn:
-            resp = conn.send_and_receive(command)
+        _workers.call(call, ranked[0])
+        sent = 1
+        hedged = False
+        errors = {}
+        while True:
+            timeout = None
+            if not hedged and sent < len(ranked):
+                timeout = self._hedge_delay(ranked[0])
+            try:
+                server, ok, value = done.get(timeout=timeout)
+            except queue.Empty:
+                # The fastest replica is slow, ask the next one as well
+                hedged = True
+                _workers.call(call, ranked[sent])
+                sent += 1
+                continue
 
-        if resp.startswith("Yes") or resp.startswith("No"):
-            return [r == "Yes" for r in resp.split(" ")]
-        raise BloomdError("Got response: %s" % resp)
+            if ok:
+                return value
+            errors[server] = value
+            if sent < len(ranked):
+                _workers.call(call, ranked[sent])
+                sent += 1
+            elif len(errors) == sent:
+                raise BloomdFanOutError({}, errors)
 
-    def drop(self):
-        "Deletes the filter from the server. This is permanent"
-        with self.pool.get_connection() as conn:
-            resp = conn.send_and_receive("drop %s" % (self.name))
-        if resp != "Done":
-            raise BloomdError("Got response: %s" % resp)
+    def _hedge_delay(self, server):
+        "Returns how long to wait for a replica before hedging"
+        delay = self.latency[server].percentile(self.hedge_percentile)
+        if delay is None:
+            return self.hedge_delay
+        return max(self.min_hedge_delay, delay)
 
-    def close(self):
+    def add(self, key):
         """
-        Closes the filter on the server.
+        Adds a new key to the filter. Returns True if the key was added
+        to any replica.
         """
-        with self.pool.get_connection() as conn:
-            resp = conn.send_and_receive("close %s" % (self.name))
-        if resp != "Done":
-            raise BloomdError("Got response: %s" % resp)
+        return any(self._write("add", self._get_key(key)))
 
-    def clear(self):
-        """
-        Clears the filter on the server.
-        """
-        with self.pool.get_connection() as conn:
-            resp = conn.send_and_receive("clear %s" % (self.name))
-        if resp != "Done":
-            raise BloomdError("Got response: %s" % resp)
+    def bulk(self, keys):
+        "Performs a bulk set command, adds multiple keys in the filter"
+        results = self._write("bulk", self._get_keys(keys))
+        return [any(added) for added in zip(*results)]
 
     def check(self, key):
         "Checks if the key is contained in the filter."
@@ -471,49 +3568,41 @@ class BloomdFilter(object):
 
     def __contains__(self, key):
         "Checks if the key is contained in the filter."
-        with self.pool.get_connection() as conn:
-            resp = conn.send_and_receive("c %s %s" % (self.name, self._get_key(key)))
-        if resp in ("Yes", "No"):
-            return resp == "Yes"
-        raise BloomdError("Got response: %s" % resp)
+        return self._read("check", self._get_key(key))
 
     def multi(self, keys):
         "Performs a multi command, checks for multiple keys in the filter"
-        command = ("m %s " % self.name) + " ".join([self._get_key(k) for k in keys])
+        return self._read("multi", self._get_keys(keys))
 
-        with self.pool.get_connection() as conn:
-            resp = conn.send_and_receive(command)
-
-        if resp.startswith("Yes") or resp.startswith("No"):
-            return [r == "Yes" for r in resp.split(" ")]
-        raise BloomdError("Got response: %s" % resp)
+    def drop(self):
+        "Deletes every replica from the servers. This is permanent"
+        self._write("drop")
 
-    def __len__(self):
-        "Returns the count of items in the filter."
-        info = self.info()
-        return int(info["size"])
+    def close(self):
+        "Closes every replica on the servers."
+        self._write("close")
 
-    def info(self):
-        "Returns the info dictionary about the filter."
-        with self.pool.get_connection() as conn:
-            conn.send("info %s" % (self.name))
-            return self.conn.response_block_to_dict()
+    def clear(self):
+        "Clears every replica on the servers."
+        self._write("clear")
 
     def flush(self):
-        "Forces the filter to flush to disk"
-        with self.pool.get_connection() as conn:
-            resp = conn.send_and_receive("flush %s" % (self.name))
-        if resp != "Done":
-            raise BloomdError("Got response: %s" % resp)
+        "Forces every replica to flush to disk"
+        self._write("flush")
+
+    def __len__(self):
+        "Returns the count of items in the fastest replica."
+        return self._read("__len__")
 
-    def pipeline(self):
-        "Creates a BloomdPipeline for pipelining multiple queries"
-        return BloomdPipeline(self.pool, self.name, self.hash_keys)
+    def info(self):
+        "Returns a dictionary of {server : info dictionary} for every replica."
+        return dict(zip(self.servers, _fan_out(lambda server: self.replicas[server].info(),
+                                               self.servers)))
 
 
 class BloomdPipeline(object):
     "Provides an interface to a single Bloomd filter"
-    def __init__(self, pool, name, hash_keys=False):
+    def __init__(self, pool, name, hash_keys=False, cache=None, result_type="list"):
         """
         Creates a new BloomdPipeline object.
 
@@ -521,78 +3610,98 @@ class BloomdPipeline(object):
             - pool : The connection pool to use
             - name : The name of the filter
             - hash_keys : Should the keys be hashed client side
+            - cache (optional) : The PositiveCache of the filter, which is
+              invalidated when the filter is cleared, dropped or closed.
+            - result_type (optional) : The type of bulk and multi results,
+              one of "list", "bytearray" or "numpy".
         """
+        _check_result_type(result_type)
         self.pool = pool
         self.name = name
         self.hash_keys = hash_keys
+        self.hasher = KeyHasher.from_setting(hash_keys)
+        self.cache = cache
+        self.result_type = result_type
+        self.commands = _filter_commands(name)
         self.buf = []
 
     def _get_key(self, key):
         """
-        Returns the key we should send to the server
+        Returns the key we should send to the server, as bytes
         """
-        if self.hash_keys:
-            return hashlib.sha1(key).hexdigest()
-        return key
+        if self.hasher:
+            return _encode(self.hasher(key))
+        return _encode_key(key)
+
+    def _get_keys(self, keys):
+        "Returns a list of the keys we should send to the server"
+        if self.hasher:
+            keys = self.hasher.hash_iter(keys)
+        return list(keys)
 
     def add(self, key):
         """
         Adds a new key to the filter. Returns True/False if the key was added.
         """
-        self.buf.append(("add", "s %s %s" % (self.name, self._get_key(key))))
+        self.buf.append(("add", self.commands["s"] + self._get_key(key)))
         return self
 
     def bulk(self, keys):
         "Performs a bulk set command, adds multiple keys in the filter"
-        command = ("b %s " % self.name) + " ".join([self._get_key(k) for k in keys])
+        command = self.commands["b"] + _join_keys(self._get_keys(keys))
         self.buf.append(("bulk", command))
         return self
 
     def drop(self):
         "Deletes the filter from the server. This is permanent"
-        self.buf.append(("drop", "drop %s" % (self.name)))
+        self.buf.append(("drop", self.commands["drop"]))
         return self
 
     def close(self):
         """
         Closes the filter on the server.
         """
-        self.buf.append(("close", "close %s" % (self.name)))
+        self.buf.append(("close", self.commands["close"]))
         return self
 
     def clear(self):
         """
         Clears the filter on the server.
         """
-        self.buf.append(("clear", "clear %s" % (self.name)))
+        self.buf.append(("clear", self.commands["clear"]))
         return self
 
     def check(self, key):
         "Checks if the key is contained in the filter."
-        self.buf.append(("check", "c %s %s" % (self.name, self._get_key(key))))
+        self.buf.append(("check", self.commands["c"] + self._get_key(key)))
         return self
 
     def multi(self, keys):
         "Performs a multi command, checks for multiple keys in the filter"
-        command = ("m %s " % self.name) + " ".join([self._get_key(k) for k in keys])
+        command = self.commands["m"] + _join_keys(self._get_keys(keys))
         self.buf.append(("multi", command))
         return self
 
     def info(self):
         "Returns the info dictionary about the filter."
-        self.buf.append(("info", "info %s" % (self.name)))
+        self.buf.append(("info", self.commands["info"]))
         return self
 
     def flush(self):
         "Forces the filter to flush to disk"
-        self.buf.append(("flush", "flush %s" % (self.name)))
+        self.buf.append(("flush", self.commands["flush"]))
         return self
 
     def merge(self, pipeline):
         """
         Merges this pipeline with another pipeline. Commands from the
         other pipeline are appended to the commands of this pipeline.
+        Both pipelines must use the same connection pool, otherwise
+        the commands would be sent to the wrong server. Use
+        `BloomdClient.pipeline` to pipeline commands across servers.
         """
+        if pipeline.pool is not self.pool:
+            raise BloomdError("Cannot merge pipelines for different servers!")
         self.buf.extend(pipeline.buf)
         return self
 
@@ -602,46 +3711,561 @@ class BloomdPipeline(object):
         the server in the order issued, and responses are returned
         in appropriate order.
         """
-        with self.pool.get_connection() as conn:
-            # Send each command
-            buf = self.buf
-            self.buf = []
-            for name, cmd in buf:
-                conn.send(cmd)
-
-            # Get the responses
-            all_resp = []
-            for name, cmd in buf:
-                if name in ("bulk", "multi"):
-                    resp = conn.read()
-                    if resp.startswith("Yes") or resp.startswith("No"):
-                        all_resp.append([r == "Yes" for r in resp.split(" ")])
-                    else:
-                        all_resp.append(BloomdError("Got response: %s" % resp))
+        buf = self.buf
+        self.buf = []
+        flags = self.result_type != "list"
+        try:
+            with self.pool.get_connection() as conn:
+                all_resp = list(_execute_windowed(conn, buf, len(buf), flags))
+        finally:
+            self._invalidate(buf)
+        if flags:
+            all_resp = [self._convert(name, resp) for (name, cmd), resp in zip(buf, all_resp)]
+        return all_resp
 
-                elif name in ("add", "check"):
-                    resp = conn.read()
-                    if resp in ("Yes", "No"):
-                        all_resp.append(resp == "Yes")
-                    else:
-                        all_resp.append(BloomdError("Got response: %s" % resp))
+    def execute_iter(self, window=DEFAULT_WINDOW, max_bytes=DEFAULT_WINDOW_BYTES):
+        """
+        Executes the pipelined commands, returning a generator of the
+        responses in the order issued. Unlike `execute`, at most `window`
+        commands and roughly `max_bytes` bytes of commands are in flight
+        at once, and responses are read while later commands are still
+        being sent. This keeps memory flat, and keeps the server from
+        blocking on unread responses while we are still writing, as
+        long as the responses to the commands in flight fit in the
+        socket buffers.
+
+        :Parameters:
+            - window (optional) : The maximum number of commands awaiting
+              a response. Defaults to DEFAULT_WINDOW.
+            - max_bytes (optional) : The maximum number of command bytes
+              awaiting a response. A larger command is sent on its own.
+              Defaults to DEFAULT_WINDOW_BYTES.
+        """
+        if window < 1:
+            raise ValueError("Window must be at least 1!")
+        if max_bytes < 1:
+            raise ValueError("Max bytes must be at least 1!")
+        buf = self.buf
+        self.buf = []
+        return self._execute_iter(buf, window, max_bytes)
+
+    def _execute_iter(self, buf, window, max_bytes):
+        "Generator backing `execute_iter`"
+        flags = self.result_type != "list"
+        try:
+            with self.pool.get_connection() as conn:
+                responses = _execute_windowed(conn, buf, window, flags, max_bytes)
+                with closing(responses):
+                    for (name, cmd), resp in zip(buf, responses):
+                        yield self._convert(name, resp) if flags else resp
+        finally:
+            self._invalidate(buf)
 
+    def _convert(self, name, resp):
+        "Converts the flags of a bulk or multi response to the result type"
+        if name in ("bulk", "multi") and not isinstance(resp, BloomdError):
+            return _flags_result(resp, self.result_type)
+        return resp
+
+    def _invalidate(self, buf):
+        "Invalidates the cache if the commands could have removed keys"
+        if self.cache is None:
+            return
+        for name, cmd in buf:
+            if name in ("drop", "close", "clear"):
+                self.cache.invalidate(self.name)
+                return
+
+
+class BloomdClientPipeline(object):
+    """
+    Pipelines commands for any number of filters, across servers. Each
+    command is routed to the server holding its filter, the commands for
+    each server are executed over a single connection, and the servers
+    are executed concurrently.
+    """
+    def __init__(self, client, result_type="list"):
+        """
+        Creates a new BloomdClientPipeline object.
+
+        :Parameters:
+            - client : The BloomdClient to use
+            - result_type (optional) : The type of bulk and multi results,
+              one of "list", "bytearray" or "numpy".
+        """
+        _check_result_type(result_type)
+        self.client = client
+        self.result_type = result_type
+        self.pipes = {}
+        self.buf = []
+
+    def _command(self, filter, method, *args):
+        "Builds a command with the BloomdPipeline of the filter, and buffers it"
+        pipe = self.pipes.get(filter)
+        if pipe is None:
+            pipe = self.pipes[filter] = BloomdPipeline(None, filter, self.client.hash_keys,
+                                                       self.client.positive_cache,
+                                                       self.result_type)
+        getattr(pipe, method)(*args)
+        self.buf.append((filter, pipe.buf.pop()))
+        return self
+
+    def add(self, filter, key):
+        "Adds a new key to a filter. Returns True/False if the key was added."
+        return self._command(filter, "add", key)
+
+    def bulk(self, filter, keys):
+        "Performs a bulk set command, adds multiple keys in a filter"
+        return self._command(filter, "bulk", keys)
+
+    def check(self, filter, key):
+        "Checks if the key is contained in a filter."
+        return self._command(filter, "check", key)
+
+    def multi(self, filter, keys):
+        "Performs a multi command, checks for multiple keys in a filter"
+        return self._command(filter, "multi", keys)
+
+    def drop(self, filter):
+        "Deletes a filter from the server. This is permanent"
+        return self._command(filter, "drop")
+
+    def close(self, filter):
+        "Closes a filter on the server."
+        return self._command(filter, "close")
+
+    def clear(self, filter):
+        "Clears a filter on the server."
+        return self._command(filter, "clear")
+
+    def info(self, filter):
+        "Returns the info dictionary about a filter."
+        return self._command(filter, "info")
+
+    def flush(self, filter):
+        "Forces a filter to flush to disk"
+        return self._command(filter, "flush")
+
+    def merge(self, pipeline):
+        """
+        Merges another pipeline into this one. Either a BloomdPipeline
+        or a BloomdClientPipeline may be merged, and its commands are
+        appended to the commands of this pipeline.
+        """
+        if isinstance(pipeline, BloomdClientPipeline):
+            self.buf.extend(pipeline.buf)
+        else:
+            self.buf.extend((pipeline.name, entry) for entry in pipeline.buf)
+        return self
+
+    def execute(self, timeout=None):
+        """
+        Executes the pipelined commands, and returns the responses in the
+        order issued. Errors from the server are returned as BloomdErrors.
+        If any server fails, a BloomdFanOutError is raised with the list
+        of responses as its `results`, holding the server error in place
+        of each response from that server.
+
+        :Parameters:
+            - timeout (optional) : The time each server has to respond.
+        """
+        buf = self.buf
+        self.buf = []
+
+        # Route each command to its server, remembering its position
+        servers = {}
+        commands = collections.defaultdict(list)
+        positions = collections.defaultdict(list)
+        for idx, (filter, entry) in enumerate(buf):
+            server = servers.get(filter)
+            if server is None:
+                server = servers[filter] = self.client._get_server(filter)
+            commands[server].append(entry)
+            positions[server].append(idx)
+
+        flags = self.result_type != "list"
+        try:
+            responses, errors = self.client._execute_grouped(commands, timeout, flags)
+        finally:
+            self._invalidate(buf)
+
+        results = [None] * len(buf)
+        for server, resps in responses.items():
+            for idx, resp in zip(positions[server], resps):
+                if flags and buf[idx][1][0] in ("bulk", "multi") and not isinstance(resp, BloomdError):
+                    resp = _flags_result(resp, self.result_type)
+                results[idx] = resp
+        for server, error in errors.items():
+            for idx in positions[server]:
+                results[idx] = error
+        if errors:
+            raise BloomdFanOutError(results, errors)
+        return results
+
+    def _invalidate(self, buf):
+        "Invalidates the cache of filters which could have removed keys"
+        cache = self.client.positive_cache
+        if cache is None:
+            return
+        for filter, (name, cmd) in buf:
+            if name in ("drop", "close", "clear"):
+                cache.invalidate(filter)
+
+
+def _parse_server(server):
+    "Parses a 'host' or 'host:port' server string into a (host, port) tuple"
+    parts = server.split(":", 1)
+    if len(parts) == 2:
+        return parts[0], int(parts[1])
+    return parts[0], 8673
+
+
+def _server_id(server):
+    "Returns a normalized 'host:port' id for a server string"
+    if server.startswith(LOCAL_PREFIX):
+        return server
+    return "%s:%d" % _parse_server(server)
+
+
+def _shard_layout(shards):
+    """
+    Returns a sorted list of (shard id, server) pairs from either a list
+    of servers, identified by their normalized address, or a dictionary
+    of {shard id : server}.
+    """
+    if isinstance(shards, dict):
+        layout = list(shards.items())
+    else:
+        layout = [(_server_id(server), server) for server in shards]
+    if not layout:
+        raise ValueError("At least one shard is required!")
+    if len(dict(layout)) < len(layout):
+        raise ValueError("Shard ids must be unique!")
+    return sorted(layout)
+
+
+def _check_result_type(result_type):
+    "Checks that a bulk or multi result type is supported"
+    if result_type not in RESULT_TYPES:
+        raise ValueError("Unknown result type: %s" % result_type)
+    if result_type == "numpy" and numpy is None:
+        raise ImportError("NumPy is required for numpy results")
+
+
+def _parse_flags(resp):
+    """
+    Parses a bulk or multi response into a string with a 0 or 1 byte
+    per key. This is done with a single translate, instead of splitting
+    the response into a string per key.
+    """
+    if not isinstance(resp, bytes):
+        resp = resp.encode("ascii")
+    return resp.translate(_FLAG_TABLE, b"eso ")
+
+
+def _parse_info(info):
+    "Converts the values of an info dictionary into ints, floats and bools"
+    parsed = {}
+    for key, value in info.items():
+        if key == "in_memory":
+            parsed[key] = value == "1"
+            continue
+        try:
+            parsed[key] = int(value)
+        except ValueError:
+            try:
+                parsed[key] = float(value)
+            except ValueError:
+                parsed[key] = value
+    return parsed
+
+
+def _flags_result(flags, result_type):
+    "Converts the parsed flags to a bytearray or NumPy bool array"
+    flags = bytearray(flags)
+    if result_type == "numpy":
+        return numpy.frombuffer(flags, dtype=numpy.bool_)
+    return flags
+
+
+def _read_response(conn, name, flags=False):
+    """
+    Reads and parses the response to a single pipelined command.
+    Errors from the server are returned as BloomdError instances.
+    If `flags` is True, bulk and multi results are left as the
+    string of 0 or 1 bytes from `_parse_flags`.
+    """
+    if name in ("bulk", "multi"):
+        ok, resp = conn.read_flags()
+        if ok:
+            if flags:
+                return resp
+            return list(map(bool, bytearray(resp)))
+        return BloomdError("Got response: %s" % resp)
+
+    elif name in ("add", "check"):
+        resp = conn.read()
+        if resp in ("Yes", "No"):
+            return resp == "Yes"
+        return BloomdError("Got response: %s" % resp)
+
+    elif name in ("drop", "close", "clear", "flush"):
+        resp = conn.read()
+        if resp == "Done":
+            return True
+        return BloomdError("Got response: %s" % resp)
+
+    elif name == "info":
+        try:
+            return conn.response_block_to_dict()
+        except BloomdError as e:
+            return e
+
+    raise Exception("Unknown command! Command: %s" % name)
+
+
+def _fan_out_partial(func, items, timeout=None):
+    """
+    Calls `func` on each item concurrently, on the shared worker threads.
+    Items must be unique. Each call has `timeout` seconds to finish, so
+    one slow call does not hold up the results of the others. Returns a
+    tuple of dictionaries ({item : result}, {item : error}). Calls which
+    did not finish in time get a BloomdError, and are left to complete
+    in the background. Once every worker is busy, the remaining calls
+    are made on this thread, and are not bounded by the timeout.
+    """
+    items = list(items)
+    results = {}
+    errors = {}
+    if len(items) == 1 and timeout is None:
+        try:
+            results[items[0]] = func(items[0])
+        except Exception as e:
+            errors[items[0]] = e
+        return results, errors
+
+    finished = queue.Queue()
+
+    def run(item):
+        try:
+            finished.put((item, True, func(item)))
+        except Exception as e:
+            finished.put((item, False, e))
+
+    for item in items:
+        _workers.call(run, item)
+
+    deadline = None if timeout is None else time.time() + timeout
+    for _ in items:
+        try:
+            if deadline is None:
+                item, ok, value = finished.get()
+            else:
+                item, ok, value = finished.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            break
+        if ok:
+            results[item] = value
+        else:
+            errors[item] = value
+
+    for item in items:
+        if item not in results and item not in errors:
+            errors[item] = BloomdError("Timed out after %s seconds" % timeout)
+    return results, errors
+
+
+def _fan_out(func, items, timeout=None):
+    """
+    Calls `func` on each item concurrently, and returns the results in
+    order. If any call fails, the error of the first is raised once all
+    calls have finished or timed out.
+    """
+    items = list(items)
+    results, errors = _fan_out_partial(func, items, timeout)
+    for item in items:
+        if item in errors:
+            raise errors[item]
+    return [results[item] for item in items]
+
+
+def _chunk_commands(prefix, keys, max_keys, max_bytes):
+    """
+    Splits an iterable of keys into bytes commands starting with `prefix`.
+    Each command holds at most `max_keys` keys, and is at most `max_bytes`
+    long unless a single key is larger. Text keys are measured in
+    characters, so non-ASCII keys may go over. The keys of each command
+    are encoded and joined at once by `_join_keys`.
+    """
+    chunk = []
+    size = len(prefix)
+    for key in keys:
+        if chunk and (len(chunk) >= max_keys or size + len(key) >= max_bytes):
+            yield prefix + _join_keys(chunk)
+            chunk = []
+            size = len(prefix)
+        chunk.append(key)
+        size += len(key) + 1
+    if chunk:
+        yield prefix + _join_keys(chunk)
+
+
+def _as_key_array(keys):
+    """
+    Returns keys provided as a NumPy array or a buffer protocol object
+    as a NumPy array, or None for any other iterable of keys.
+    """
+    if numpy is not None and isinstance(keys, numpy.ndarray):
+        return keys
+    if isinstance(keys, (bytes, _text_type, list, tuple)):
+        return None
+    try:
+        view = memoryview(keys)
+    except TypeError:
+        return None
+    if numpy is None:
+        raise ImportError("NumPy is required for buffer protocol keys")
+    return numpy.asarray(view)
 
-                elif name in ("drop", "close", "clear", "flush"):
-                    resp = conn.read()
-                    if resp == "Done":
-                        all_resp.append(True)
-                    else:
-                        all_resp.append(BloomdError("Got response: %s" % resp))
-
-                elif name == "info":
-                    try:
-                        resp = conn.response_block_to_dict()
-                        all_resp.append(resp)
-                    except BloomdError, e:
-                        all_resp.append(e)
-                else:
-                    raise Exception("Unknown command! Command: %s" % name)
 
-            return all_resp
+def _string_rows(keys):
+    """
+    Returns an array of fixed width byte strings as a matrix with a row
+    of bytes per key, checking that the keys are valid.
+    """
+    keys = numpy.ascontiguousarray(keys)
+    rows = keys.view(numpy.uint8).reshape(len(keys), keys.dtype.itemsize)
+    if (rows[:, 0] == 0).any():
+        raise ValueError("Keys must not be empty!")
+    if ((rows == ord(" ")) | (rows == ord("\n"))).any():
+        raise ValueError("Keys must not contain spaces or newlines!")
+    return rows
 
+
+def _integer_rows(keys):
+    """
+    Formats an array of integers in decimal, as a matrix with a row of
+    null padded digits per key. Every key is formatted at once, with one
+    pass over the array per digit.
+    """
+    if keys.dtype.kind == "u":
+        values = keys.astype(numpy.uint64)
+    else:
+        values = numpy.abs(keys.astype(numpy.int64)).astype(numpy.uint64)
+    negative = keys < 0
+    width = len(str(int(values.max()))) + int(negative.any()) if len(keys) else 1
+
+    rows = numpy.zeros((len(keys), width), dtype=numpy.uint8)
+    for col in range(width - 1, -1, -1):
+        digits = (values % 10).astype(numpy.uint8) + ord("0")
+        if col == width - 1:
+            rows[:, col] = digits
+        else:
+            rows[:, col] = numpy.where(values > 0, digits, 0)
+        values //= 10
+
+    if negative.any():
+        # The sign goes just before the first digit
+        first = width - numpy.count_nonzero(rows, axis=1)
+        idx = numpy.nonzero(negative)[0]
+        rows[idx, first[idx] - 1] = ord("-")
+    return rows
+
+
+def _join_rows(rows):
+    """
+    Joins a matrix with a row of null padded bytes per key into a single
+    string of space separated keys, without a Python object per key.
+    """
+    count, width = rows.shape
+    padded = numpy.empty((count, width + 1), dtype=numpy.uint8)
+    padded[:, :width] = rows
+    padded[:, width] = ord(" ")
+    data = padded.ravel()
+    return data[data != 0][:-1].tobytes()
+
+
+def _array_commands(prefix, keys, max_keys, max_bytes, hasher=None):
+    """
+    Builds bulk or multi commands starting with `prefix` from a 1-D NumPy
+    array of integers or strings. Each slice of the array is formatted
+    and joined with vectorized operations. Keys are passed through the
+    `hasher` when provided, which requires a Python string per key.
+    """
+    if keys.ndim != 1:
+        raise ValueError("Key arrays must be 1-dimensional!")
+    kind = keys.dtype.kind
+    if kind in "iu":
+        info = numpy.iinfo(keys.dtype)
+        width = max(len(str(info.min)), len(str(info.max)))
+    elif kind in "SU":
+        width = keys.dtype.itemsize
+    else:
+        raise TypeError("Key arrays must hold integers or strings, not %s" % keys.dtype)
+
+    step = max(1, min(max_keys, (max_bytes - len(prefix)) // (width + 1)))
+    for start in range(0, len(keys), step):
+        chunk = keys[start:start + step]
+        if kind == "U":
+            chunk = numpy.char.encode(chunk, "utf-8")
+
+        if hasher:
+            if kind in "iu":
+                chunk = chunk.astype("S%d" % width)
+            yield prefix + _join_keys(hasher.hash_many(chunk.tolist()))
+        elif kind in "iu":
+            yield prefix + _join_rows(_integer_rows(chunk))
+        else:
+            yield prefix + _join_rows(_string_rows(chunk))
+
+
+def _execute_windowed(conn, commands, window, flags=False, max_bytes=DEFAULT_WINDOW_BYTES):
+    """
+    Sends an iterable of (name, cmd) pairs over a connection, yielding
+    the parsed responses in order. Commands are written in batches once
+    no more than half of `window` commands and half of `max_bytes`
+    bytes are in flight, so at most `window` responses are ever
+    outstanding. A command larger than `max_bytes` is only sent once
+    nothing else is in flight. If the generator is abandoned or
+    fails with commands in flight, the connection is dropped since its
+    remaining responses can no longer be matched up. `flags` is
+    passed through to `_read_response`.
+    """
+    commands = iter(commands)
+    in_flight = collections.deque()
+    in_flight_bytes = 0
+    pending = None
+    exhausted = False
+    try:
+        while True:
+            if (not exhausted and len(in_flight) <= window // 2
+                    and in_flight_bytes <= max_bytes // 2):
+                batch = []
+                size = in_flight_bytes
+                while len(in_flight) + len(batch) < window:
+                    if pending is None:
+                        pending = next(commands, None)
+                        if pending is None:
+                            exhausted = True
+                            break
+                    cmd_size = len(pending[1]) + 1
+                    if (in_flight or batch) and size + cmd_size > max_bytes:
+                        break
+                    batch.append(pending)
+                    size += cmd_size
+                    pending = None
+                if batch:
+                    conn.send_many([cmd for name, cmd in batch])
+                    in_flight.extend((name, len(cmd) + 1) for name, cmd in batch)
+                    in_flight_bytes = size
+
+            if not in_flight:
+                break
+            name, cmd_size = in_flight[0]
+            resp = _read_response(conn, name, flags)
+            in_flight.popleft()
+            in_flight_bytes -= cmd_size
+            yield resp
+    finally:
+        if in_flight:
+            conn.disconnect()
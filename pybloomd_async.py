@@ -0,0 +1,651 @@
+"""
+This module implements an asyncio client for the BloomD server.
+It mirrors the interface of `pybloomd`, but every network operation
+is a coroutine. Requires Python 3.5 or newer.
+"""
+__all__ = ["AsyncBloomdConnection", "AsyncConnectionPool", "AsyncBloomdClient",
+           "AsyncBloomdFilter", "AsyncBloomdPipeline"]
+import asyncio
+import collections
+import errno
+import logging
+import time
+
+from pybloomd import (BATCH_MAX_BYTES, BATCH_MAX_KEYS, BloomdError, KeyHasher, _chunk_commands,
+                      _encode, _encode_key, _filter_commands, _join_keys, _parse_server)
+
+# Socket errors that are retried by re-connecting to the server
+RETRY_ERRNOS = (errno.ECONNRESET, errno.ECONNREFUSED, errno.EAGAIN, errno.EHOSTUNREACH, errno.EPIPE)
+
+
+def _retryable(e):
+    "Checks if an error raised by the transport should be retried"
+    return isinstance(e, ConnectionError) or getattr(e, "errno", None) in RETRY_ERRNOS
+
+
+class AsyncBloomdConnection(object):
+    """
+    Provides an asyncio interface to a server connection. Any number of
+    commands may be in flight at once: bloomd answers strictly in order,
+    so responses are matched to a FIFO of pending futures by a single
+    reader task.
+    """
+    def __init__(self, server, timeout=None, attempts=3, pool=None, write_buffer_limit=2 ** 16,
+                 read_limit=2 ** 24):
+        """
+        Creates a new asyncio Bloomd Connection.
+
+        :Parameters:
+            - server: Provided as a string, either as "host" or "host:port".
+                      Uses the default port of 8673 if none is provided.
+            - timeout: (Optional) Timeout for connecting and for each response.
+            - attempts (optional): Maximum retry attempts on errors. Defaults to 3.
+            - write_buffer_limit (optional): Once this many bytes are buffered
+              for writing, senders wait for the transport to drain.
+            - read_limit (optional): The longest response line which can be
+              read. Defaults to 16MB, enough for a multi of millions of keys.
+        """
+        self.server = _parse_server(server)
+        self.timeout = timeout
+        self.attempts = attempts
+        self.pool = pool
+        self.write_buffer_limit = write_buffer_limit
+        self.read_limit = read_limit
+        self.reader = None
+        self.writer = None
+        self.pending = collections.deque()
+        self._reader_task = None
+        self._connect_lock = None
+        self._drain_lock = None
+        self.logger = logging.getLogger("pybloomd_async.AsyncBloomdConnection.%s.%d" % self.server)
+
+    @property
+    def in_flight(self):
+        "Returns the number of commands awaiting a response"
+        return len(self.pending)
+
+    async def connect(self):
+        "Connects to the server, if not already connected"
+        if self.writer is not None:
+            return
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.writer is not None:
+                return
+            coro = asyncio.open_connection(*self.server, limit=self.read_limit)
+            if self.timeout:
+                reader, writer = await asyncio.wait_for(coro, self.timeout)
+            else:
+                reader, writer = await coro
+            self.reader, self.writer = reader, writer
+            self.pending = collections.deque()
+            self._reader_task = asyncio.ensure_future(self._read_responses(reader, self.pending))
+
+    async def _readline(self, reader):
+        "Reads a single line, raising ConnectionResetError on EOF"
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("Connection closed by bloomd server")
+        return line.decode("utf-8").rstrip("\r\n")
+
+    async def _read_responses(self, reader, pending):
+        """
+        Reader task for a single socket. Reads responses in order and
+        resolves the oldest pending future with each one.
+        """
+        try:
+            while True:
+                line = await self._readline(reader)
+                if not pending:
+                    raise BloomdError("Got unexpected response: %s" % line)
+                future, block = pending[0]
+
+                result = line
+                if block:
+                    if line != "START":
+                        result = BloomdError("Did not get block start (START)! Got '%s'!" % line)
+                    else:
+                        result = []
+                        while True:
+                            line = await self._readline(reader)
+                            if line == "END":
+                                break
+                            result.append(line)
+
+                pending.popleft()
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+        except asyncio.CancelledError:
+            self._reset(pending, ConnectionAbortedError("Connection closed"))
+            raise
+        except Exception as e:
+            self.logger.exception("Failed to read response from bloomd server!")
+            self._reset(pending, e)
+
+    def _reset(self, pending, exc):
+        "Drops the socket owning `pending`, failing all of its commands"
+        if pending is self.pending:
+            if self.writer is not None:
+                self.writer.close()
+            self.reader = self.writer = None
+            self.pending = collections.deque()
+        while pending:
+            future, _ = pending.popleft()
+            if not future.done():
+                future.set_exception(exc)
+
+    async def send_many(self, commands):
+        """
+        Sends multiple commands in a single write. Commands are provided
+        as (cmd, block) pairs, where `block` is True when the response is
+        a START/END block. Text commands are sent as UTF-8. Returns a list
+        of futures for the responses.
+        """
+        await self.connect()
+        loop = asyncio.get_event_loop()
+        futures = []
+        for cmd, block in commands:
+            future = loop.create_future()
+            self.pending.append((future, block))
+            futures.append(future)
+        self.writer.write(b"".join(_encode(cmd) + b"\n" for cmd, _ in commands))
+
+        # Apply back-pressure if the server is not keeping up
+        if self.writer.transport.get_write_buffer_size() > self.write_buffer_limit:
+            if self._drain_lock is None:
+                self._drain_lock = asyncio.Lock()
+            async with self._drain_lock:
+                if self.writer is not None:
+                    await self.writer.drain()
+        return futures
+
+    async def wait(self, future):
+        "Waits for the response to a command, applying the timeout"
+        if self.timeout:
+            return await asyncio.wait_for(future, self.timeout)
+        return await future
+
+    async def send_and_receive(self, cmd, block=False):
+        """
+        Sends a command and waits for the response, performing a retry
+        if necessary. Returns a line, or a list of lines if `block` is True.
+        """
+        for attempt in range(self.attempts):
+            try:
+                future, = await self.send_many([(cmd, block)])
+                return await self.wait(future)
+            except OSError as e:
+                if not _retryable(e):
+                    raise
+                self.logger.exception("Failed to send command to bloomd server! Attempt: %d" % attempt)
+
+        self.logger.critical("Failed to send command to bloomd server after %d attempts!" % self.attempts)
+        raise EnvironmentError("Cannot contact bloomd server!")
+
+    async def response_block_to_dict(self, cmd):
+        """
+        Convenience wrapper around `send_and_receive` to convert a block
+        output into a dictionary by splitting on spaces, and using the
+        first column as the key, and the remainder as the value.
+        """
+        resp_lines = await self.send_and_receive(cmd, block=True)
+        return dict(tuple(l.split(" ", 1)) for l in resp_lines)
+
+    async def close(self):
+        "Disconnects from the Bloomd server"
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        self._reset(self.pending, ConnectionAbortedError("Connection closed"))
+
+
+class AsyncConnectionPool(object):
+    """
+    Connection pool for the asyncio client. Connections are shared rather
+    than checked out, so a small number of sockets can serve any number
+    of concurrent coroutines.
+    """
+    def __init__(self, connection_class=AsyncBloomdConnection, max_connections=2,
+                 max_in_flight=128, **connection_kwargs):
+        """
+        Creates a new AsyncConnectionPool.
+
+        :Parameters:
+            - max_connections (optional) : Maximum number of sockets. Defaults to 2.
+            - max_in_flight (optional) : A new socket is opened once every
+              existing socket has this many commands in flight.
+        """
+        self.connection_class = connection_class
+        self.connection_kwargs = connection_kwargs
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self.connections = []
+
+    def get_connection(self):
+        "Returns the least loaded connection, opening another if all are busy"
+        conn = None
+        if self.connections:
+            conn = min(self.connections, key=lambda c: c.in_flight)
+        if conn is None or (conn.in_flight >= self.max_in_flight and
+                            len(self.connections) < self.max_connections):
+            conn = self.make_connection()
+            self.connections.append(conn)
+        return conn
+
+    def make_connection(self):
+        "Create a new connection"
+        return self.connection_class(pool=self, **self.connection_kwargs)
+
+    async def disconnect(self):
+        "Disconnects all connections in the pool"
+        for conn in self.connections:
+            await conn.close()
+        self.connections = []
+
+
+class AsyncBloomdClient(object):
+    "Provides an asyncio client abstraction around the BloomD interface."
+    def __init__(self, servers, timeout=None, hash_keys=False, max_connections=2, max_in_flight=128):
+        """
+        Creates a new asyncio BloomD client.
+
+        :Parameters:
+            - servers : A list of servers, which are provided as strings in the "host" or "host:port".
+            - timeout: (Optional) A timeout to use, defaults to no timeout.
+            - hash_keys: (Optional) Should keys be hashed before sending to bloomd. Defaults to False.
+              Accepts the same values as `pybloomd.BloomdClient`.
+            - max_connections: (Optional) Maximum sockets per server. Defaults to 2.
+            - max_in_flight: (Optional) Commands in flight per socket before
+              another socket is opened. Defaults to 128.
+        """
+        if len(servers) == 0:
+            raise ValueError("Must provide at least 1 server!")
+        self.servers = servers
+        self.timeout = timeout
+        self.server_pools = {}
+        self.server_info = None
+        self.info_time = 0
+        self.hash_keys = hash_keys
+        self.max_connections = max_connections
+        self.max_in_flight = max_in_flight
+        self._refresh = None
+
+    def _server_pool(self, server):
+        "Returns the connection pool for a server"
+        if server not in self.server_pools:
+            self.server_pools[server] = AsyncConnectionPool(server=server, timeout=self.timeout,
+                                                            max_connections=self.max_connections,
+                                                            max_in_flight=self.max_in_flight)
+        return self.server_pools[server]
+
+    async def _refresh_info(self):
+        """
+        Reloads the filter locations. Concurrent callers share a single
+        reload instead of each listing every server.
+        """
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self.list_filters(inc_server=True))
+        refresh = self._refresh
+        try:
+            self.server_info = await refresh
+            self.info_time = time.time()
+        finally:
+            if self._refresh is refresh:
+                self._refresh = None
+
+    async def _get_pool(self, filter, strict=True, explicit_server=None):
+        """
+        Gets a connection pool for a server which is able to service a
+        filter. See `pybloomd.BloomdClient._get_pool`.
+        """
+        # Force checking if we have no info or 5 minutes has elapsed
+        if not self.server_info or time.time() - self.info_time > 300:
+            await self._refresh_info()
+
+        # Check if this filter is in a known location
+        if filter in self.server_info:
+            return self._server_pool(self.server_info[filter][0])
+
+        # Possibly old data? Reload
+        await self._refresh_info()
+        if filter in self.server_info:
+            return self._server_pool(self.server_info[filter][0])
+
+        # Check if this is fatal
+        if strict:
+            raise BloomdError("Filter does not exist!")
+
+        # We have an explicit server provided to us, use that
+        if explicit_server:
+            return self._server_pool(explicit_server)
+
+        # Select the server with the minimal set count
+        counts = dict((server, 0) for server in self.servers)
+        for server, info in self.server_info.values():
+            counts[server] += 1
+        counts = sorted((count, srv) for srv, count in counts.items())
+        return self._server_pool(counts[0][1])
+
+    async def create_filter(self, name, capacity=None, prob=None, in_memory=False, server=None):
+        """
+        Creates a new filter on the BloomD server and returns an
+        AsyncBloomdFilter to interface with it. See
+        `pybloomd.BloomdClient.create_filter` for the parameters.
+        """
+        if prob and not capacity:
+            raise ValueError("Must provide size with probability!")
+
+        pool = await self._get_pool(name, strict=False, explicit_server=server)
+
+        cmd = "create %s" % name
+        if capacity:
+            cmd += " capacity=%d" % capacity
+        if prob:
+            cmd += " prob=%f" % prob
+        if in_memory:
+            cmd += " in_memory=1"
+
+        resp = await pool.get_connection().send_and_receive(cmd)
+        if resp == "Done":
+            return AsyncBloomdFilter(pool, name, self.hash_keys)
+        elif resp == "Exists":
+            return await self.get_filter(name)
+        else:
+            raise BloomdError("Got response: %s" % resp)
+
+    async def get_filter(self, name):
+        "Gets an AsyncBloomdFilter object based on the name."
+        pool = await self._get_pool(name)
+        return AsyncBloomdFilter(pool, name, self.hash_keys)
+
+    async def list_filters(self, inc_server=False):
+        """
+        Lists all the available filters across all servers, querying
+        the servers concurrently. Returns a dictionary of
+        {filter_name : filter_info}.
+
+        :Parameters:
+            - inc_server (optional) : If true, the dictionary values
+               will be (server, filter_info) instead of filter_info.
+        """
+        blocks = await asyncio.gather(*[
+            self._server_pool(server).get_connection().send_and_receive("list", block=True)
+            for server in self.servers])
+
+        responses = {}
+        for server, resp in zip(self.servers, blocks):
+            for line in resp:
+                name, info = line.split(" ", 1)
+                if inc_server:
+                    responses[name] = server, info
+                else:
+                    responses[name] = info
+        return responses
+
+    async def flush(self):
+        "Instructs all servers to flush to disk"
+        pools = [self._server_pool(server) for server in self.servers]
+        resps = await asyncio.gather(*[pool.get_connection().send_and_receive("flush")
+                                       for pool in pools])
+        for server, resp in zip(self.servers, resps):
+            if resp != "Done":
+                raise BloomdError("Got response: '%s' from '%s'" % (resp, server))
+
+    async def close(self):
+        "Closes all connections to the servers"
+        for pool in self.server_pools.values():
+            await pool.disconnect()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+def _get_key(key, hasher):
+    "Returns the key we should send to the server"
+    if hasher:
+        return hasher(key)
+    return key
+
+
+def _get_keys(keys, hasher):
+    "Returns a list of the keys we should send to the server"
+    if hasher:
+        return hasher.hash_many(list(keys))
+    return list(keys)
+
+
+def _key_command(prefix, key, hasher):
+    "Returns the bytes command for a verb prefix and a single key"
+    return prefix + _encode_key(_get_key(key, hasher))
+
+
+def _keys_command(prefix, keys, hasher):
+    "Returns the bytes command for a verb prefix and multiple keys"
+    return prefix + _join_keys(_get_keys(keys, hasher))
+
+
+def _parse_response(name, resp):
+    "Converts the response to a command into its result, raising on errors"
+    if name in ("bulk", "multi"):
+        if resp.startswith("Yes") or resp.startswith("No"):
+            return [r == "Yes" for r in resp.split(" ")]
+    elif name in ("add", "check"):
+        if resp in ("Yes", "No"):
+            return resp == "Yes"
+    elif name in ("drop", "close", "clear", "flush"):
+        if resp == "Done":
+            return True
+    elif name == "info":
+        return dict(tuple(l.split(" ", 1)) for l in resp)
+    else:
+        raise Exception("Unknown command! Command: %s" % name)
+    raise BloomdError("Got response: %s" % resp)
+
+
+class AsyncBloomdFilter(object):
+    "Provides an asyncio interface to a single Bloomd filter"
+    def __init__(self, pool, name, hash_keys=False):
+        """
+        Creates a new AsyncBloomdFilter object.
+
+        :Parameters:
+            - pool : The AsyncConnectionPool to use
+            - name : The name of the filter
+            - hash_keys : Should the keys be hashed client side
+        """
+        self.pool = pool
+        self.name = name
+        self.hash_keys = hash_keys
+        self.hasher = KeyHasher.from_setting(hash_keys)
+        self.commands = _filter_commands(name)
+
+    async def _execute(self, name, cmd):
+        "Sends a single command and parses the response"
+        conn = self.pool.get_connection()
+        resp = await conn.send_and_receive(cmd, block=(name == "info"))
+        return _parse_response(name, resp)
+
+    async def add(self, key):
+        """
+        Adds a new key to the filter. Returns True/False if the key was added.
+        """
+        return await self._execute("add", _key_command(self.commands["s"], key, self.hasher))
+
+    async def _batch(self, name, verb, keys, max_keys, max_bytes):
+        """
+        Sends a bulk or multi command, split into chunks as in
+        `pybloomd.BloomdFilter.bulk`. The chunks are sent in a single
+        write, and their results are joined in order.
+        """
+        keys = _get_keys(keys, self.hasher)
+        cmds = list(_chunk_commands(self.commands[verb], keys, max_keys, max_bytes))
+        if not cmds:
+            return []
+        conn = self.pool.get_connection()
+        futures = await conn.send_many([(cmd, False) for cmd in cmds])
+        results = []
+        for future in futures:
+            results += _parse_response(name, await conn.wait(future))
+        return results
+
+    async def bulk(self, keys, max_keys=BATCH_MAX_KEYS, max_bytes=BATCH_MAX_BYTES):
+        """
+        Performs a bulk set command, adds multiple keys in the filter.
+        Large key lists are split into commands of at most `max_keys`
+        keys and around `max_bytes` bytes.
+        """
+        return await self._batch("bulk", "b", keys, max_keys, max_bytes)
+
+    async def drop(self):
+        "Deletes the filter from the server. This is permanent"
+        await self._execute("drop", self.commands["drop"])
+
+    async def close(self):
+        "Closes the filter on the server."
+        await self._execute("close", self.commands["close"])
+
+    async def clear(self):
+        "Clears the filter on the server."
+        await self._execute("clear", self.commands["clear"])
+
+    async def check(self, key):
+        "Checks if the key is contained in the filter."
+        return await self._execute("check", _key_command(self.commands["c"], key, self.hasher))
+
+    async def multi(self, keys, max_keys=BATCH_MAX_KEYS, max_bytes=BATCH_MAX_BYTES):
+        """
+        Performs a multi command, checks for multiple keys in the filter.
+        Large key lists are split as in `bulk`.
+        """
+        return await self._batch("multi", "m", keys, max_keys, max_bytes)
+
+    async def size(self):
+        "Returns the count of items in the filter."
+        info = await self.info()
+        return int(info["size"])
+
+    async def info(self):
+        "Returns the info dictionary about the filter."
+        return await self._execute("info", self.commands["info"])
+
+    async def flush(self):
+        "Forces the filter to flush to disk"
+        await self._execute("flush", self.commands["flush"])
+
+    def pipeline(self):
+        "Creates an AsyncBloomdPipeline for pipelining multiple queries"
+        return AsyncBloomdPipeline(self.pool, self.name, self.hash_keys)
+
+
+class AsyncBloomdPipeline(object):
+    "Provides an asyncio pipeline interface to a single Bloomd filter"
+    def __init__(self, pool, name, hash_keys=False):
+        """
+        Creates a new AsyncBloomdPipeline object.
+
+        :Parameters:
+            - pool : The AsyncConnectionPool to use
+            - name : The name of the filter
+            - hash_keys : Should the keys be hashed client side
+        """
+        self.pool = pool
+        self.name = name
+        self.hash_keys = hash_keys
+        self.hasher = KeyHasher.from_setting(hash_keys)
+        self.commands = _filter_commands(name)
+        self.buf = []
+
+    def add(self, key):
+        "Adds a new key to the filter."
+        self.buf.append(("add", _key_command(self.commands["s"], key, self.hasher)))
+        return self
+
+    def bulk(self, keys):
+        "Performs a bulk set command, adds multiple keys in the filter"
+        command = _keys_command(self.commands["b"], keys, self.hasher)
+        self.buf.append(("bulk", command))
+        return self
+
+    def drop(self):
+        "Deletes the filter from the server. This is permanent"
+        self.buf.append(("drop", self.commands["drop"]))
+        return self
+
+    def close(self):
+        "Closes the filter on the server."
+        self.buf.append(("close", self.commands["close"]))
+        return self
+
+    def clear(self):
+        "Clears the filter on the server."
+        self.buf.append(("clear", self.commands["clear"]))
+        return self
+
+    def check(self, key):
+        "Checks if the key is contained in the filter."
+        self.buf.append(("check", _key_command(self.commands["c"], key, self.hasher)))
+        return self
+
+    def multi(self, keys):
+        "Performs a multi command, checks for multiple keys in the filter"
+        command = _keys_command(self.commands["m"], keys, self.hasher)
+        self.buf.append(("multi", command))
+        return self
+
+    def info(self):
+        "Returns the info dictionary about the filter."
+        self.buf.append(("info", self.commands["info"]))
+        return self
+
+    def flush(self):
+        "Forces the filter to flush to disk"
+        self.buf.append(("flush", self.commands["flush"]))
+        return self
+
+    def merge(self, pipeline):
+        """
+        Merges this pipeline with another pipeline. Commands from the
+        other pipeline are appended to the commands of this pipeline.
+        Both pipelines must use the same connection pool, otherwise
+        the commands would be sent to the wrong server.
+        """
+        if pipeline.pool is not self.pool:
+            raise BloomdError("Cannot merge pipelines for different servers!")
+        self.buf.extend(pipeline.buf)
+        return self
+
+    async def execute(self):
+        """
+        Executes the pipelined commands. All commands are written to
+        a single connection at once, and responses are returned in
+        appropriate order. Failed commands are returned as BloomdError
+        instances in place of their result.
+        """
+        buf = self.buf
+        self.buf = []
+        if not buf:
+            return []
+
+        conn = self.pool.get_connection()
+        futures = await conn.send_many([(cmd, name == "info") for name, cmd in buf])
+
+        all_resp = []
+        for (name, cmd), future in zip(buf, futures):
+            try:
+                all_resp.append(_parse_response(name, await conn.wait(future)))
+            except BloomdError as e:
+                all_resp.append(e)
+        return all_resp
@@ -1,6 +1,12 @@
+import sys
 from setuptools import setup, Command
 import pybloomd
 
+# The asyncio client is only installed on Python 3.5+
+py_modules = ['pybloomd']
+if sys.version_info >= (3, 5):
+    py_modules.append('pybloomd_async')
+
 # Get the long description by reading the README
 try:
     readme_content = open("README.rst").read()
@@ -19,7 +25,7 @@ setup(name='pybloomd',
       url="https://github.com/kiip/bloom-python-driver/",
       license="MIT License",
       keywords=["bloom", "filter","client","bloomd"],
-      py_modules=['pybloomd'],
+      py_modules=py_modules,
       classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",
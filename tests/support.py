@@ -0,0 +1,25 @@
+"""
+Shared helpers for the tests, which run the client against the
+stand-in server from the benchmarks.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+from server import StandInServer
+
+
+def start_server():
+    "Starts a stand-in server on a free port, returning it"
+    return StandInServer().start()
+
+
+def wait_for(predicate, timeout=2.0, interval=0.005):
+    "Polls `predicate` until it is true, returning its last value"
+    deadline = time.time() + timeout
+    while True:
+        value = predicate()
+        if value or time.time() > deadline:
+            return value
+        time.sleep(interval)
@@ -0,0 +1,83 @@
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pybloomd import _array_commands, _integer_rows, _join_rows
+
+
+def joined(values):
+    "Returns the keys as bytes joined by spaces, as the protocol expects"
+    return " ".join(str(int(value)) for value in values).encode("ascii")
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class IntegerRowsTest(unittest.TestCase):
+    def check(self, values, dtype):
+        keys = numpy.array(values, dtype=dtype)
+        self.assertEqual(_join_rows(_integer_rows(keys)), joined(values))
+
+    def test_positive_and_zero(self):
+        self.check([0, 1, 9, 10, 99, 100, 12345], numpy.int64)
+        self.check([0], numpy.int32)
+        self.check([0, 0, 7], numpy.uint8)
+
+    def test_negative(self):
+        self.check([-1, 0, 1, -10, 10, -12345, 5], numpy.int64)
+        self.check([-5, -50, -500], numpy.int16)
+        self.check([-128, 127, 0], numpy.int8)
+
+    def test_int64_limits(self):
+        info = numpy.iinfo(numpy.int64)
+        self.check([info.min, info.max, -1, 0], numpy.int64)
+
+    def test_uint64_above_int64_max(self):
+        self.check([2 ** 63, 2 ** 64 - 1, 2 ** 63 - 1, 0, 1], numpy.uint64)
+
+    def test_empty(self):
+        keys = numpy.array([], dtype=numpy.int64)
+        self.assertEqual(_join_rows(_integer_rows(keys)), b"")
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class ArrayCommandsTest(unittest.TestCase):
+    def commands(self, keys, max_keys=10000, max_bytes=512 * 1024):
+        return list(_array_commands(b"m f ", keys, max_keys, max_bytes))
+
+    def test_integer_chunks(self):
+        values = list(range(-20, 21))
+        keys = numpy.array(values, dtype=numpy.int64)
+        for max_keys in (1, 3, 7, 41, 100):
+            cmds = self.commands(keys, max_keys=max_keys)
+            self.assertEqual(len(cmds), (len(values) + max_keys - 1) // max_keys)
+            self.assertEqual(b" ".join(cmd[len(b"m f "):] for cmd in cmds), joined(values))
+            for cmd in cmds:
+                self.assertLessEqual(cmd.count(b" ") - 1, max_keys)
+
+    def test_byte_limit_chunks(self):
+        keys = numpy.arange(1000, dtype=numpy.uint64) + 2 ** 63
+        cmds = self.commands(keys, max_bytes=200)
+        self.assertTrue(all(len(cmd) <= 200 for cmd in cmds))
+        self.assertEqual(b" ".join(cmd[len(b"m f "):] for cmd in cmds),
+                         joined(int(key) for key in keys))
+
+    def test_string_arrays(self):
+        keys = numpy.array([b"a", b"bb", b"ccc"], dtype="S3")
+        self.assertEqual(self.commands(keys), [b"m f a bb ccc"])
+        keys = numpy.array([u"a", u"caf\xe9", u"xyz"])
+        self.assertEqual(self.commands(keys, max_keys=2),
+                         [u"m f a caf\xe9".encode("utf-8"), b"m f xyz"])
+
+    def test_invalid_string_keys(self):
+        for keys in ([b"a", b""], [b"a b"], [u"a\nb"]):
+            self.assertRaises(ValueError, self.commands, numpy.array(keys))
+
+    def test_unsupported_arrays(self):
+        self.assertRaises(TypeError, self.commands, numpy.array([1.5]))
+        self.assertRaises(ValueError, self.commands, numpy.zeros((2, 2), dtype=numpy.int64))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import sys
+import unittest
+
+from tests.support import start_server
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from pybloomd import BloomdError
+    from pybloomd_async import AsyncBloomdClient
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio client requires Python 3.5")
+class AsyncFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncBloomdClient([self.server.address], timeout=5)
+        self.filter = self.run_async(self.client.create_filter("async", in_memory=True))
+
+    def tearDown(self):
+        self.run_async(self.client.close())
+        self.loop.close()
+        self.server.stop()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_bytes_and_text_keys_match(self):
+        self.assertTrue(self.run_async(self.filter.add(b"bk")))
+        self.assertTrue(self.run_async(self.filter.check("bk")))
+        self.assertEqual(self.run_async(self.filter.multi([b"bk", "bk", b"a"])),
+                         [True, True, False])
+        self.assertEqual(self.run_async(self.filter.bulk([u"caf\xe9", b"caf\xc3\xa9"])),
+                         [True, False])
+
+    def test_invalid_keys_are_rejected(self):
+        for key in ("a b", "a\nb", ""):
+            self.assertRaises(ValueError, lambda: self.run_async(self.filter.add(key)))
+            self.assertRaises(ValueError, self.filter.pipeline().check, key)
+        self.assertRaises(ValueError, lambda: self.run_async(self.filter.multi(["a", "b c"])))
+
+    def test_large_multi(self):
+        keys = ["key%d" % i for i in range(30000)]
+        self.assertEqual(self.run_async(self.filter.bulk(keys[::2])), [True] * 15000)
+        expected = [i % 2 == 0 for i in range(30000)]
+        self.assertEqual(self.run_async(self.filter.multi(keys, max_keys=7000)), expected)
+
+        # A single unchunked response line longer than 64KB
+        pipe = self.filter.pipeline().multi(keys).check("key0")
+        self.assertEqual(self.run_async(pipe.execute()), [expected, True])
+        self.assertEqual(len(self.server.filters["async"].keys), 15000)
+
+    def test_pipeline(self):
+        pipe = self.filter.pipeline().add(b"x").check("x").multi([b"x", "y"])
+        self.assertEqual(self.run_async(pipe.execute()), [True, True, [True, False]])
+
+    def test_merge_rejects_other_pools(self):
+        other = start_server()
+        try:
+            client = AsyncBloomdClient([other.address])
+            remote = self.run_async(client.create_filter("async", in_memory=True))
+            self.assertRaises(BloomdError, self.filter.pipeline().merge, remote.pipeline())
+            self.run_async(client.close())
+        finally:
+            other.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
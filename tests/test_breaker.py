@@ -0,0 +1,93 @@
+import logging
+import time
+import unittest
+
+from pybloomd import (BloomdClient, BloomdConnection, BloomdError, BloomdServerDown,
+                      CircuitBreaker)
+from tests.support import start_server, wait_for
+
+
+class RecordingHandler(logging.Handler):
+    "Keeps the log records it handles"
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_open_half_open_close(self):
+        breaker = CircuitBreaker("server", failure_threshold=2, reset_timeout=0.05)
+        breaker.failure()
+        breaker.allow()
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(BloomdServerDown, breaker.allow)
+
+        # One probe is let through once the reset timeout passes
+        time.sleep(0.06)
+        breaker.allow()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertRaises(BloomdServerDown, breaker.allow)
+
+        # A failed probe opens the circuit for longer
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.04)
+        self.assertRaises(BloomdServerDown, breaker.allow)
+        time.sleep(0.07)
+        breaker.allow()
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+        breaker.allow()
+
+
+class ServerBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            for pool in self.client.sever_pools.values():
+                pool.disconnect()
+        self.server.stop()
+
+    def test_open_circuit_is_not_logged(self):
+        breaker = CircuitBreaker(self.server.address, failure_threshold=1)
+        breaker.failure()
+        conn = BloomdConnection(self.server.address, 1, breaker=breaker)
+        handler = RecordingHandler()
+        conn.logger.addHandler(handler)
+        try:
+            self.assertRaises(BloomdServerDown, conn.send_and_receive, b"list")
+        finally:
+            conn.logger.removeHandler(handler)
+        self.assertEqual(handler.records, [])
+
+    def test_multiplexed_timeouts_open_circuit(self):
+        options = {"failure_threshold": 2, "reset_timeout": 0.1}
+        self.client = BloomdClient([self.server.address], timeout=0.05, multiplex=1,
+                                   circuit_breaker=options)
+        foobar = self.client.create_filter("foobar", in_memory=True)
+        breaker = self.client.breakers[self.server.address]
+
+        # Hang the server by holding the lock its commands run under
+        with self.server.lock:
+            for i in range(2):
+                self.assertRaises(BloomdError, foobar.check, "key")
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            start = time.time()
+            self.assertRaises(BloomdServerDown, foobar.check, "key")
+            self.assertLess(time.time() - start, 0.05)
+
+        # The late responses show the server is back
+        self.assertTrue(wait_for(lambda: breaker.state == CircuitBreaker.CLOSED))
+        self.assertFalse(foobar.check("key"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import time
+import unittest
+
+from pybloomd import BloomdClient
+from tests.support import start_server, wait_for
+
+
+class BufferedFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.client = BloomdClient([self.server.address])
+        self.filter = self.client.create_filter("buffered", in_memory=True)
+        self.keys = self.server.filters["buffered"].keys
+
+    def tearDown(self):
+        for pool in self.client.sever_pools.values():
+            pool.disconnect()
+        self.server.stop()
+
+    def test_single_key_sent_after_max_age(self):
+        buf = self.filter.buffered(max_keys=1000, max_age=0.05)
+        try:
+            for key in ("buf1", "buf2", "buf3"):
+                buf.add(key)
+                self.assertTrue(wait_for(lambda: key in self.keys, timeout=1.0),
+                                "%s was not flushed by age" % key)
+                time.sleep(0.1)
+        finally:
+            buf.close()
+
+    def test_flush_at_max_keys(self):
+        buf = self.filter.buffered(max_keys=10, max_age=60)
+        try:
+            futures = [buf.add("key%d" % i, future=True) for i in range(10)]
+            self.assertEqual([fut.result(timeout=1.0) for fut in futures], [True] * 10)
+            buf.add("late")
+            time.sleep(0.1)
+            self.assertNotIn("late", self.keys)
+        finally:
+            buf.close()
+        self.assertIn("late", self.keys)
+
+    def test_callbacks_get_results(self):
+        results = []
+        with self.filter.buffered(max_keys=1000, max_age=0.01) as buf:
+            buf.add("a", callback=lambda fut: results.append(fut.result()))
+            buf.add("a", callback=lambda fut: results.append(fut.result()))
+        self.assertEqual(sorted(results), [False, True])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import threading
+import time
+import unittest
+
+import pybloomd
+from pybloomd import BloomdError, _fan_out, _fan_out_partial, _WorkerPool
+from tests.support import wait_for
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_busy_pool_runs_on_caller(self):
+        pool = _WorkerPool(max_workers=2)
+        release = threading.Event()
+        self.assertTrue(pool.run(release.wait))
+        self.assertTrue(pool.run(release.wait))
+        self.assertFalse(pool.run(release.wait))
+        threads = []
+        pool.call(lambda: threads.append(threading.current_thread()))
+        self.assertEqual(threads, [threading.current_thread()])
+        release.set()
+
+    def test_workers_are_reused(self):
+        pool = _WorkerPool(max_workers=4)
+        done = threading.Event()
+        for i in range(20):
+            done.clear()
+            pool.call(done.set)
+            self.assertTrue(done.wait(1.0))
+            self.assertTrue(wait_for(lambda: pool._idle == 1))
+        self.assertEqual(pool._workers, 1)
+
+
+class FanOutTest(unittest.TestCase):
+    def setUp(self):
+        self.workers = pybloomd._workers
+        pybloomd._workers = _WorkerPool(max_workers=2)
+
+    def tearDown(self):
+        pybloomd._workers = self.workers
+
+    def test_results_in_order(self):
+        self.assertEqual(_fan_out(lambda i: i * 2, range(10)), list(range(0, 20, 2)))
+        self.assertLessEqual(pybloomd._workers._workers, 2)
+
+    def test_errors_and_timeouts(self):
+        def call(item):
+            if item == "slow":
+                time.sleep(0.2)
+            if item == "bad":
+                raise ValueError(item)
+            return item
+        results, errors = _fan_out_partial(call, ["slow", "bad", "ok"], timeout=0.05)
+        self.assertEqual(results, {"ok": "ok"})
+        self.assertIsInstance(errors["bad"], ValueError)
+        self.assertIsInstance(errors["slow"], BloomdError)
+
+    def test_nested_fan_out_does_not_deadlock(self):
+        outer = _fan_out(lambda i: sum(_fan_out(lambda j: i * j, range(4))), range(4))
+        self.assertEqual(outer, [0, 6, 12, 18])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+import hashlib
+import unittest
+
+from pybloomd import KeyHasher
+
+
+class KeyHasherTest(unittest.TestCase):
+    keys = [b"bytes", u"text", u"caf\xe9", b"", u"a b\nc"]
+
+    def test_default_is_sha1_hex(self):
+        hasher = KeyHasher.from_setting(True)
+        self.assertEqual(hasher(u"caf\xe9"), hashlib.sha1(u"caf\xe9".encode("utf-8")).hexdigest())
+        self.assertEqual(hasher(b"bytes"), hasher(u"bytes"))
+
+    def test_hash_many_matches_hash_one(self):
+        for encoding in ("hex", "base64", "base62"):
+            for digest_size in (None, 8, 9):
+                hasher = KeyHasher("sha1", digest_size, encoding)
+                self.assertEqual(hasher.hash_many(self.keys), [hasher(k) for k in self.keys])
+                self.assertEqual(list(hasher.hash_iter(iter(self.keys), batch_size=2)),
+                                 hasher.hash_many(self.keys))
+
+    def test_truncated_digests(self):
+        hasher = KeyHasher("sha1", 8, "hex")
+        self.assertEqual(hasher(b"key"), hashlib.sha1(b"key").hexdigest()[:16])
+        self.assertEqual(len(KeyHasher("sha1", 9, "base64")(b"key")), 12)
+
+
+if __name__ == "__main__":
+    unittest.main()
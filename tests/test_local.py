@@ -0,0 +1,108 @@
+import re
+import unittest
+
+from pybloomd import BloomdClient, LocalBackend, LocalBloomFilter
+
+# The keys of a bloomd info block
+INFO_KEYS = set(["capacity", "checks", "check_hits", "check_misses", "in_memory", "page_ins",
+                 "page_outs", "probability", "sets", "set_hits", "set_misses", "size",
+                 "storage"])
+
+
+class LocalBloomFilterTest(unittest.TestCase):
+    def false_positive_rate(self, f, count):
+        return sum(f.check("miss%d" % i) for i in range(count)) / float(count)
+
+    def test_false_positives_under_prob(self):
+        f = LocalBloomFilter("local", capacity=10000, prob=0.01)
+        for i in range(10000):
+            f.add("key%d" % i)
+        self.assertTrue(all(f.check("key%d" % i) for i in range(10000)))
+        self.assertLess(self.false_positive_rate(f, 20000), 0.01)
+
+    def test_grows_past_capacity(self):
+        f = LocalBloomFilter("local", capacity=1000, prob=0.01)
+        added = sum(f.add("key%d" % i) for i in range(10000))
+        self.assertEqual(f.size, added)
+        self.assertGreater(added, 9900)
+        self.assertEqual(len(f.layers), 3)
+        self.assertEqual(f.total_capacity(), 1000 + 4000 + 16000)
+        self.assertTrue(all(f.check("key%d" % i) for i in range(10000)))
+        self.assertLess(self.false_positive_rate(f, 20000), 0.01)
+
+    def test_add_reports_existing_keys(self):
+        f = LocalBloomFilter("local")
+        self.assertTrue(f.add(b"key"))
+        self.assertFalse(f.add(u"key"))
+        self.assertEqual((f.sets, f.set_hits, f.size), (2, 1, 1))
+
+    def test_clear(self):
+        f = LocalBloomFilter("local", capacity=100)
+        for i in range(1000):
+            f.add("key%d" % i)
+        f.clear()
+        self.assertEqual((f.size, len(f.layers), f.total_capacity()), (0, 1, 100))
+        self.assertFalse(f.check("key1"))
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, LocalBloomFilter, "local", capacity=0)
+        self.assertRaises(ValueError, LocalBloomFilter, "local", prob=1.5)
+
+
+class LocalBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = LocalBackend()
+
+    def test_info_and_list_match_bloomd(self):
+        self.assertEqual(self.backend.execute("create foobar capacity=1000 prob=0.001 in_memory=1"),
+                         ["Done"])
+        self.assertEqual(self.backend.execute("b foobar a b a"), ["Yes Yes No"])
+        self.assertEqual(self.backend.execute("m foobar a c"), ["Yes No"])
+
+        lines = self.backend.execute("list")
+        self.assertEqual((lines[0], lines[-1], len(lines)), ("START", "END", 3))
+        self.assertTrue(re.match(r"^foobar 0\.001000 \d+ 1000 2$", lines[1]), lines[1])
+
+        lines = self.backend.execute(b"info foobar")
+        self.assertEqual((lines[0], lines[-1]), ("START", "END"))
+        info = dict(line.split(" ", 1) for line in lines[1:-1])
+        self.assertEqual(set(info), INFO_KEYS)
+        self.assertEqual(info["probability"], "0.001000")
+        self.assertEqual((info["in_memory"], info["size"], info["capacity"]), ("1", "2", "1000"))
+        self.assertEqual((info["sets"], info["set_hits"], info["set_misses"]), ("3", "2", "1"))
+        self.assertEqual((info["checks"], info["check_hits"], info["check_misses"]), ("2", "1", "1"))
+
+    def test_errors(self):
+        self.assertEqual(self.backend.execute("c missing a"), ["Filter does not exist"])
+        self.assertEqual(self.backend.execute("create"), ["Client Error: Must provide filter name"])
+        self.assertEqual(self.backend.execute("create f capacity=x"), ["Client Error: Bad arguments"])
+        self.assertEqual(self.backend.execute("conf"), ["Client Error: Command not supported"])
+        self.backend.execute("create f")
+        self.assertEqual(self.backend.execute("create f"), ["Exists"])
+        self.assertEqual(self.backend.execute("s f"),
+                         ["Client Error: Must provide filter name and key"])
+
+
+class LocalClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = "local://%s" % self.id()
+        self.client = BloomdClient([self.server])
+
+    def test_clear_and_drop(self):
+        foobar = self.client.create_filter("foobar", capacity=1000)
+        self.assertEqual(foobar.bulk(["a", "b"]), [True, True])
+        self.assertEqual(len(foobar), 2)
+        self.assertEqual(self.client.list_filters(), {"foobar": "0.000100 %d 1000 2" %
+                                                      foobar.stats()["storage"]})
+
+        foobar.clear()
+        self.assertFalse(foobar.check("a"))
+        self.assertEqual(len(foobar), 0)
+
+        foobar.drop()
+        self.assertEqual(self.client.list_filters(), {})
+        self.assertEqual(LocalBackend.named(self.server).filters, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
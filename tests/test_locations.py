@@ -0,0 +1,67 @@
+import time
+import unittest
+
+from pybloomd import BloomdClient, BloomdFanOutError
+from tests.support import start_server
+
+
+class FilterLocationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = [start_server() for i in range(2)]
+        self.addresses = [server.address for server in self.servers]
+        self.client = BloomdClient(self.addresses, timeout=1, negative_ttl=0.2,
+                                   metrics=True, circuit_breaker=False)
+        self.locations = self.client.locations
+
+    def tearDown(self):
+        self.disconnect()
+        for server in self.servers:
+            server.stop()
+
+    def disconnect(self):
+        for pool in self.client.sever_pools.values():
+            pool.disconnect()
+
+    def resolves(self):
+        return self.client.metrics.snapshot()["locations"]["resolves"]
+
+    def test_lookup_finds_filter(self):
+        self.servers[1].execute("create foobar in_memory=1")
+        self.assertEqual(self.locations.lookup("foobar"), self.addresses[1])
+        resolves = self.resolves()
+        self.assertEqual(self.locations.lookup("foobar"), self.addresses[1])
+        self.assertEqual(self.resolves(), resolves)
+
+    def test_missing_filters_are_remembered_for_negative_ttl(self):
+        self.assertIsNone(self.locations.lookup("foobar"))
+        resolves = self.resolves()
+        self.servers[0].execute("create foobar in_memory=1")
+        self.assertIsNone(self.locations.lookup("foobar"))
+        self.assertEqual(self.resolves(), resolves)
+        time.sleep(0.25)
+        self.assertEqual(self.locations.lookup("foobar"), self.addresses[0])
+        self.assertEqual(self.resolves(), resolves + 1)
+
+    def test_refresh_keeps_filters_of_failed_servers(self):
+        self.servers[0].execute("create a in_memory=1")
+        self.servers[1].execute("create b in_memory=1")
+        self.assertEqual(self.locations.all(), {"a": self.addresses[0], "b": self.addresses[1]})
+
+        # Take the second server down and drop its open connections
+        self.servers[1].stop()
+        self.disconnect()
+        self.servers[0].execute("create c in_memory=1")
+        self.locations.refresh()
+        self.assertEqual(self.locations.all(), {"a": self.addresses[0], "b": self.addresses[1],
+                                                "c": self.addresses[0]})
+        self.assertEqual(self.client.metrics.snapshot()["locations"]["refresh_failures"], 1)
+
+        # Nothing is forgotten when every server fails
+        self.servers[0].stop()
+        self.disconnect()
+        self.assertRaises(BloomdFanOutError, self.locations.refresh)
+        self.assertEqual(sorted(self.locations.all()), ["a", "b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
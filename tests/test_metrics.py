@@ -0,0 +1,50 @@
+import threading
+import unittest
+
+from pybloomd import BloomdClient, BloomdMetrics
+from tests.support import start_server, wait_for
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.sent = []
+        self.threads = set()
+        self.metrics = BloomdMetrics(on_send=[self.on_send])
+
+    def tearDown(self):
+        for pool in self.client.sever_pools.values():
+            pool.disconnect()
+        self.server.stop()
+
+    def on_send(self, server, command, nbytes):
+        self.sent.append((command, nbytes))
+        self.threads.add(threading.current_thread())
+
+    def check_pipeline(self, **options):
+        self.client = BloomdClient([self.server.address], metrics=self.metrics, **options)
+        foobar = self.client.create_filter("foobar", in_memory=True)
+        self.threads.clear()
+
+        pipe = foobar.pipeline()
+        cmds = [b"c foobar key%d" % i for i in range(1000)]
+        for i in range(1000):
+            pipe.check("key%d" % i)
+        pipe.execute()
+
+        # Multiplexed hooks run on the writer, which may lag the responses
+        checks = lambda: [nbytes for command, nbytes in self.sent if command == "c"]
+        self.assertTrue(wait_for(lambda: len(checks()) == 1000))
+        self.assertEqual(checks(), [len(cmd) + 1 for cmd in cmds])
+
+    def test_send_hook_gets_command_sizes(self):
+        self.check_pipeline()
+        self.assertEqual(self.threads, set([threading.current_thread()]))
+
+    def test_send_hook_gets_command_sizes_multiplexed(self):
+        self.check_pipeline(multiplex=1)
+        self.assertNotIn(threading.current_thread(), self.threads)
+
+
+if __name__ == "__main__":
+    unittest.main()
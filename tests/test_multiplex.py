@@ -0,0 +1,99 @@
+import socket
+import threading
+import unittest
+
+from pybloomd import BloomdClient, MultiplexedConnection
+from tests.support import start_server, wait_for
+
+
+class MultiplexTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.client = BloomdClient([self.server.address], timeout=5, multiplex=1)
+        self.filter = self.client.create_filter("mux", in_memory=True)
+
+    def tearDown(self):
+        for pool in self.client.sever_pools.values():
+            pool.disconnect()
+        self.server.stop()
+
+    def test_responses_match_callers(self):
+        self.filter.bulk(["key%d" % i for i in range(0, 1000, 2)])
+        errors = []
+
+        def check(offset):
+            try:
+                for i in range(offset, 1000, 8):
+                    if self.filter.check("key%d" % i) != (i % 2 == 0):
+                        errors.append(i)
+                pipe = self.filter.pipeline()
+                for i in range(offset, 1000, 8):
+                    pipe.check("key%d" % i)
+                if pipe.execute() != [i % 2 == 0 for i in range(offset, 1000, 8)]:
+                    errors.append(offset)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=check, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_futures_resolve_in_order(self):
+        conn = MultiplexedConnection(self.server.address)
+        try:
+            futures = conn.submit([b"s mux a", b"s mux a", b"c mux a", b"c mux b"])
+            futures += conn.submit([b"info mux"])
+            self.assertEqual([fut.result(2.0) for fut in futures[:4]],
+                             [["Yes"], ["No"], ["Yes"], ["No"]])
+            lines = futures[4].result(2.0)
+            self.assertEqual((lines[0], lines[-1]), ("START", "END"))
+        finally:
+            conn.close()
+
+    def test_close_stops_reader(self):
+        conn = MultiplexedConnection(self.server.address)
+        for i in range(3):
+            before = set(threading.enumerate())
+            conn.connect()
+            readers = set(threading.enumerate()) - before
+            self.assertEqual(conn.submit([b"c mux a"])[0].result(2.0), ["No"])
+            conn.close()
+            self.assertTrue(wait_for(lambda: not any(t.is_alive() for t in readers)))
+
+
+class MultiplexFailureTest(unittest.TestCase):
+    def setUp(self):
+        # A server which reads the commands, then drops the connection
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.received = threading.Event()
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def serve(self):
+        conn, _ = self.listener.accept()
+        data = b""
+        while data.count(b"\n") < 3:
+            data += conn.recv(4096)
+        self.received.set()
+        conn.close()
+
+    def test_lost_connection_fails_every_pending_future(self):
+        conn = MultiplexedConnection("127.0.0.1:%d" % self.listener.getsockname()[1])
+        futures = conn.submit([b"c mux a", b"c mux b"]) + conn.submit([b"c mux c"])
+        self.assertTrue(self.received.wait(2.0))
+        for future in futures:
+            self.assertRaises(EnvironmentError, future.result, 2.0)
+        self.assertIsNone(conn.sock)
+
+
+if __name__ == "__main__":
+    unittest.main()
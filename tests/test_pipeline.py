@@ -0,0 +1,40 @@
+import unittest
+
+from pybloomd import BloomdClient
+from tests.support import start_server
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.client = BloomdClient([self.server.address], timeout=5)
+        self.filter = self.client.create_filter("pipeline", in_memory=True)
+
+    def tearDown(self):
+        for pool in self.client.sever_pools.values():
+            pool.disconnect()
+        self.server.stop()
+
+    def test_execute_iter_in_order(self):
+        pipe = self.filter.pipeline()
+        for i in range(50):
+            pipe.add("key%d" % (i % 25))
+        results = list(pipe.execute_iter(window=4))
+        self.assertEqual(results, [True] * 25 + [False] * 25)
+
+    def test_execute_iter_limits_bytes_in_flight(self):
+        # Each command and response is far larger than the socket
+        # buffers allow to be outstanding at once
+        keys = ["key%d" % i for i in range(20000)]
+        pipe = self.filter.pipeline()
+        for i in range(300):
+            pipe.multi(keys)
+        count = 0
+        for result in pipe.execute_iter():
+            self.assertEqual(len(result), len(keys))
+            count += 1
+        self.assertEqual(count, 300)
+
+
+if __name__ == "__main__":
+    unittest.main()
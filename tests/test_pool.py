@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+import unittest
+
+from pybloomd import BloomdPoolTimeout, ConnectionPool
+
+
+class FakeConnection(object):
+    "Stands in for a BloomdConnection, recording disconnects"
+    def __init__(self, pool=None):
+        self.pid = os.getpid()
+        self.pool = pool
+        self.last_used = time.time()
+        self.stale = False
+        self.disconnects = 0
+
+    def is_stale(self):
+        return self.stale
+
+    def disconnect(self):
+        self.disconnects += 1
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def make_pool(self, **options):
+        return ConnectionPool(FakeConnection, **options)
+
+    def test_connections_are_reused(self):
+        pool = self.make_pool()
+        conn = pool.get_connection()
+        other = pool.get_connection()
+        self.assertIsNot(conn, other)
+        pool.release(conn)
+        self.assertIs(pool.get_connection(), conn)
+        self.assertEqual(pool.stats()["created"], 2)
+
+    def test_checkout_blocks_until_release(self):
+        pool = self.make_pool(max_connections=1)
+        conn = pool.get_connection()
+        got = []
+        t = threading.Thread(target=lambda: got.append(pool.get_connection()))
+        t.start()
+        time.sleep(0.05)
+        self.assertEqual(got, [])
+        pool.release(conn)
+        t.join(1.0)
+        self.assertEqual(got, [conn])
+        stats = pool.stats()
+        self.assertEqual((stats["created"], stats["waits"]), (1, 1))
+        self.assertGreaterEqual(stats["max_wait_time"], 0.04)
+
+    def test_pool_timeout(self):
+        pool = self.make_pool(max_connections=1, pool_timeout=0.05)
+        pool.get_connection()
+        start = time.time()
+        self.assertRaises(BloomdPoolTimeout, pool.get_connection)
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual(pool.stats()["waits"], 1)
+
+    def test_idle_connections_are_evicted(self):
+        pool = self.make_pool(max_idle_time=0.05)
+        conn = pool.get_connection()
+        pool.release(conn)
+        time.sleep(0.1)
+        fresh = pool.get_connection()
+        self.assertIsNot(fresh, conn)
+        self.assertEqual(conn.disconnects, 1)
+        self.assertEqual(pool.stats()["created"], 1)
+
+    def test_stale_connections_are_reset(self):
+        pool = self.make_pool()
+        conn = pool.get_connection()
+        pool.release(conn)
+        conn.stale = True
+        self.assertIs(pool.get_connection(), conn)
+        self.assertEqual(conn.disconnects, 1)
+
+    def test_failed_connect_frees_slot(self):
+        pool = self.make_pool(max_connections=1, pool_timeout=0.05)
+        make = pool.make_connection
+        pool.make_connection = lambda: 1 / 0
+        self.assertRaises(ZeroDivisionError, pool.get_connection)
+        pool.make_connection = make
+        self.assertIsInstance(pool.get_connection(), FakeConnection)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import time
+import unittest
+
+from pybloomd import BloomdClient, BloomdFanOutError, ReplicatedBloomdFilter
+from tests.support import start_server, wait_for
+
+
+class ReplicatedFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = [start_server() for i in range(2)]
+        self.addresses = [server.address for server in self.servers]
+        self.clients = []
+        client = self.make_client()
+        client.create_replicated_filter("replicated", self.addresses, in_memory=True)
+        self.filter = self.make_filter(client)
+        self.assertEqual(self.filter.bulk(["a", "b"]), [True, True])
+
+    def tearDown(self):
+        for client in self.clients:
+            for pool in client.sever_pools.values():
+                pool.disconnect()
+        for server in self.servers:
+            server.stop()
+
+    def make_client(self):
+        client = BloomdClient(self.addresses, timeout=2, circuit_breaker=False)
+        self.clients.append(client)
+        return client
+
+    def make_filter(self, client):
+        return ReplicatedBloomdFilter(client, "replicated", self.addresses, hedge_delay=0.02)
+
+    def test_writes_reach_every_replica(self):
+        for server in self.servers:
+            self.assertEqual(server.filters["replicated.127_0_0_1_%d" % server.server_address[1]]
+                             .keys, set(["a", "b"]))
+
+    def test_replicas_ignore_other_client_servers(self):
+        extra = start_server()
+        try:
+            client = BloomdClient([extra.address] + self.addresses)
+            self.clients.append(client)
+            replicated = client.replicated_filter("replicated", self.addresses)
+            self.assertEqual(replicated.add("c"), True)
+            self.assertTrue(replicated.check("c"))
+            self.assertEqual(extra.filters, {})
+            self.assertRaises(ValueError, client.replicated_filter, "replicated", [])
+        finally:
+            extra.stop()
+
+    def test_slow_replica_is_hedged(self):
+        fastest, other = self.filter.ranked()
+        # Hang the fastest replica by holding the lock its commands run under
+        with self.servers[self.addresses.index(fastest)].lock:
+            start = time.time()
+            self.assertTrue(self.filter.check("a"))
+            self.assertEqual(self.filter.multi(["a", "c"]), [True, False])
+            self.assertLess(time.time() - start, 1.0)
+        # The hung replica finishes in the background, and is ranked lower
+        self.assertTrue(wait_for(lambda: self.filter.ranked()[0] == other))
+
+    def test_failed_replica_fails_over(self):
+        self.servers[0].stop()
+        replicated = self.make_filter(self.make_client())
+        self.assertTrue(replicated.check("a"))
+        self.assertEqual(replicated.ranked(), [self.addresses[1], self.addresses[0]])
+
+    def test_every_replica_failing_raises(self):
+        for server in self.servers:
+            server.stop()
+        replicated = self.make_filter(self.make_client())
+        try:
+            replicated.check("a")
+        except BloomdFanOutError as e:
+            self.assertEqual(sorted(e.errors), sorted(self.addresses))
+        else:
+            self.fail("Expected BloomdFanOutError")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from pybloomd import BloomdClient, ShardedBloomdFilter
+from tests.support import start_server
+
+
+class ShardedFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = [start_server() for i in range(3)]
+        self.addresses = [server.address for server in self.servers]
+        self.client = BloomdClient(self.addresses)
+
+    def tearDown(self):
+        for pool in self.client.sever_pools.values():
+            pool.disconnect()
+        for server in self.servers:
+            server.stop()
+
+    def test_keys_spread_over_shards(self):
+        sharded = self.client.create_sharded_filter("sharded", self.addresses, in_memory=True)
+        keys = ["key%d" % i for i in range(300)]
+        self.assertEqual(sharded.bulk(keys), [True] * 300)
+        self.assertEqual(sharded.multi(keys + ["missing"]), [True] * 300 + [False])
+        self.assertIn("key1", sharded)
+        for server in self.servers:
+            self.assertTrue(server.filters)
+
+    def test_default_port_is_same_shard(self):
+        short = ShardedBloomdFilter(self.client, "s", ["bloomd1"])
+        full = ShardedBloomdFilter(self.client, "s", ["bloomd1:8673"])
+        self.assertEqual(list(short.shards), ["bloomd1:8673"])
+        self.assertEqual(list(full.shards), ["bloomd1:8673"])
+        self.assertEqual(short.shards["bloomd1:8673"].name, "s.bloomd1_8673")
+
+    def test_shard_ids_survive_a_host_change(self):
+        old = {"a": self.addresses[0], "b": self.addresses[1]}
+        sharded = self.client.create_sharded_filter("sharded", old, in_memory=True)
+        keys = ["key%d" % i for i in range(100)]
+        sharded.bulk(keys)
+
+        # Point shard "b" at a new server holding a copy of its filter
+        moved = self.servers[1].filters["sharded.b"]
+        self.servers[2].filters["sharded.b"] = moved
+        sharded = self.client.sharded_filter("sharded", {"a": self.addresses[0],
+                                                         "b": self.addresses[2]})
+        self.assertEqual(sharded.multi(keys), [True] * 100)
+
+    def test_previous_layout_is_checked_during_transition(self):
+        old = self.addresses[:2]
+        sharded = self.client.create_sharded_filter("sharded", old, in_memory=True)
+        keys = ["key%d" % i for i in range(300)]
+        sharded.bulk(keys)
+
+        new = self.client.create_sharded_filter("sharded", self.addresses, in_memory=True)
+        self.assertIn(False, new.multi(keys))
+
+        moving = self.client.sharded_filter("sharded", self.addresses, previous=old)
+        self.assertEqual(moving.multi(keys + ["missing"]), [True] * 300 + [False])
+        self.assertTrue(all(key in moving for key in keys))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import time
+import unittest
+
+from pybloomd import BloomdClient, BloomdError
+from tests.support import start_server, wait_for
+
+
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            for pool in client.sever_pools.values():
+                pool.disconnect()
+        self.server.stop()
+
+    def make_client(self, **options):
+        client = BloomdClient([self.server.address], **options)
+        self.clients.append(client)
+        return client
+
+    def test_info(self):
+        foobar = self.make_client().create_filter("foobar", in_memory=True)
+        foobar.bulk(["a", "b"])
+        info = foobar.info()
+        self.assertEqual(info["size"], "2")
+        self.assertEqual(info["in_memory"], "1")
+        self.assertEqual(len(foobar), 2)
+
+    def test_filter_stats(self):
+        client = self.make_client()
+        client.create_filter("a", in_memory=True).add("key")
+        client.create_filter("b", in_memory=True)
+        stats = client.filter_stats(["a", "b", "missing"])
+        self.assertEqual(sorted(stats), ["a", "b"])
+        self.assertEqual((stats["a"]["size"], stats["b"]["size"]), (1, 0))
+        self.assertIs(stats["a"]["in_memory"], True)
+
+    def test_cached_until_ttl(self):
+        client = self.make_client(stats_ttl=0.2)
+        foobar = client.create_filter("foobar", in_memory=True)
+        self.assertEqual(len(foobar), 0)
+        foobar.add("a")
+        self.assertEqual(len(foobar), 0)
+        self.assertEqual(client.stats_cache.stats()["hits"], 1)
+        time.sleep(0.25)
+        self.assertEqual(len(foobar), 1)
+        self.assertRaises(BloomdError, client.stats_cache.get, "missing")
+
+    def test_clear_and_drop_invalidate(self):
+        client = self.make_client(stats_ttl=60)
+        foobar = client.create_filter("foobar", in_memory=True)
+        foobar.bulk(["a", "b"])
+        self.assertEqual(len(foobar), 2)
+        foobar.clear()
+        self.assertEqual(len(foobar), 0)
+        foobar.drop()
+        self.assertNotIn("foobar", client.stats_cache.entries)
+        self.assertEqual(client.filter_stats(["foobar"]), {})
+
+    def test_background_refresh(self):
+        client = self.make_client(stats_ttl=0.05, stats_background=True)
+        foobar = client.create_filter("foobar", in_memory=True)
+        self.assertEqual(len(foobar), 0)
+        foobar.add("a")
+        time.sleep(0.1)
+        # The stale size is returned while it is fetched again
+        self.assertEqual(len(foobar), 0)
+        self.assertTrue(wait_for(lambda: len(foobar) == 1))
+
+
+if __name__ == "__main__":
+    unittest.main()